@@ -2,6 +2,8 @@ import os
 
 os.chdir("/home/tommaso/Repositories/teleRAG/")
 
+CHUNK_LEN = 4000  # characters per message chunk, leaving room for the " [i/n]" counter below Telegram's 4096 limit
+
 
 def load_api_token(path='bot/API_token'):
     """Load API token string from file"""
@@ -17,7 +19,7 @@ def check_length(text: str, max_length: int = 4096):
     return len(text) >= max_length
 
 
-def split_text(text: str, max_length: int = 4000):
+def split_text(text: str, max_length: int = CHUNK_LEN):
     """Split text into chunks if too long"""
     chunks = []
     for x in range(0, len(text), max_length):
@@ -0,0 +1,171 @@
+import time
+import asyncio
+import logging
+
+from telegram.error import Forbidden, BadRequest, RetryAfter, TelegramError
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter: tokens are refilled at 'rate' per second up to 'capacity', and each send takes one.
+
+    A flood-control answer from Telegram pauses the bucket for the time it asks (see 'pause').
+
+    Attributes
+    ----------
+    rate : float
+        tokens refilled per second (the sustained send rate)
+    capacity : float
+        maximum number of tokens (the largest burst)
+    """
+    def __init__(self, rate: float = 25.0, capacity: float | None = None):
+        """
+        Parameters
+        ----------
+        rate : float
+            tokens refilled per second (the sustained send rate)
+        capacity : float | None
+            maximum number of tokens (the largest burst), 'rate' if None
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for 'seconds', e.g. when Telegram answers with RetryAfter."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = self._paused_until
+
+    def idle(self) -> bool:
+        """Whether the bucket is full again and not paused, i.e. it behaves like a new one."""
+        now = time.monotonic()
+        return now >= self._paused_until and self._tokens + (now - self._updated) * self.rate >= self.capacity
+
+    async def acquire(self):
+        """Wait until a token is available and take it. Waiters are served in FIFO order."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Broadcaster:
+    """
+    Sends the same message to many chats, concurrently but within Telegram's rate limits.
+
+    Recipients are consumed from an async iterable (e.g. ChatCache.aiter_chat_ids, which pages them out of the database)
+    through a bounded queue, so that they are never all held in memory. 'max_concurrency' workers send the messages,
+    each send taking a token from a shared TokenBucket (Telegram allows about 30 messages per second overall; every chat
+    receives a single message, well within the per-chat limit). RetryAfter pauses the bucket for the requested time and
+    the send is retried, as are network errors (with exponential backoff); chats that blocked the bot or don't exist
+    anymore are skipped. Progress is logged every 'log_interval' seconds.
+
+    Attributes
+    ----------
+    bot : telegram.Bot
+        the bot sending the messages
+    bucket : TokenBucket
+        the rate limiter shared by the workers
+    max_concurrency : int
+        number of sends in flight
+    retries : int
+        number of retries of a failed send
+    log_interval : float
+        seconds between two progress logs
+    """
+    def __init__(self, bot, rate: float = 25.0, max_concurrency: int = 8, retries: int = 3, log_interval: float = 5.0,
+                 bucket: TokenBucket | None = None):
+        """
+        Parameters
+        ----------
+        bot : telegram.Bot
+            the bot sending the messages
+        rate : float
+            maximum number of messages per second
+        max_concurrency : int
+            number of sends in flight
+        retries : int
+            number of retries of a failed send
+        log_interval : float
+            seconds between two progress logs
+        bucket : TokenBucket | None
+            a rate limiter shared with other senders (e.g. OutboundDispatcher.bucket), which overrides 'rate'
+        """
+        self.bot = bot
+        self.bucket = TokenBucket(rate=rate) if bucket is None else bucket
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.log_interval = log_interval
+
+    async def send(self, chat_id, text: str) -> bool:
+        """Send 'text' to 'chat_id' within the rate limit, retrying throttled and failed sends. Return whether it was sent."""
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                return True
+            except RetryAfter as e:
+                logging.warning(f"broadcast throttled for {e.retry_after} seconds")
+                self.bucket.pause(float(e.retry_after))
+            except (Forbidden, BadRequest) as e:
+                # e.g., the user blocked the bot or the chat does not exist anymore: retrying won't help
+                logging.info(f"broadcast to {chat_id} skipped: {e}")
+                return False
+            except TelegramError as e:
+                logging.warning(f"broadcast to {chat_id} failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        return False
+
+    async def broadcast(self, chat_ids, text: str, timeout: float | None = None) -> dict:
+        """Send 'text' to every chat id of the (async) iterable 'chat_ids'.
+
+        With a 'timeout', the broadcast is cancelled after 'timeout' seconds and the remaining chats are not notified.
+        Return a dict with the number of messages sent and failed, whether the broadcast completed and the elapsed seconds.
+        """
+        stats = {"sent": 0, "failed": 0, "completed": False, "elapsed": 0.0}
+        start = time.monotonic()
+        recipients = asyncio.Queue(maxsize=2 * self.max_concurrency)
+
+        async def produce():
+            if hasattr(chat_ids, "__aiter__"):
+                async for chat_id in chat_ids:
+                    await recipients.put(chat_id)
+            else:
+                for chat_id in chat_ids:
+                    await recipients.put(chat_id)
+            for _ in range(self.max_concurrency):
+                await recipients.put(None)
+
+        async def work():
+            while (chat_id := await recipients.get()) is not None:
+                stats["sent" if await self.send(chat_id, text) else "failed"] += 1
+
+        async def report():
+            while True:
+                await asyncio.sleep(self.log_interval)
+                logging.info(f"broadcasting: {stats['sent']} sent, {stats['failed']} failed in {time.monotonic() - start:.0f}s")
+
+        reporter = asyncio.create_task(report())
+        try:
+            await asyncio.wait_for(asyncio.gather(produce(), *(work() for _ in range(self.max_concurrency))), timeout=timeout)
+            stats["completed"] = True
+        except asyncio.TimeoutError:
+            logging.warning(f"broadcast stopped after {timeout} seconds")
+        finally:
+            reporter.cancel()
+        stats["elapsed"] = time.monotonic() - start
+        logging.info(f"broadcast {'completed' if stats['completed'] else 'interrupted'}: "
+                     f"{stats['sent']} sent, {stats['failed']} failed in {stats['elapsed']:.1f}s")
+        return stats
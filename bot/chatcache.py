@@ -0,0 +1,264 @@
+import time
+import atexit
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+from bot.sqlutils import ChatStorage
+
+
+class ChatEntry:
+    """In-memory state of a chat: its most recent messages and the changes not yet written to the database."""
+    def __init__(self, messages: list[dict], complete: bool):
+        self.messages = messages  # last messages of the chat (DEFAULT template excluded)
+        self.complete = complete  # whether 'messages' holds the whole chat history
+        self.pending = []  # messages appended since the last flush
+        self.restarted = False  # whether the chat was restarted since the last flush
+
+    @property
+    def dirty(self) -> bool:
+        return self.restarted or len(self.pending) > 0
+
+
+class ChatCache:
+    """
+    In-memory write-behind cache of chat histories and session timestamps, in front of ChatStorage.
+
+    Hot conversations are served from memory: reads don't touch SQLite, and appends, restarts and session updates only mark
+    the chat as dirty. A background thread flushes all the dirty state every 'flush_interval' seconds in a single
+    transaction; the cache is also flushed on close (post_stop) and at interpreter exit. If a flush fails, the changes
+    stay dirty and are retried at the next one.
+    Session last-access updates are debounced: they are written at most once every 'session_debounce' seconds per chat,
+    an access held back by the debounce is written by the first flush after it expires, and the final flush on close
+    writes all the accesses still held back.
+    Clean chats are evicted in LRU order when more than 'max_chats' are cached; written sessions of chats that are not
+    cached are dropped as well when more than 'max_chats' sessions are held.
+
+    Attributes
+    ----------
+    storage : ChatStorage
+        the storage the changes are flushed to
+    max_chats : int
+        maximum number of chats kept in memory
+    max_messages : int
+        number of most recent messages kept in memory per chat
+    flush_interval : float
+        seconds between two flushes
+    session_debounce : float
+        minimum number of seconds between two writes of the last access of a chat
+    """
+    def __init__(self, storage: ChatStorage, max_chats: int = 1000, max_messages: int = 100, flush_interval: float = 5.0, session_debounce: float = 60.0):
+        """
+        Parameters
+        ----------
+        storage : ChatStorage
+            the storage the changes are flushed to
+        max_chats : int
+            maximum number of chats kept in memory
+        max_messages : int
+            number of most recent messages kept in memory per chat
+        flush_interval : float
+            seconds between two flushes
+        session_debounce : float
+            minimum number of seconds between two writes of the last access of a chat
+        """
+        self.storage = storage
+        self.max_chats = max_chats
+        self.max_messages = max_messages
+        self.flush_interval = flush_interval
+        self.session_debounce = session_debounce
+        self.default = storage.get_chat("DEFAULT")
+        self._chats = OrderedDict()  # chat_id -> ChatEntry, in LRU order
+        self._sessions = {}  # chat_id -> [config, last access, last written access, dirty]
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run_, name="ChatCacheFlusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush, final=True)
+
+    def _run_(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _install_(self, user_id: str, chat: list[dict]) -> ChatEntry:
+        """Cache the messages read from the database (a concurrent load of the same chat keeps the first entry)."""
+        with self._lock:
+            if user_id not in self._chats:
+                messages = chat[len(self.default):]
+                self._chats[user_id] = ChatEntry(messages, complete=len(messages) < self.max_messages)
+            self._chats.move_to_end(user_id)
+            return self._chats[user_id]
+
+    def _read_(self, entry: ChatEntry, last_n: int | None) -> list[dict] | None:
+        with self._lock:
+            if last_n is not None and (last_n <= len(entry.messages) or entry.complete):
+                return self.default + entry.messages[-last_n:] if last_n > 0 else list(self.default)
+            if entry.complete:
+                return self.default + entry.messages
+            return None
+
+    def get_chat(self, user_id: str, last_n: int | None = None) -> list[dict]:
+        """Return the default chat incipit followed by the messages (optionally, only the last 'last_n') of the chat."""
+        if user_id == "DEFAULT":
+            return list(self.default)
+        with self._lock:
+            entry = self._chats.get(user_id)
+            if entry is not None:
+                self._chats.move_to_end(user_id)
+        if entry is None:
+            entry = self._install_(user_id, self.storage.get_chat(user_id, last_n=self.max_messages))
+        chat = self._read_(entry, last_n)
+        if chat is None:
+            # Older messages than the cached ones are needed: read them from the database, once pending changes are written
+            self.flush(user_id)
+            chat = self.storage.get_chat(user_id, last_n=last_n)
+        return chat
+
+    def append_chat(self, user_id: str, messages: list[dict]):
+        """Append messages to the chat, they will be written at the next flush."""
+        with self._lock:
+            entry = self._chats.get(user_id)
+            if entry is None:
+                # No need to read the chat to append to it: the entry only knows the new messages
+                entry = self._chats[user_id] = ChatEntry([], complete=False)
+            self._chats.move_to_end(user_id)
+            entry.messages.extend(messages)
+            if len(entry.messages) > self.max_messages:
+                del entry.messages[:-self.max_messages]
+                entry.complete = False
+            entry.pending.extend(messages)
+
+    def restart_chat(self, user_id: str):
+        """Erase the chat history, the database will be updated at the next flush."""
+        with self._lock:
+            entry = self._chats[user_id] = ChatEntry([], complete=True)
+            self._chats.move_to_end(user_id)
+            entry.restarted = True
+
+    def update_session(self, user_id: str, config: str):
+        """Record the last access of the chat, written at the next flush if the last write is older than 'session_debounce'."""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.setdefault(user_id, [config, now, 0.0, False])
+            if session[0] != config or now - session[2] >= self.session_debounce:
+                session[3] = True
+            session[0], session[1] = config, now
+
+    async def aget_chat(self, user_id: str, last_n: int | None = None) -> list[dict]:
+        if user_id == "DEFAULT":
+            return list(self.default)
+        with self._lock:
+            entry = self._chats.get(user_id)
+            if entry is not None:
+                self._chats.move_to_end(user_id)
+        if entry is None:
+            entry = self._install_(user_id, await self.storage.aget_chat(user_id, last_n=self.max_messages))
+        chat = self._read_(entry, last_n)
+        if chat is None:
+            await asyncio.to_thread(self.flush, user_id)
+            chat = await self.storage.aget_chat(user_id, last_n=last_n)
+        return chat
+
+    async def aappend_chat(self, user_id: str, messages: list[dict]):
+        self.append_chat(user_id, messages)
+
+    async def arestart_chat(self, user_id: str):
+        self.restart_chat(user_id)
+
+    async def aupdate_session(self, user_id: str, config: str):
+        self.update_session(user_id, config)
+
+    async def aget_chat_page(self, user_id: str, page: int = 1, page_size: int = 20) -> tuple[list[dict], int]:
+        """Return a page of the chat history (read from the database, once the pending changes of the chat are written)."""
+        await asyncio.to_thread(self.flush, user_id)
+        return await self.storage.aget_chat_page(user_id, page=page, page_size=page_size)
+
+    async def aget_all_chat_ids(self, recent=False) -> list[str]:
+        """Return the chat ids from the database, once the pending session updates are written."""
+        await asyncio.to_thread(self.flush)
+        return await self.storage.aget_all_chat_ids(recent=recent)
+
+    async def aiter_chat_ids(self, recent=False, page_size: int = 500):
+        """Yield the chat ids from the database page by page, once the pending session updates are written."""
+        await asyncio.to_thread(self.flush)
+        async for chat_id in self.storage.aiter_chat_ids(recent=recent, page_size=page_size):
+            yield chat_id
+
+    @staticmethod
+    def _unwritten_(session: list) -> bool:
+        """Whether the last access of a session is not in the database yet (debounced accesses included)."""
+        return session[3] or session[1] > session[2]
+
+    def _due_(self, session: list, now: float, final: bool) -> bool:
+        """Whether a session is to be written: it is dirty, or its last access was held back and the debounce expired (or it is the final flush)."""
+        return session[3] or (session[1] > session[2] and (final or now - session[2] >= self.session_debounce))
+
+    def flush(self, user_id: str | None = None, final: bool = False):
+        """Write the dirty chats (or only 'user_id') and sessions to the database in a single transaction.
+
+        With 'final' (on close), the session accesses held back by the debounce are all written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                ids = [user_id] if user_id is not None else list(self._chats)
+                restarts, appends, changes = [], [], []
+                for chat_id in ids:
+                    entry = self._chats.get(chat_id)
+                    if entry is None or not entry.dirty:
+                        continue
+                    changes.append((entry, entry.restarted, entry.pending))
+                    if entry.restarted:
+                        restarts.append(chat_id)
+                    if entry.pending:
+                        appends.append((chat_id, entry.pending))
+                    entry.restarted, entry.pending = False, []
+                now = time.time()
+                sessions = [(chat_id, session[0], session[1]) for chat_id, session in self._sessions.items()
+                            if self._due_(session, now, final) and (user_id is None or chat_id == user_id)]
+                for chat_id, _, _ in sessions:
+                    self._sessions[chat_id][3] = False
+            if not (restarts or appends or sessions):
+                return
+            try:
+                self.storage.write_batch(restarts=restarts, appends=appends, sessions=sessions)
+            except Exception as e:
+                logging.error(f"chat cache flush failed, retrying at the next one: {e}")
+                with self._lock:
+                    for entry, restarted, pending in changes:
+                        entry.restarted = entry.restarted or restarted
+                        entry.pending = pending + entry.pending
+                    for chat_id, _, _ in sessions:
+                        self._sessions[chat_id][3] = True
+                return
+            with self._lock:
+                for chat_id, _, last_access in sessions:
+                    self._sessions[chat_id][2] = last_access
+                self._evict_()
+
+    def _evict_(self):
+        """Drop the least recently used clean chats beyond 'max_chats' (dirty ones are kept until they are flushed).
+
+        Sessions are dropped with their chat, and beyond 'max_chats' sessions also those of chats never cached (e.g., that
+        only triggered actions), unless their last access is still to be written.
+        """
+        excess = len(self._chats) - self.max_chats
+        for chat_id in list(self._chats):
+            if excess <= 0:
+                break
+            if not self._chats[chat_id].dirty:
+                del self._chats[chat_id]
+                if chat_id in self._sessions and not self._unwritten_(self._sessions[chat_id]):
+                    del self._sessions[chat_id]
+                excess -= 1
+        if len(self._sessions) > self.max_chats:
+            for chat_id in [chat_id for chat_id, session in self._sessions.items() if chat_id not in self._chats and not self._unwritten_(session)]:
+                del self._sessions[chat_id]
+
+    def close(self):
+        """Stop the background flushes and write all the pending changes."""
+        self._stop.set()
+        self._thread.join()
+        self.flush(final=True)
+        atexit.unregister(self.flush)
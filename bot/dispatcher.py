@@ -0,0 +1,247 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+from telegram.error import Forbidden, BadRequest, RetryAfter, TelegramError
+
+from bot.botutils import check_length, split_text
+from bot.broadcast import TokenBucket
+
+
+class OutboundJob:
+    """A pending Telegram call: a message, an edit of a message, or a chat action."""
+    def __init__(self, kind: str, chat_id, text: str | None = None, message=None, kwargs: dict | None = None):
+        self.kind = kind  # 'message', 'edit' or 'typing'
+        self.chat_id = chat_id
+        self.text = text
+        self.message = message
+        self.kwargs = kwargs or {}
+        self.future = asyncio.get_running_loop().create_future()
+        # Failures are logged by the dispatcher: don't warn about futures nobody awaits
+        self.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.enqueued_at = time.monotonic()
+
+
+class ChatQueue:
+    """Pending jobs of a chat, sent in FIFO order by a single task."""
+    def __init__(self):
+        self.jobs = deque()
+        self.task = None
+
+
+class OutboundDispatcher:
+    """
+    Central outbound queue of the bot: handlers enqueue their messages and return immediately, the dispatcher sends them.
+
+    Each chat has its own FIFO queue, drained by one task at a time, so the messages of a chat are delivered in the order
+    they were enqueued while different chats are served concurrently (at most 'max_concurrency' calls in flight). Every
+    call takes a token from the global TokenBucket ('rate' per second, shared with the broadcasts) and from the bucket of
+    its chat ('per_chat_rate' per second, bursts of 'per_chat_burst'). The chat buckets outlive the queues, which only
+    exist while a chat has pending jobs, and are dropped once they are full again (idle).
+    RetryAfter pauses the bucket of the chat for the requested time and the call is retried; when GLOBAL_THROTTLE_CHATS
+    chats are throttled within GLOBAL_THROTTLE_WINDOW seconds, the limit is the global one and the global bucket is paused
+    as well. Network errors are retried with exponential backoff; other errors (e.g., the user blocked the bot) fail the
+    job right away. Texts longer than 'max_len' are split once, into CHUNK_LEN chunks.
+    Bursty calls are coalesced: a pending edit of a message is replaced by a newer one, and a 'typing' action is dropped
+    if one is pending or still shown in the chat.
+
+    Attributes
+    ----------
+    bot : telegram.Bot | None
+        the bot sending the messages (set by 'start')
+    bucket : TokenBucket
+        the global rate limiter
+    max_len : int
+        maximum message length in characters
+    retries : int
+        number of retries of a failed call
+    typing_interval : float
+        seconds a 'typing' action stays visible in a chat
+    """
+    LATENCY_WINDOW = 1000
+    GLOBAL_THROTTLE_CHATS = 3
+    GLOBAL_THROTTLE_WINDOW = 1.0  # seconds
+
+    def __init__(self, bot=None, rate: float = 25.0, per_chat_rate: float = 1.0, per_chat_burst: float = 3.0, max_concurrency: int = 32,
+                 max_len: int = 4096, retries: int = 3, typing_interval: float = 4.5):
+        """
+        Parameters
+        ----------
+        bot : telegram.Bot | None
+            the bot sending the messages, can be set later by 'start'
+        rate : float
+            maximum number of calls per second, overall
+        per_chat_rate : float
+            maximum number of calls per second to the same chat
+        per_chat_burst : float
+            maximum number of calls sent to the same chat in a burst
+        max_concurrency : int
+            maximum number of calls in flight
+        max_len : int
+            maximum message length in characters
+        retries : int
+            number of retries of a failed call
+        typing_interval : float
+            seconds a 'typing' action stays visible in a chat
+        """
+        self.bot = bot
+        self.bucket = TokenBucket(rate=rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_len = max_len
+        self.retries = retries
+        self.typing_interval = typing_interval
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._chats: dict = {}  # chat_id -> ChatQueue, only while the chat has pending jobs
+        self._buckets: dict = {}  # chat_id -> TokenBucket, until the bucket is idle
+        self._swept = time.monotonic()
+        self._throttled: dict = {}  # chat_id -> monotonic time of its last RetryAfter, within GLOBAL_THROTTLE_WINDOW
+        self._typing: dict = {}  # chat_id -> monotonic time of the last 'typing' action, cleared by the next message
+        self._latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+
+    def start(self, bot):
+        self.bot = bot
+
+    def _bucket_(self, chat_id) -> TokenBucket:
+        """The rate limiter of a chat. Idle buckets are swept at most once per refill time: dropping them changes nothing."""
+        now = time.monotonic()
+        if now - self._swept >= self.per_chat_burst / self.per_chat_rate:
+            self._buckets = {key: bucket for key, bucket in self._buckets.items() if not bucket.idle()}
+            self._swept = now
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(rate=self.per_chat_rate, capacity=self.per_chat_burst)
+        return bucket
+
+    def _throttle_(self, chat_id, seconds: float):
+        """Pause the chat after a RetryAfter, and every chat if several were throttled at the same time."""
+        now = time.monotonic()
+        self._bucket_(chat_id).pause(seconds)
+        self._throttled = {key: at for key, at in self._throttled.items() if now - at < self.GLOBAL_THROTTLE_WINDOW}
+        self._throttled[chat_id] = now
+        if len(self._throttled) >= self.GLOBAL_THROTTLE_CHATS:
+            logging.warning(f"{len(self._throttled)} chats throttled within {self.GLOBAL_THROTTLE_WINDOW}s: pausing every chat for {seconds} seconds")
+            self.bucket.pause(seconds)
+
+    def _enqueue_(self, job: OutboundJob) -> asyncio.Future:
+        chat = self._chats.get(job.chat_id)
+        if chat is None:
+            chat = self._chats[job.chat_id] = ChatQueue()
+        chat.jobs.append(job)
+        if chat.task is None:
+            chat.task = asyncio.create_task(self._drain_(job.chat_id, chat))
+        return job.future
+
+    def send(self, chat_id, text: str, **kwargs) -> asyncio.Future:
+        """Enqueue a message (split in chunks if longer than 'max_len'), return a future of the last sent Message.
+
+        Keyword arguments (e.g. reply_markup) are passed to send_message, with the last chunk.
+        """
+        chunks = split_text(text) if check_length(text, self.max_len) else [text]
+        for chunk in chunks[:-1]:
+            self._enqueue_(OutboundJob("message", chat_id, text=chunk))
+        return self._enqueue_(OutboundJob("message", chat_id, text=chunks[-1], kwargs=kwargs))
+
+    def edit(self, message, text: str) -> asyncio.Future:
+        """Enqueue an edit of 'message', replacing the text of an edit of the same message still pending."""
+        chat = self._chats.get(message.chat_id)
+        if chat is not None:
+            # The first job may already be in flight: only the ones behind it can be updated
+            for job in list(chat.jobs)[1:]:
+                if job.kind == "edit" and job.message.message_id == message.message_id:
+                    job.text = text[:self.max_len]
+                    self.coalesced += 1
+                    return job.future
+        return self._enqueue_(OutboundJob("edit", message.chat_id, text=text[:self.max_len], message=message))
+
+    def typing(self, chat_id):
+        """Enqueue a 'typing' action, unless one is pending or still shown in the chat."""
+        if len(self._typing) > self.LATENCY_WINDOW:
+            now = time.monotonic()
+            self._typing = {key: sent for key, sent in self._typing.items() if now - sent < self.typing_interval}
+        chat = self._chats.get(chat_id)
+        last = self._typing.get(chat_id)
+        if (chat is not None and any(job.kind == "typing" for job in chat.jobs)) or (last is not None and time.monotonic() - last < self.typing_interval):
+            self.coalesced += 1
+            return
+        self._enqueue_(OutboundJob("typing", chat_id))
+
+    async def _call_(self, job: OutboundJob):
+        if job.kind == "message":
+            return await self.bot.send_message(chat_id=job.chat_id, text=job.text, **job.kwargs)
+        if job.kind == "edit":
+            return await job.message.edit_text(job.text)
+        return await self.bot.send_chat_action(chat_id=job.chat_id, action="typing")
+
+    async def _drain_(self, chat_id, chat: ChatQueue):
+        """Send the jobs of a chat one at a time, in FIFO order, until its queue is empty."""
+        while chat.jobs:
+            job = chat.jobs[0]
+            try:
+                result = await self._send_(job)
+                if not job.future.done():
+                    job.future.set_result(result)
+            except Exception as e:
+                self.failed += 1
+                logging.warning(f"{job.kind} to {chat_id} failed: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            chat.jobs.popleft()
+        del self._chats[chat_id]
+
+    async def _send_(self, job: OutboundJob):
+        for attempt in range(self.retries + 1):
+            await self._bucket_(job.chat_id).acquire()
+            await self.bucket.acquire()
+            try:
+                async with self._semaphore:
+                    result = await self._call_(job)
+                self.sent += 1
+                self._latencies.append(time.monotonic() - job.enqueued_at)
+                if job.kind == "typing":
+                    self._typing[job.chat_id] = time.monotonic()
+                else:
+                    # A new message clears the 'typing' action shown in the chat
+                    self._typing.pop(job.chat_id, None)
+                return result
+            except RetryAfter as e:
+                logging.warning(f"{job.kind} to {job.chat_id} throttled for {e.retry_after} seconds")
+                self._throttle_(job.chat_id, float(e.retry_after))
+            except (Forbidden, BadRequest):
+                # e.g., the user blocked the bot or the message is not modified: retrying won't help
+                raise
+            except TelegramError as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning(f"{job.kind} to {job.chat_id} failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            self.retried += 1
+        raise TelegramError(f"{job.kind} to {job.chat_id} still throttled after {self.retries} retries")
+
+    async def join(self, timeout: float | None = None):
+        """Wait until every pending job is sent (or 'timeout' seconds have passed), e.g. before shutdown."""
+        tasks = [chat.task for chat in self._chats.values()]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            if pending:
+                logging.warning(f"{self.depth()} outbound jobs not sent before shutdown")
+
+    def depth(self) -> int:
+        """Number of jobs waiting to be sent."""
+        return sum(len(chat.jobs) for chat in self._chats.values())
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {"queue_depth": self.depth(),
+                "active_chats": len(self._chats),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "coalesced": self.coalesced,
+                "latency_p50": latencies[len(latencies) // 2] if latencies else None,
+                "latency_p95": latencies[int(0.95 * (len(latencies) - 1))] if latencies else None}
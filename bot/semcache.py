@@ -0,0 +1,181 @@
+import time
+import queue
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from scripts.embedder.index import l2_normalize
+
+
+class SemanticAnswerCache:
+    """
+    Cache of LLM answers, looked up by semantic similarity of the question.
+
+    Question embeddings are kept as rows of a preallocated, L2-normalized float32 matrix, so a lookup is a single
+    matrix-vector product. An answer is served when the similarity between the incoming question and a cached one is at
+    least 'threshold'. Entries expire after 'ttl' seconds and the least recently used entry is evicted when the cache holds
+    'max_entries' answers. Optionally, entries are persisted to SQLite and reloaded on restart: lookups and insertions only
+    touch memory, while the database writes are queued to a background writer thread that commits them in batches, so the
+    event loop never waits on SQLite.
+
+    Attributes
+    ----------
+    threshold : float
+        minimum cosine similarity between questions to serve a cached answer
+    max_entries : int
+        maximum number of cached answers
+    ttl : float
+        time to live of a cached answer, in seconds
+    db_path : str | None
+        path of the SQLite database used for persistence (None to keep the cache in memory only)
+    hits : int
+        number of lookups that returned an answer
+    misses : int
+        number of lookups that did not return an answer
+    """
+    def __init__(self, threshold: float = 0.92, max_entries: int = 10000, ttl: float = 24 * 3600, db_path: str | None = None):
+        """
+        Parameters
+        ----------
+        threshold : float
+            minimum cosine similarity between questions to serve a cached answer
+        max_entries : int
+            maximum number of cached answers
+        ttl : float
+            time to live of a cached answer, in seconds
+        db_path : str | None
+            path of the SQLite database used for persistence (None to keep the cache in memory only)
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self._matrix = None  # (max_entries, dim), allocated at the first insertion
+        self._entries = OrderedDict()  # slot -> (question, answer, created_at), in LRU order
+        self._slots = {}  # question -> slot
+        self._free = list(range(max_entries - 1, -1, -1))
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes = queue.Queue()  # (statement, parameters), executed in order by the writer thread
+        self._writer = None
+        if db_path is not None:
+            # Used by _load_ here, then only by the writer thread
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL;")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS answer_cache
+                                  (
+                                      question   TEXT
+                                          constraint answer_cache_pk
+                                              primary key,
+                                      answer     TEXT,
+                                      embedding  BLOB,
+                                      created_at REAL
+                                  );""")
+            self._load_()
+            self._writer = threading.Thread(target=self._write_, name="SemanticAnswerCacheWriter", daemon=True)
+            self._writer.start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load_(self):
+        rows = self._conn.execute("SELECT question, answer, embedding, created_at FROM answer_cache WHERE created_at > ? ORDER BY created_at DESC LIMIT ?;",
+                                  (time.time() - self.ttl, self.max_entries)).fetchall()
+        for question, answer, embedding, created_at in reversed(rows):
+            self._insert_(np.frombuffer(embedding, dtype=np.float32), question, answer, created_at)
+        logging.info(f"{len(rows)} cached answers loaded from {self.db_path}")
+
+    def _write_(self):
+        """Writer thread loop: drain the queued statements, execute them in order and commit once per drained batch."""
+        stop = False
+        while not stop:
+            batch = [self._writes.get()]
+            while True:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for write in batch:
+                    if write is None:
+                        stop = True
+                        continue
+                    self._conn.execute(*write)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"answer cache writes lost: {e}")
+                self._conn.rollback()
+
+    def _persist_(self, statement: str, parameters: tuple):
+        if self._writer is not None:
+            self._writes.put((statement, parameters))
+
+    def _insert_(self, embedding: np.ndarray, question: str, answer: str, created_at: float):
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_entries, len(embedding)), dtype=np.float32)
+        if question in self._slots:
+            self._evict_(self._slots[question], persisted=False)
+        if not self._free:
+            self._evict_(next(iter(self._entries)))
+        slot = self._free.pop()
+        self._matrix[slot] = l2_normalize(embedding)
+        self._entries[slot] = (question, answer, created_at)
+        self._slots[question] = slot
+
+    def _evict_(self, slot: int, persisted: bool = True):
+        question, _, _ = self._entries.pop(slot)
+        del self._slots[question]
+        self._matrix[slot] = 0
+        self._free.append(slot)
+        if persisted:
+            self._persist_("DELETE FROM answer_cache WHERE question = ?;", (question,))
+
+    def lookup(self, embedding) -> str | None:
+        """Return the cached answer to the most similar question, if similar enough and not expired (None otherwise)."""
+        with self._lock:
+            if self._entries:
+                scores = self._matrix @ l2_normalize(np.ravel(embedding))
+                # Expired entries are evicted on the way: the best one still valid is served
+                candidates = np.flatnonzero(scores >= self.threshold)
+                for slot in candidates[np.argsort(-scores[candidates], kind="stable")].tolist():
+                    if slot not in self._entries:
+                        continue
+                    question, answer, created_at = self._entries[slot]
+                    if time.time() - created_at > self.ttl:
+                        self._evict_(slot)
+                        continue
+                    self._entries.move_to_end(slot)
+                    self.hits += 1
+                    logging.info(f"Cached answer served! Question: {question}, Similarity: {round(float(scores[slot]), 2)}")
+                    return answer
+            self.misses += 1
+            return None
+
+    def store(self, embedding, question: str, answer: str):
+        """Cache the answer to a question."""
+        created_at = time.time()
+        with self._lock:
+            self._insert_(np.asarray(np.ravel(embedding), dtype=np.float32), question, answer, created_at)
+            self._persist_("INSERT OR REPLACE INTO answer_cache (question, answer, embedding, created_at) VALUES (?, ?, ?, ?);",
+                           (question, answer, l2_normalize(np.ravel(embedding)).tobytes(), created_at))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0}
+
+    def close(self):
+        """Write the queued changes and close the database."""
+        if self._writer is not None and self._writer.is_alive():
+            self._writes.put(None)
+            self._writer.join()
+        if self._conn is not None:
+            self._conn.close()
@@ -1,38 +1,62 @@
 import os
+import ast
+import json
+import queue
+import asyncio
 import sqlite3
 import logging
+import threading
+from concurrent.futures import Future
 from datetime import datetime
+from typing import TYPE_CHECKING
 
-import pandas as pd
-from pandas import DataFrame
+import numpy as np
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
 
 os.chdir("/home/tommaso/Repositories/teleRAG/")
 
 
-def put_chat(user_id: str, chat_updated: list[dict]):
-    """Update chat history with user id. Create new if user not in database."""
-    conn = sqlite3.connect('data/chats.db')
-    cursor = conn.cursor()
-    try:
-        cursor.execute("INSERT OR REPLACE INTO history (id, template) VALUES (?, ?);", (user_id, str(chat_updated)))
-        conn.commit()
-    except sqlite3.Error as e:
-        logging.error(e)
-    finally:
-        conn.close()
+EMBEDDING_DTYPE = np.dtype("<f4")
+
+
+def embedding_to_blob(embedding) -> bytes:
+    """Serialize an embedding as a little-endian float32 BLOB."""
+    return np.asarray(embedding, dtype=EMBEDDING_DTYPE).tobytes()
+
 
+def blob_to_embedding(blob) -> np.ndarray:
+    """Deserialize an embedding BLOB (zero-copy, read-only view). Legacy TEXT embeddings are parsed as JSON lists."""
+    if isinstance(blob, str):
+        return np.asarray(json.loads(blob), dtype=EMBEDDING_DTYPE)
+    return np.frombuffer(blob, dtype=EMBEDDING_DTYPE)
 
-def retrieve_actions() -> DataFrame | None:
-    """Return all action as DataFrame (or None if no actions)."""
+
+def embeddings_matrix(blobs: list) -> np.ndarray:
+    """Stack embedding BLOBs into a single contiguous (n, dim) float32 matrix."""
+    if all(isinstance(blob, bytes) for blob in blobs):
+        return np.frombuffer(b"".join(blobs), dtype=EMBEDDING_DTYPE).reshape(len(blobs), -1)
+    logging.warning("Legacy TEXT embeddings found, run pipelines/migrate_embeddings.py to convert them to float32 BLOBs.")
+    return np.stack([blob_to_embedding(blob) for blob in blobs])
+
+
+def retrieve_actions() -> dict | None:
+    """Return all the actions (or None if no actions) as a dict of columns: 'id' (int64 array), 'name' and 'description' (lists) and 'embedding', a single contiguous (n, dim) float32 matrix.
+
+    Plain sqlite3 and numpy: the bot reads the actions at startup, before polling, without importing pandas.
+    """
     conn = sqlite3.connect('data/actions.db')
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT a.action_id, a.action_name, e.embedding FROM actions a, embeddings e WHERE a.action_id = e.id;")
+        cursor.execute("SELECT a.action_id, a.action_name, a.description, e.embedding FROM actions a, embeddings e WHERE a.action_id = e.id;")
         result = cursor.fetchall()
         if result:
-            df = pd.DataFrame(data=result, columns=['id', 'name', 'embedding'])
-            df["embedding"] = df["embedding"].apply(eval)
-            return df
+            ids, names, descriptions, blobs = zip(*result)
+            return {"id": np.asarray(ids, dtype=np.int64),
+                    "name": list(names),
+                    "description": [description or "" for description in descriptions],
+                    "embedding": embeddings_matrix(list(blobs))}
         else:
             return None
     except sqlite3.Error as e:
@@ -40,54 +64,398 @@ def retrieve_actions() -> DataFrame | None:
     finally:
         conn.close()
 
-def get_all_chat_ids(recent=False) -> list[str]:
-    """Return a list of all the ids memorized into the database. Optionally, filter only those who interacted with the bot recently."""
-    conn = sqlite3.connect('data/chats.db')
-    cursor = conn.cursor()
+
+def retrieve_action_descriptions() -> "DataFrame | None":
+    """Return id and description of all the actions as DataFrame (or None if no actions)."""
+    # Imported on first use: the bot itself doesn't need pandas
+    import pandas as pd
+    conn = sqlite3.connect('data/actions.db')
     try:
-        if recent:
-            cursor.execute("""SELECT h.id FROM history h, session s 
-                              WHERE h.id!='DEFAULT' 
-                              AND s.last_access > DATETIME('now', '-30 day') 
-                              AND h.id = s.id;""")
-            result = cursor.fetchone()
-        else:
-            cursor.execute("SELECT h.id FROM history h, session s WHERE h.id!='DEFAULT'")
-            result = cursor.fetchall()
-        return result
-    except sqlite3.Error as e:
+        df = pd.read_sql_query("SELECT action_id AS id, description FROM actions;", conn)
+        return df if len(df) > 0 else None
+    except (sqlite3.Error, pd.errors.DatabaseError) as e:
         logging.error(e)
     finally:
         conn.close()
 
-def get_chat(user_id: str) -> list[dict]:
-    """Return chat history with user. Is no history, default chat incipit is created and returned."""
-    conn = sqlite3.connect('data/chats.db')
+
+def put_action_embeddings(action_ids: list[int], embeddings):
+    """Store action embeddings as float32 BLOBs, replacing the existing ones."""
+    conn = sqlite3.connect('data/actions.db')
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT template FROM history WHERE id = ?;", (user_id,))
-        result = cursor.fetchone()
-        if result:
-            return eval(result[0])
-        else:
-            logging.warning("Chat with user {} not found. Creating a new one.".format(user_id))
-            default_template = get_chat("DEFAULT")
-            put_chat(user_id, default_template)
-            return default_template
+        cursor.executemany("INSERT OR REPLACE INTO embeddings (id, embedding) VALUES (?, ?);",
+                           [(int(action_id), embedding_to_blob(embedding)) for action_id, embedding in zip(action_ids, embeddings)])
+        conn.commit()
     except sqlite3.Error as e:
         logging.error(e)
     finally:
         conn.close()
 
 
+class ChatStorage:
+    """
+    Long-lived access layer to the chat database.
+
+    A single connection is owned by a dedicated DB thread, so the event loop never blocks on SQLite: every operation is queued
+    and returns a Future, that synchronous callers can wait on and handlers can await. The connection runs in WAL mode,
+    so readers don't block the writer, and keeps its statements prepared in the connection statement cache.
+    Jobs queued while the thread is busy are executed back to back and committed together (group commit), each in its own
+    savepoint: the writes of a job that raises are rolled back, those of the other jobs are committed.
+
+    Conversations are stored as an append-only log of messages, one row per message keyed by (chat_id, seq): a new turn
+    is an O(1) append, the last N messages are a ranged read and restarting a chat is a ranged delete. The DEFAULT
+    template is stored once under the 'DEFAULT' chat id and prepended to every chat when it is read.
+    A legacy 'history' table is migrated to the log the first time the database is opened.
+
+    Attributes
+    ----------
+    db_path : str
+        path of the SQLite database with the 'messages' and 'session' tables
+    """
+    PRAGMAS = ("PRAGMA journal_mode=WAL;",
+               "PRAGMA synchronous=NORMAL;",
+               "PRAGMA busy_timeout=5000;",
+               "PRAGMA temp_store=MEMORY;",
+               "PRAGMA cache_size=-16000;")
+
+    def __init__(self, db_path: str = 'data/chats.db'):
+        """
+        Parameters
+        ----------
+        db_path : str
+            path of the SQLite database with the 'messages' and 'session' tables
+        """
+        self.db_path = db_path
+        self._default = None  # DEFAULT template, read once from the DB thread
+        self._jobs = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()  # no job can be queued behind the stop sentinel
+        self._thread = threading.Thread(target=self._run_, name="ChatStorage", daemon=True)
+        self._thread.start()
+
+    def _connect_(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, cached_statements=256)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        self._create_tables_(conn)
+        return conn
+
+    def _run_(self):
+        """DB thread loop: drain the job queue, run the jobs on the shared connection and commit once per drained batch."""
+        conn = self._connect_()
+        stop = False
+        while not stop:
+            batch = [self._jobs.get()]
+            while True:
+                try:
+                    batch.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            done = []
+            if not conn.in_transaction:
+                # Opened explicitly: releasing the savepoint of the first job must not commit it on its own
+                conn.execute("BEGIN;")
+            for job in batch:
+                if job is None:
+                    stop = True
+                    continue
+                function, args, future = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT job;")
+                try:
+                    result = function(conn, *args)
+                    conn.execute("RELEASE job;")
+                    done.append((future, result, None))
+                except Exception as e:
+                    # A failed job leaves no rows behind, so that its caller can retry it as it was
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK TO job;")
+                        conn.execute("RELEASE job;")
+                    else:
+                        # SQLite rolled back the whole transaction (e.g., disk full): the jobs before are lost as well
+                        done = [(other, None, error or e) for other, _, error in done]
+                        conn.execute("BEGIN;")
+                    done.append((future, None, e))
+            try:
+                conn.commit()
+            except sqlite3.Error as e:
+                logging.error(e)
+                conn.rollback()
+                done = [(other, None, error or e) for other, _, error in done]
+            for future, result, error in done:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        conn.close()
+
+    def submit(self, function, *args) -> Future:
+        """Queue 'function(connection, *args)' for execution on the DB thread. Raise RuntimeError once the storage is closed."""
+        future = Future()
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError("ChatStorage is closed")
+            self._jobs.put((function, args, future))
+        return future
+
+    def close(self):
+        """Commit pending jobs and close the connection. Later jobs are refused (see 'submit')."""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._jobs.put(None)
+        self._thread.join()
+
+    def _create_tables_(self, conn: sqlite3.Connection):
+        conn.execute("""CREATE TABLE IF NOT EXISTS messages
+                        (
+                            chat_id TEXT    NOT NULL,
+                            seq     INTEGER NOT NULL,
+                            role    TEXT,
+                            content TEXT,
+                            constraint messages_pk
+                                primary key (chat_id, seq)
+                        ) WITHOUT ROWID;""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS session
+                        (
+                            id          TEXT
+                                constraint session_pk
+                                    primary key,
+                            config      TEXT,
+                            last_access TEXT
+                        );""")
+        conn.commit()
+        if conn.execute("SELECT 1 FROM messages LIMIT 1;").fetchone() is None:
+            self._migrate_history_(conn)
+
+    def _migrate_history_(self, conn: sqlite3.Connection):
+        """Convert the legacy 'history' table (one stringified template per chat) to the 'messages' log.
+
+        The DEFAULT template is stored under the 'DEFAULT' chat id, every other chat only stores the messages following it.
+        The legacy table is left untouched.
+        """
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='history';").fetchone() is None:
+            return
+        templates = {chat_id: ast.literal_eval(template) for chat_id, template in conn.execute("SELECT id, template FROM history;")}
+        default = templates.get("DEFAULT", [])
+        with conn:
+            for chat_id, template in templates.items():
+                if chat_id != "DEFAULT" and template[:len(default)] == default:
+                    template = template[len(default):]
+                conn.executemany("INSERT INTO messages (chat_id, seq, role, content) VALUES (?, ?, ?, ?);",
+                                 [(chat_id, seq, message["role"], message["content"]) for seq, message in enumerate(template, start=1)])
+        logging.info(f"{len(templates)} chats migrated from the 'history' table to the 'messages' log")
+
+    def _default_template_(self, conn: sqlite3.Connection) -> list[dict]:
+        if self._default is None:
+            self._default = self._messages_(conn, "DEFAULT")
+        return list(self._default)
+
+    @staticmethod
+    def _messages_(conn: sqlite3.Connection, chat_id: str, last_n: int | None = None) -> list[dict]:
+        if last_n is None:
+            rows = conn.execute("SELECT role, content FROM messages WHERE chat_id = ? ORDER BY seq;", (chat_id,)).fetchall()
+        else:
+            rows = conn.execute("SELECT role, content FROM messages WHERE chat_id = ? ORDER BY seq DESC LIMIT ?;", (chat_id, last_n)).fetchall()[::-1]
+        return [{"role": role, "content": content} for role, content in rows]
+
+    @staticmethod
+    def _last_seq_(conn: sqlite3.Connection, chat_id: str) -> int:
+        return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM messages WHERE chat_id = ?;", (chat_id,)).fetchone()[0]
+
+    def _append_chat_(self, conn: sqlite3.Connection, user_id: str, messages: list[dict]):
+        try:
+            last_seq = self._last_seq_(conn, user_id)
+            conn.executemany("INSERT INTO messages (chat_id, seq, role, content) VALUES (?, ?, ?, ?);",
+                             [(user_id, seq, message["role"], message["content"]) for seq, message in enumerate(messages, start=last_seq + 1)])
+        except sqlite3.Error as e:
+            logging.error(e)
+
+    def _restart_chat_(self, conn: sqlite3.Connection, user_id: str):
+        try:
+            conn.execute("DELETE FROM messages WHERE chat_id = ?;", (user_id,))
+            if user_id == "DEFAULT":
+                self._default = None
+        except sqlite3.Error as e:
+            logging.error(e)
+
+    def _put_chat_(self, conn: sqlite3.Connection, user_id: str, chat_updated: list[dict]):
+        default = self._default_template_(conn) if user_id != "DEFAULT" else []
+        if chat_updated[:len(default)] == default:
+            chat_updated = chat_updated[len(default):]
+        self._restart_chat_(conn, user_id)
+        self._append_chat_(conn, user_id, chat_updated)
+
+    def _get_chat_(self, conn: sqlite3.Connection, user_id: str, last_n: int | None = None) -> list[dict]:
+        try:
+            default = self._default_template_(conn)
+            if user_id == "DEFAULT":
+                return default
+            return default + self._messages_(conn, user_id, last_n)
+        except sqlite3.Error as e:
+            logging.error(e)
+
+    def _get_chat_page_(self, conn: sqlite3.Connection, user_id: str, page: int, page_size: int) -> tuple[list[dict], int]:
+        try:
+            last_seq = self._last_seq_(conn, user_id)
+            pages = max(-(-last_seq // page_size), 1)
+            last = last_seq - (page - 1) * page_size
+            rows = conn.execute("SELECT role, content FROM messages WHERE chat_id = ? AND seq BETWEEN ? AND ? ORDER BY seq;",
+                                (user_id, last - page_size + 1, last)).fetchall()
+            return [{"role": role, "content": content} for role, content in rows], pages
+        except sqlite3.Error as e:
+            logging.error(e)
+
+    @staticmethod
+    def _get_chat_ids_page_(conn: sqlite3.Connection, recent: bool, after: str | None, page_size: int | None) -> list[str]:
+        # Keyset pagination on the primary key: each page starts after the last id of the previous one
+        query = "SELECT s.id FROM session s WHERE s.id!='DEFAULT'"
+        params = []
+        if recent:
+            query += " AND s.last_access > DATETIME('now', '-30 day')"
+        if after is not None:
+            query += " AND s.id > ?"
+            params.append(after)
+        query += " ORDER BY s.id"
+        if page_size is not None:
+            query += " LIMIT ?"
+            params.append(page_size)
+        return [chat_id for chat_id, in conn.execute(query + ";", params)]
+
+    def _get_all_chat_ids_(self, conn: sqlite3.Connection, recent: bool) -> list[str]:
+        try:
+            return self._get_chat_ids_page_(conn, recent, None, None)
+        except sqlite3.Error as e:
+            logging.error(e)
+            return []
+
+    def _get_chat_ids_(self, conn: sqlite3.Connection, recent: bool, after: str | None, page_size: int) -> list[str]:
+        try:
+            return self._get_chat_ids_page_(conn, recent, after, page_size)
+        except sqlite3.Error as e:
+            logging.error(e)
+            return []
+
+    @staticmethod
+    def _update_session_(conn: sqlite3.Connection, user_id: str, config: str):
+        try:
+            conn.execute("INSERT OR REPLACE INTO session (id, config, last_access) VALUES (?, ?, ?);", (user_id, config, datetime.now()))
+        except sqlite3.Error as e:
+            logging.error(e)
+
+    def _write_batch_(self, conn: sqlite3.Connection, restarts: list[str], appends: list[tuple[str, list[dict]]], sessions: list[tuple[str, str, float]]):
+        # Errors are raised, not logged: the caller keeps the changes and retries them
+        for user_id in restarts:
+            conn.execute("DELETE FROM messages WHERE chat_id = ?;", (user_id,))
+        for user_id, messages in appends:
+            last_seq = self._last_seq_(conn, user_id)
+            conn.executemany("INSERT INTO messages (chat_id, seq, role, content) VALUES (?, ?, ?, ?);",
+                             [(user_id, seq, message["role"], message["content"]) for seq, message in enumerate(messages, start=last_seq + 1)])
+        conn.executemany("INSERT OR REPLACE INTO session (id, config, last_access) VALUES (?, ?, ?);",
+                         [(user_id, config, datetime.fromtimestamp(last_access)) for user_id, config, last_access in sessions])
+
+    def write_batch(self, restarts: list[str] = (), appends: list[tuple[str, list[dict]]] = (), sessions: list[tuple[str, str, float]] = ()):
+        """Restart chats, append messages and update sessions (id, config, last access timestamp) in a single job."""
+        return self.submit(self._write_batch_, list(restarts), list(appends), list(sessions)).result()
+
+    def put_chat(self, user_id: str, chat_updated: list[dict]):
+        return self.submit(self._put_chat_, user_id, chat_updated).result()
+
+    def append_chat(self, user_id: str, messages: list[dict]):
+        return self.submit(self._append_chat_, user_id, messages).result()
+
+    def restart_chat(self, user_id: str):
+        return self.submit(self._restart_chat_, user_id).result()
+
+    def get_chat(self, user_id: str, last_n: int | None = None) -> list[dict]:
+        return self.submit(self._get_chat_, user_id, last_n).result()
+
+    def get_chat_page(self, user_id: str, page: int = 1, page_size: int = 20) -> tuple[list[dict], int]:
+        return self.submit(self._get_chat_page_, user_id, page, page_size).result()
+
+    def get_all_chat_ids(self, recent=False) -> list[str]:
+        return self.submit(self._get_all_chat_ids_, recent).result()
+
+    def get_chat_ids(self, recent=False, after: str | None = None, page_size: int = 500) -> list[str]:
+        return self.submit(self._get_chat_ids_, recent, after, page_size).result()
+
+    def update_session(self, user_id: str, config: str):
+        return self.submit(self._update_session_, user_id, config).result()
+
+    async def aput_chat(self, user_id: str, chat_updated: list[dict]):
+        return await asyncio.wrap_future(self.submit(self._put_chat_, user_id, chat_updated))
+
+    async def aappend_chat(self, user_id: str, messages: list[dict]):
+        return await asyncio.wrap_future(self.submit(self._append_chat_, user_id, messages))
+
+    async def arestart_chat(self, user_id: str):
+        return await asyncio.wrap_future(self.submit(self._restart_chat_, user_id))
+
+    async def aget_chat(self, user_id: str, last_n: int | None = None) -> list[dict]:
+        return await asyncio.wrap_future(self.submit(self._get_chat_, user_id, last_n))
+
+    async def aget_chat_page(self, user_id: str, page: int = 1, page_size: int = 20) -> tuple[list[dict], int]:
+        return await asyncio.wrap_future(self.submit(self._get_chat_page_, user_id, page, page_size))
+
+    async def aget_all_chat_ids(self, recent=False) -> list[str]:
+        return await asyncio.wrap_future(self.submit(self._get_all_chat_ids_, recent))
+
+    async def aupdate_session(self, user_id: str, config: str):
+        return await asyncio.wrap_future(self.submit(self._update_session_, user_id, config))
+
+    async def aget_chat_ids(self, recent=False, after: str | None = None, page_size: int = 500) -> list[str]:
+        return await asyncio.wrap_future(self.submit(self._get_chat_ids_, recent, after, page_size))
+
+    async def aiter_chat_ids(self, recent=False, page_size: int = 500):
+        """Yield the chat ids page by page, so that only 'page_size' ids are held in memory at a time."""
+        after = None
+        while page := await self.aget_chat_ids(recent=recent, after=after, page_size=page_size):
+            for chat_id in page:
+                yield chat_id
+            after = page[-1]
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> ChatStorage:
+    """Return the process-wide ChatStorage, creating it on first use."""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = ChatStorage()
+        return _storage
+
+
+def put_chat(user_id: str, chat_updated: list[dict]):
+    """Replace the chat history with user id. Create new if user not in database."""
+    get_storage().put_chat(user_id, chat_updated)
+
+
+def append_chat(user_id: str, messages: list[dict]):
+    """Append messages to the chat history with user id."""
+    get_storage().append_chat(user_id, messages)
+
+
+def restart_chat(user_id: str):
+    """Erase the chat history with user id, restarting from the default chat incipit."""
+    get_storage().restart_chat(user_id)
+
+
+def get_all_chat_ids(recent=False) -> list[str]:
+    """Return a list of all the ids memorized into the database. Optionally, filter only those who interacted with the bot recently."""
+    return get_storage().get_all_chat_ids(recent=recent)
+
+
+def get_chat(user_id: str, last_n: int | None = None) -> list[dict]:
+    """Return chat history with user, i.e. the default chat incipit followed by the messages (optionally, only the last 'last_n')."""
+    return get_storage().get_chat(user_id, last_n=last_n)
+
+
 def update_session(user_id: str, config: str):
     """Update chat history with user id. Create new if user not in database."""
-    conn = sqlite3.connect('data/chats.db')
-    cursor = conn.cursor()
-    try:
-        cursor.execute("INSERT OR REPLACE INTO session (id, config, last_access) VALUES (?, ?, ?);", (user_id, config, datetime.now()))
-        conn.commit()
-    except sqlite3.Error as e:
-        logging.error(e)
-    finally:
-        conn.close()
+    get_storage().update_session(user_id, config)
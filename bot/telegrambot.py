@@ -1,17 +1,25 @@
+import asyncio
 import logging
 import os
 import sys
-
-import pandas as pd
+import time
 
 sys.path.append("/home/tommaso/Repositories/teleRAG/")
 
-from bot.botutils import check_length, split_text, load_api_token
-from bot.sqlutils import retrieve_actions, get_chat, put_chat, update_session, get_all_chat_ids
-from scripts.embedder.embeddings import SentenceEmbedder
-from scripts.llm.LLM import LLM
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from bot.botutils import load_api_token, CHUNK_LEN
+from bot.broadcast import Broadcaster
+from bot.dispatcher import OutboundDispatcher
+from bot.chatcache import ChatCache
+from bot.sqlutils import retrieve_actions, get_storage
+from bot.semcache import SemanticAnswerCache
+from bot.workers import InferenceExecutor, keep_typing
+from scripts.embedder.index import EmbeddingIndex
+from scripts.embedder.knowledge import KnowledgeBase
+from scripts.embedder.lexical import BM25Index, fuse, tokenize
+from scripts.llm.history import HistoryWindow
+
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import filters, Application, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler
 
 os.chdir("/home/tommaso/Repositories/teleRAG/")
@@ -30,18 +38,91 @@ class TelegramBot:
 
     Attributes
     ----------
-    llm : LLM
-        the large language model that is used to generate replies
-    embedder : str
-        a small language model used for semantic search for RAG
-    actions : DataFrame
-        special routines that are triggered through semantic search
+    llm : LLM | None
+        the large language model that is used to generate replies (None until loaded)
+    embedder : SentenceEmbedder | None
+        a small language model used for semantic search for RAG (None until loaded)
+    models_ready : bool
+        whether the LLM and the embedder are loaded and warmed up; until then, messages get WARMUP_MSG
+    model_loading : asyncio.Task | None
+        the background task loading the models, started once polling is set up
+    started_at : float
+        monotonic time at which the bot was created, to report the time to the first reply after a restart
+    first_reply_at : float | None
+        monotonic time of the first reply sent after the restart
+    actions : dict
+        special routines that are triggered through semantic search (columns 'id', 'name', 'description' and 'embedding')
+    action_index : EmbeddingIndex
+        normalized embedding matrix of the actions, built once at startup and queried on every message
+    action_lexical : BM25Index
+        inverted index of the action names and descriptions, for exact keyword matches
+    action_name_tokens : dict
+        the tokens of each action name, by action id, to tell whether a message names the action
+    knowledge : KnowledgeBase | None
+        chunks of the scraped articles retrieved to ground the answers (None if the knowledge base was not built)
+    storage : ChatStorage
+        long-lived access layer to the chat database
+    chats : ChatCache
+        in-memory write-behind cache of chat histories and sessions in front of the storage, flushed periodically and on stop
+    answer_cache : SemanticAnswerCache
+        answers to the first question of fresh conversations, served again to semantically equivalent questions
+    history_window : HistoryWindow | None
+        fits the conversation history in HISTORY_TOKEN_BUDGET tokens before it is passed to the LLM
+    workers : InferenceExecutor
+        runs embedding and generation off the event loop, with bounded concurrency and per-chat ordering
+    outbox : OutboundDispatcher
+        queue of the outgoing messages, edits and chat actions: handlers enqueue them, the outbox sends them in per-chat
+        order within Telegram's rate limits
+    startup_broadcast : asyncio.Task | None
+        the broadcast of ONSTART_MSG, sent in the background while the bot already serves updates
     MAX_LEN : int
         maximum message length in characters
     API_TOKEN: str
         the api token of the telegram bot
+    HISTORY_TOKEN_BUDGET: int
+        maximum number of tokens of the prompt (history, new message and answer) passed to the LLM
+    HISTORY_MAX_MESSAGES: int
+        maximum number of past messages read from the history database for each reply
+    HISTORY_PAGE_SIZE: int
+        number of messages per page of the /history command
+    STREAM_REPLIES: bool
+        whether answers are streamed to the chat (progressively edited message) while they are generated
+    EDIT_INTERVAL: float
+        minimum number of seconds between two edits of a streamed message
+    MAX_BATCH_SIZE: int
+        maximum number of replies generated together by the LLM in a single batch
+    MAX_BATCH_WAIT_MS: int
+        maximum time (milliseconds) a reply waits for other replies to join its batch
+    EMBED_BATCH_SIZE: int
+        maximum number of incoming messages embedded together in a single batch
+    EMBED_BATCH_WAIT_MS: int
+        maximum time (milliseconds) an incoming message waits for other messages to join its embedding batch
     ACTIONS_THRESHOLD: float
         consider semantic search result only if similarity above this threshold
+    ACTIONS_MARGIN: float
+        consider semantic search result only if its similarity exceeds the runner-up by at least this margin
+    ACTIONS_LEXICAL_WEIGHT: float
+        boost added to the similarity of the action with the best lexical (BM25) match with the message
+    ACTIONS_KEYWORD_MAX_WORDS: int
+        messages up to this number of words that name a single action trigger it without semantic search
+    ANSWER_CACHE_THRESHOLD: float
+        serve a cached answer only if the question similarity is above this threshold
+    KB_PATH: str
+        directory of the knowledge base built by pipelines/knowledge_base.py
+    KB_TOP_K: int
+        maximum number of knowledge base chunks injected in the prompt
+    KB_THRESHOLD: float
+        inject a knowledge base chunk only if its similarity with the message is above this threshold
+    KB_LEXICAL_WEIGHT: float
+        boost added to the similarity of the knowledge base chunk with the best lexical (BM25) match with the message
+    BROADCAST_RATE: float
+        maximum number of broadcast messages per second (Telegram allows about 30 overall)
+    BROADCAST_CONCURRENCY: int
+        maximum number of broadcast messages in flight
+    BROADCAST_STOP_TIMEOUT: float
+        maximum number of seconds spent broadcasting ONSTOP_MSG, so that shutdown does not hang
+    OUTBOX_STOP_TIMEOUT: float
+        maximum number of seconds spent sending the messages still in the outbox at shutdown
     ONSTART_MSG: str
         the message broadcasted when the bot goes online
     ONSTOP_MSG: str
@@ -50,6 +131,12 @@ class TelegramBot:
         the greet message sent when conversation starts for the first time
     WELCOME_MSG: str
         the message sent when conversation is restarted
+    BUSY_MSG: str
+        the message sent when too many messages are already waiting for an answer
+    PLACEHOLDER_MSG: str
+        the message shown while the first tokens of a streamed answer are generated
+    WARMUP_MSG: str
+        the message sent while the models are still loading after a restart
 
     Methods
     -------
@@ -63,16 +150,102 @@ class TelegramBot:
         api_token_path : str
             path where the telegram bot API is located
         """
-        self.llm = LLM()
-        self.embedder = SentenceEmbedder()
+        self.HISTORY_TOKEN_BUDGET = 3072
+        self.HISTORY_MAX_MESSAGES = 100
+        self.HISTORY_PAGE_SIZE = 20
+        self.STREAM_REPLIES = True
+        self.EDIT_INTERVAL = 1.0  # seconds
+        self.MAX_BATCH_SIZE = 8
+        self.MAX_BATCH_WAIT_MS = 20
+        self.EMBED_BATCH_SIZE = 32
+        self.EMBED_BATCH_WAIT_MS = 5
+        self.started_at = time.monotonic()
+        self.first_reply_at = None
+        # The models are loaded in the background by post_init (see load_models), so that polling starts right away
+        self.llm = None
+        self.embedder = None
+        self.history_window = None
+        self.models_ready = False
+        self.model_loading = None
+        self.storage = get_storage()
+        self.chats = ChatCache(self.storage, max_chats=1000, max_messages=self.HISTORY_MAX_MESSAGES, flush_interval=5.0, session_debounce=60.0)
         self.actions = retrieve_actions()
+        self.action_index = EmbeddingIndex(self.actions["embedding"], ids=self.actions["id"], names=self.actions["name"])
+        self.action_lexical = BM25Index()
+        self.action_lexical.add(self.actions["id"], [f"{name} {description}" for name, description in zip(self.actions["name"], self.actions["description"])])
+        self.action_name_tokens = {action_id: frozenset(tokenize(name.replace("_", " "))) for action_id, name in zip(self.actions["id"].tolist(), self.actions["name"])}
+        self.KB_PATH = 'data/kb'
+        self.KB_TOP_K = 3
+        self.KB_THRESHOLD = 0.45
+        self.KB_LEXICAL_WEIGHT = 0.1
+        self.knowledge = KnowledgeBase(self.KB_PATH) if os.path.exists(os.path.join(self.KB_PATH, "embeddings.npy")) else None
+        if self.knowledge is None:
+            logging.warning(f"no knowledge base found in {self.KB_PATH}, answers will not be grounded")
+        # One worker per batch slot, so that concurrent chats can wait on the same LLM batch
+        self.workers = InferenceExecutor(max_workers=self.MAX_BATCH_SIZE, max_pending=64)
         self.MAX_LEN = 4096  # characters
+        self.outbox = OutboundDispatcher(max_len=self.MAX_LEN)
         self.API_TOKEN = load_api_token(api_token_path)
         self.ACTIONS_THRESHOLD = 0.6
+        self.ACTIONS_MARGIN = 0.05
+        self.ACTIONS_LEXICAL_WEIGHT = 0.1
+        self.ACTIONS_KEYWORD_MAX_WORDS = 4
+        self.ANSWER_CACHE_THRESHOLD = 0.92
+        self.BROADCAST_RATE = 25.0
+        self.BROADCAST_CONCURRENCY = 8
+        self.BROADCAST_STOP_TIMEOUT = 10.0  # seconds
+        self.OUTBOX_STOP_TIMEOUT = 5.0  # seconds
+        self.startup_broadcast = None
+        self.answer_cache = SemanticAnswerCache(threshold=self.ANSWER_CACHE_THRESHOLD, max_entries=10000, ttl=24 * 3600,
+                                                db_path='data/answer_cache.db')
         self.ONSTART_MSG = "Back online! Let meow know if you need assistance 🐱"
         self.ONSTOP_MSG = "Meowtenance time! Need to recharge and get my fur fluffed. Sweet dreams, humans! I'll be back online soon. Meanwhile, I will just ignore you 🐱"
         self.WELCOME_MSG = "Nice to meet you! I am RagBot, meow! How can I assist you today?"
         self.RESTART_MSG = "Memory wiped out! Meow! How can I assist you today?"
+        self.BUSY_MSG = "Too many cats in the queue! Please try again in a minute 🐱"
+        self.PLACEHOLDER_MSG = "🐾 ..."
+        self.WARMUP_MSG = "Just woke up, stretching my paws! Please try again in a minute 🐱"
+
+    def load_llm(self):
+        """Load the LLM (heavy imports included), enable batching and prefix caching, and warm it up."""
+        from scripts.llm.LLM import LLM
+        llm = LLM()
+        llm.enable_batching(max_batch_size=self.MAX_BATCH_SIZE, max_wait_ms=self.MAX_BATCH_WAIT_MS)
+        llm.enable_prefix_cache(max_entries=64, max_bytes=2 * 1024 ** 3)
+        llm.warmup()
+        return llm
+
+    def load_embedder(self):
+        """Load the sentence embedder (heavy imports included), enable batching, and warm it up."""
+        from scripts.embedder.embeddings import SentenceEmbedder
+        embedder = SentenceEmbedder()
+        embedder.enable_batching(max_batch_size=self.EMBED_BATCH_SIZE, max_wait_ms=self.EMBED_BATCH_WAIT_MS)
+        embedder.warmup()
+        return embedder
+
+    async def load_models(self, application: Application) -> None:
+        """Load the LLM and the embedder concurrently, in worker threads, while the bot already serves updates.
+
+        Messages are answered with WARMUP_MSG until both models are loaded and warmed up. If loading fails, the bot stops.
+
+        Parameters
+        ----------
+        application : Application
+            The application to stop if the models cannot be loaded
+        """
+        try:
+            llm, embedder = await asyncio.gather(asyncio.to_thread(self.load_llm), asyncio.to_thread(self.load_embedder))
+        except Exception as e:
+            logging.exception(f"could not load the models: {e}")
+            application.stop_running()
+            return
+        self.history_window = HistoryWindow(llm.tokenizer,
+                                            max_tokens=self.HISTORY_TOKEN_BUDGET,
+                                            system_turns=len(self.chats.default),
+                                            reserved_tokens=llm.gen_config.max_new_tokens)
+        self.llm, self.embedder = llm, embedder
+        self.models_ready = True
+        logging.info(f"models loaded and warmed up {time.monotonic() - self.started_at:.1f}s after startup")
 
     def increase_decrease_menu(self, action_id: str) -> InlineKeyboardMarkup:
         """Defines an increase/decrease template for actions.
@@ -91,34 +264,46 @@ class TelegramBot:
         ]
         return InlineKeyboardMarkup(keyboard)
 
-    async def button(self, update: Update) -> None:
+    async def button(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Parses the CallbackQuery and updates the message text.
 
         Retrieve callback data after user's interaction with 'InlineKeyboardMarkup'.
         Increase/decrease by 25% the LLM attribute associated with the action_id in callback data.
+        The change waits for the replies already queued for the chat, like a new message would.
 
         Parameters
         ----------
         update : Update
             The incoming update
+        context: ContextTypes.DEFAULT_TYPE
+            The current context, reporting application that called this function, chat id and user id
         """
         query = update.callback_query
+        if not self.models_ready:
+            await query.answer(text=self.WARMUP_MSG)
+            return
         data = eval(query.data)
-        action_name = self.actions[self.actions['id'] == data['action_id']]['name'].iloc[0]
-        old_val = self.llm.gen_config.__getattribute__(action_name)
-        if data['action'] == 'decrease':
-            new_val = 0.75 * old_val
-        else:
-            new_val = 1.25 * old_val
-        if isinstance(old_val, int):
-            new_val = round(new_val)
-        else:
-            new_val = round(new_val, 2)
-        self.llm.gen_config.__setattr__(action_name, new_val)
+        try:
+            async with self.workers.slot(query.message.chat_id):
+                action_name = self.action_index.name(data['action_id'])
+                old_val = self.llm.gen_config.__getattribute__(action_name)
+                if data['action'] == 'decrease':
+                    new_val = 0.75 * old_val
+                else:
+                    new_val = 1.25 * old_val
+                if isinstance(old_val, int):
+                    new_val = round(new_val)
+                else:
+                    new_val = round(new_val, 2)
+                self.llm.gen_config.__setattr__(action_name, new_val)
+        except asyncio.QueueFull as e:
+            logging.warning(f"button of {query.message.chat_id} rejected: {e}")
+            await query.answer(text=self.BUSY_MSG)
+            return
         # CallbackQueries need to be answered, even if no notification to the user is needed
         # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
         await query.answer()
-        await query.edit_message_text(text=f"Selected option: {data['action']}")
+        self.outbox.edit(query.message, f"Selected option: {data['action']}")
 
     async def config(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send the llm configuration.
@@ -131,16 +316,16 @@ class TelegramBot:
             The current context, reporting application that called this function, chat id and user id
         """
         chat_id = update.effective_chat.id
-        details = "Bot Configuration\n\n" + str(self.llm.gen_config)
-        if check_length(details):
-            chunks = split_text(details)
-            for chunk in chunks:
-                await context.bot.send_message(chat_id=chat_id, text=chunk)
-        await context.bot.send_message(chat_id=chat_id, text=details)
+        if not self.models_ready:
+            self.outbox.send(chat_id, self.WARMUP_MSG)
+            return
+        # Split in chunks by the outbox if longer than MAX_LEN
+        self.outbox.send(chat_id, "Bot Configuration\n\n" + str(self.llm.gen_config))
 
     async def history(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Send the chat history.
+        """Send a page of the chat history.
 
+        '/history' sends the most recent HISTORY_PAGE_SIZE messages, '/history <n>' the n-th page going back in time.
         Privacy protected: hijacking the incoming update with a different chat_id has no effect since the chat history would be forwarded to
         that chat_id.
 
@@ -152,21 +337,21 @@ class TelegramBot:
             The current context, reporting application that called this function, chat id and user id
         """
         chat_id = update.effective_chat.id
-        details = "Conversation History\n\n" + str(get_chat(str(chat_id)))
-        if check_length(details):
-            chunks = split_text(details)
-            for chunk in chunks:
-                await context.bot.send_message(chat_id=chat_id, text=chunk)
-        await context.bot.send_message(chat_id=chat_id, text=details)
+        page = int(context.args[0]) if context.args and context.args[0].isdigit() and int(context.args[0]) > 0 else 1
+        messages, pages = await self.chats.aget_chat_page(str(chat_id), page=page, page_size=self.HISTORY_PAGE_SIZE)
+        details = f"Conversation History (page {page}/{pages})\n\n" + "\n\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        # Split in chunks by the outbox if longer than MAX_LEN
+        self.outbox.send(chat_id, details)
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Message sent when conversation starts for the first time"""
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=self.WELCOME_MSG)
+        self.outbox.send(update.effective_chat.id, self.WELCOME_MSG)
 
     async def restart(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Restart the conversation.
 
-        The conversation history for this chat is erased from the database and restarted with default conversation template.
+        The conversation history for this chat is erased from the database (a ranged delete of its messages) and restarted with default conversation template.
+        The restart waits for the replies already queued for the chat, so that their history updates don't land after the wipe.
 
         Parameters
         ----------
@@ -176,42 +361,153 @@ class TelegramBot:
             The current context, reporting application that called this function, chat id and user id
         """
         chat_id = update.effective_chat.id
-        put_chat(str(chat_id), get_chat("DEFAULT"))
-        await context.bot.send_message(chat_id=chat_id, text=self.RESTART_MSG)
+        try:
+            async with self.workers.slot(chat_id):
+                await self.chats.arestart_chat(str(chat_id))
+                if self.models_ready:
+                    self.llm.prefix_cache.invalidate(str(chat_id))
+        except asyncio.QueueFull as e:
+            logging.warning(f"restart of {chat_id} rejected: {e}")
+            self.outbox.send(chat_id, self.BUSY_MSG)
+            return
+        self.outbox.send(chat_id, self.RESTART_MSG)
+
+    def keyword_search(self, input_text) -> dict | None:
+        """Lexical search of an action explicitly named in a short message, e.g. 'temperature' or 'max new tokens'.
+
+        Runs before the message is embedded: when the message has at most ACTIONS_KEYWORD_MAX_WORDS words and names exactly one action,
+        which is also the best BM25 match, that action is returned and semantic search is skipped.
+        Only the actions in the posting lists of the message tokens are checked, against their precomputed name tokens.
 
-    def vector_db_search(self, input_text) -> dict | None:
-        """Semantic search in the vector database.
+        Parameters
+        ----------
+        input_text : str
+            The input text used to search the actions
 
-        The incoming text is embedded and compared to the entries (i.e., embeddings) of the vector database.
-        If the similarity is high enough, the entry with the highest similarity is returned
+        Returns
+        -------
+        action: dict | None
+            The action named in the text, together with its BM25 score
+        """
+        if len(input_text.split()) > self.ACTIONS_KEYWORD_MAX_WORDS:
+            return None
+        hits = self.action_lexical.search(input_text, top_k=1)
+        if not hits:
+            return None
+        tokens = set(tokenize(input_text))
+        named = [action_id for action_id in self.action_lexical.matching(tokens) if self.action_name_tokens[action_id] <= tokens]
+        action_id, score = hits[0]
+        if named == [action_id]:
+            name = self.action_index.name(action_id)
+            logging.info(f"Action Triggered by keyword! Name: {name}, Id: {action_id}, Score: {round(score, 2)}")
+            return {"name": name,
+                    "id": action_id,
+                    "similarity": score}
+        return None
+
+    def vector_db_search(self, input_text, embedding=None) -> dict | None:
+        """Hybrid (semantic and lexical) search in the vector database.
+
+        The incoming text is embedded (unless its embedding is given) and compared to the entries (i.e., embeddings) of the vector database.
+        The similarities are fused with the BM25 scores of the text against the action names and descriptions (see lexical.fuse).
+        If the fused similarity is high enough and clearly ahead of the runner-up, the entry with the highest similarity is returned
 
         Parameters
         ----------
         input_text : str
             The input text used to search the vector database
+        embedding : np.ndarray, optional
+            The embedding of the input text, if already computed
 
         Returns
         -------
         action: dict | None
             The action selected from the vector database, together with its similarity score
         """
-        embedded_reply = self.embedder.encode(input_text)
-        value, index = self.embedder.semantic_search(embedded_reply, list(self.actions["embedding"]))
-        if value >= self.ACTIONS_THRESHOLD:
-            action = self.actions.iloc[index]
-            logging.info(f"Action Triggered! Name: {action['name']}, Id: {action['id']}, Similarity: {round(value, 2)}")
-            return {"name": action["name"],
-                    "id": action["id"],
+        embedded_reply = self.embedder.encode(input_text) if embedding is None else embedding
+        dense = self.embedder.semantic_search(embedded_reply, self.action_index, top_k=5)
+        hits = fuse(dense, self.action_lexical.search(input_text, top_k=5), weight=self.ACTIONS_LEXICAL_WEIGHT,
+                    similarities=lambda ids: self.action_index.similarities(embedded_reply, ids))
+        if not hits:
+            return None
+        action_id, value = hits[0]
+        margin = value - hits[1][1] if len(hits) > 1 else value
+        if value >= self.ACTIONS_THRESHOLD and margin >= self.ACTIONS_MARGIN:
+            name = self.action_index.name(action_id)
+            logging.info(f"Action Triggered! Name: {name}, Id: {action_id}, Similarity: {round(value, 2)}, Margin: {round(margin, 2)}")
+            return {"name": name,
+                    "id": action_id,
                     "similarity": value}
         else:
             return None
 
-    def update_and_generate(self, chat_id, input_text) -> str:
+    async def cached_answer(self, chat_id, input_text, embedding) -> str | None:
+        """Look for a cached answer to the incoming text, updating the conversation history if found.
+
+        Only fresh conversations (i.e., history equal to the default template) are served from the cache,
+        since later answers depend on the conversation context.
+
+        Parameters
+        ----------
+        chat_id : int
+            The chat id of the user (n.b. Telegram ids are integers, not strings!)
+        input_text: str
+            The text
+        embedding: np.ndarray
+            The embedding of the text
+
+        Returns
+        -------
+        answer: str | None
+            The cached answer, or None if the conversation is not fresh or no similar question was answered before
+        """
+        if len(await self.chats.aget_chat(str(chat_id), last_n=1)) > self.history_window.system_turns:
+            return None
+        answer = self.answer_cache.lookup(embedding)
+        if answer is None:
+            return None
+        await self.chats.aappend_chat(str(chat_id), [{"role": "user", "content": input_text}, {"role": "assistant", "content": answer}])
+        return "\n".join([answer, self.llm.__meow__()])
+
+    def cache_answer(self, chat_template, input_text, embedding, fresh: bool):
+        """Cache the last answer of 'chat_template' if it is the first answer of the conversation.
+
+        'fresh' tells whether the stored history held only the default template (see prepare_chat): the length of 'chat_template'
+        can't tell, since a long history may have been cut down to its last turn by the history window.
+        """
+        if embedding is not None and fresh:
+            self.answer_cache.store(embedding, input_text, chat_template[-1]["content"])
+
+    def retrieve_context(self, input_text, embedding=None) -> list[str]:
+        """Retrieve the knowledge base chunks most similar to the incoming text.
+
+        Parameters
+        ----------
+        input_text : str
+            The text
+        embedding : np.ndarray, optional
+            The embedding of the text, if already computed
+
+        Returns
+        -------
+        context: list[str]
+            The text of up to KB_TOP_K chunks with similarity above KB_THRESHOLD, most similar first
+        """
+        if self.knowledge is None:
+            return []
+        embedding = self.embedder.encode(input_text) if embedding is None else embedding
+        chunks = self.knowledge.search(embedding, top_k=self.KB_TOP_K, threshold=self.KB_THRESHOLD, text=input_text, lexical_weight=self.KB_LEXICAL_WEIGHT)
+        if chunks:
+            logging.info(f"{len(chunks)} knowledge base chunks retrieved, Similarity: {[round(chunk['similarity'], 2) for chunk in chunks]}")
+        return [chunk["text"] for chunk in chunks]
+
+    def update_and_generate(self, chat_id, input_text, embedding=None) -> str:
         """Use the LLM to generate an answer for the user and update the conversation history .
 
-        First, the chat history is retrieved from the history database.
-        Then, the conversation history, i.e., chat template, is passed to the LLM together with the input text to generate a context and history aware answer.
-        Finally, the conversation history is updated with the input_text and the answer generated.
+        First, the knowledge base chunks relevant to the input text are retrieved.
+        Then, the chat history is retrieved from the history database and its oldest turns are dropped if it exceeds the token budget.
+        The conversation history, i.e., chat template, is passed to the LLM together with the input text and the retrieved chunks to generate a context and history aware answer.
+        Finally, the input_text (without the chunks) and the answer generated are appended to the conversation history.
 
         Parameters
         ----------
@@ -219,23 +515,95 @@ class TelegramBot:
             The chat id of the user (n.b. Telegram ids are integers, not strings!)
         input_text: str
             The text
+        embedding: np.ndarray, optional
+            The embedding of the text, used for retrieval and to cache the answer of fresh conversations
 
         Returns
         -------
         answer: str
             The answer generated with LLM
         """
-        chat_template = get_chat(str(chat_id))
-        answer = self.llm.reply(user_message=input_text, chat_template=chat_template)
+        context = self.retrieve_context(input_text, embedding)
+        chat_template, fresh = self.prepare_chat(chat_id, input_text, context)
+        answer = self.llm.reply(user_message=input_text, chat_template=chat_template, cache_key=str(chat_id), context=context)
         logging.info(f"message generated for {chat_id}")
-        put_chat(str(chat_id), answer["chat_template"])
+        self.chats.append_chat(str(chat_id), answer["chat_template"][-2:])
+        self.cache_answer(answer["chat_template"], input_text, embedding, fresh)
         return answer["text"]
 
+    def prepare_chat(self, chat_id, input_text, context=None) -> tuple[list[dict], bool]:
+        """Retrieve the last HISTORY_MAX_MESSAGES messages of the chat history, dropping the oldest turns if they exceed the token budget.
+
+        The retrieved chunks in 'context' count towards the budget, since they are injected in the prompt with the new message.
+        Return the chat template and whether the conversation is fresh, i.e. the stored history is just the default template.
+        """
+        new_message = "\n\n".join([*(context or []), input_text])
+        history = self.chats.get_chat(str(chat_id), last_n=self.HISTORY_MAX_MESSAGES)
+        fresh = len(history) == len(self.chats.default)
+        return self.history_window.fit(history, new_message=new_message, chat_id=chat_id), fresh
+
+    async def edit_streamed(self, message: Message, text: str) -> float:
+        """Edit a streamed message through the outbox, return the number of seconds to wait before editing it again.
+
+        Throttled edits are retried by the outbox after the time requested by Telegram.
+        """
+        try:
+            await self.outbox.edit(message, text)
+        except BadRequest as e:
+            # e.g., 'Message is not modified'
+            logging.warning(e)
+        except TelegramError as e:
+            # Already logged by the outbox: the next edit will carry the text anyway
+            logging.debug(f"streamed edit to {message.chat_id} dropped: {e}")
+        return self.EDIT_INTERVAL
+
+    async def update_and_stream(self, chat_id, input_text, embedding=None) -> None:
+        """Use the LLM to generate an answer for the user, streaming it to the chat while it is generated, and update the conversation history.
+
+        A placeholder message is sent right away and progressively edited as the tokens arrive. Edits are throttled to one every
+        EDIT_INTERVAL seconds, and sent through the outbox (which waits if Telegram asks to retry later). When the answer outgrows CHUNK_LEN characters,
+        the current message is finalized and the answer continues in a new one.
+
+        Parameters
+        ----------
+        chat_id : int
+            The chat id of the user (n.b. Telegram ids are integers, not strings!)
+        input_text: str
+            The text
+        embedding: np.ndarray, optional
+            The embedding of the text, used for retrieval and to cache the answer of fresh conversations
+        """
+        loop = asyncio.get_running_loop()
+        context = await self.workers.run(self.retrieve_context, input_text, embedding)
+        chat_template, fresh = await self.workers.run(self.prepare_chat, chat_id, input_text, context)
+        message = await self.outbox.send(chat_id, self.PLACEHOLDER_MSG)
+        text, offset, shown, next_edit = "", 0, "", 0.0
+        async for chunk in self.llm.astream_reply(user_message=input_text, chat_template=chat_template, cache_key=str(chat_id),
+                                                  executor=self.workers.executor, context=context):
+            text += chunk
+            while len(text) - offset > CHUNK_LEN:
+                await asyncio.sleep(max(next_edit - loop.time(), 0))
+                await self.edit_streamed(message, text[offset:offset + CHUNK_LEN])
+                offset += CHUNK_LEN
+                shown = text[offset:offset + CHUNK_LEN]
+                message = await self.outbox.send(chat_id, shown if shown.strip() else self.PLACEHOLDER_MSG)
+                next_edit = loop.time() + self.EDIT_INTERVAL
+            if loop.time() >= next_edit and text[offset:] != shown and text[offset:].strip():
+                shown = text[offset:]
+                next_edit = loop.time() + await self.edit_streamed(message, shown)
+        if text[offset:] != shown and text[offset:].strip():
+            await asyncio.sleep(max(next_edit - loop.time(), 0))
+            await self.edit_streamed(message, text[offset:])
+        logging.info(f"message streamed to {chat_id}")
+        await self.chats.aappend_chat(str(chat_id), chat_template[-2:])
+        self.cache_answer(chat_template, input_text, embedding, fresh)
+
     async def post_stop(self, application: Application, recent=True) -> None:
         """Callback called when the bot is stopped.
 
         When the bot is stopped, send a broadcast message to notify users that the bot will be offline.
         The notification can be sent to the users that interacts with the bot recently (default) or to all the users in memory
+        The broadcast is rate-limited and gives up after BROADCAST_STOP_TIMEOUT seconds, so that shutdown does not hang.
 
         Parameters
         ----------
@@ -249,19 +617,32 @@ class TelegramBot:
         answer: str
             The answer generated with LLM
         """
+        if self.startup_broadcast is not None and not self.startup_broadcast.done():
+            self.startup_broadcast.cancel()
         logging.info(f"broadcasting message...")
-        chat_ids = get_all_chat_ids(recent=recent)
-        if len(chat_ids) > 0:
-            for chat_id in chat_ids:
-                await application.bot.send_message(chat_id=chat_id, text=self.ONSTOP_MSG)
-        else:
-            logging.info(f"no chats found")
+        broadcaster = Broadcaster(application.bot, rate=self.BROADCAST_RATE, max_concurrency=self.BROADCAST_CONCURRENCY, bucket=self.outbox.bucket)
+        await broadcaster.broadcast(self.chats.aiter_chat_ids(recent=recent), self.ONSTOP_MSG, timeout=self.BROADCAST_STOP_TIMEOUT)
+        await self.outbox.join(timeout=self.OUTBOX_STOP_TIMEOUT)
+        logging.info(f"Outbox statistics: {self.outbox.stats()}")
+        self.workers.shutdown()
+        if self.models_ready:
+            logging.info(f"LLM batch statistics: {self.llm.scheduler.stats.summary()}")
+            logging.info(f"LLM prefix cache statistics: {self.llm.prefix_cache.stats()}")
+            logging.info(f"Embedding cache statistics: {self.embedder.cache.stats()}")
+            logging.info(f"Embedding batch statistics: {self.embedder.batcher.stats.summary()}")
+        logging.info(f"Answer cache statistics: {self.answer_cache.stats()}")
+        self.answer_cache.close()
+        if self.knowledge is not None:
+            self.knowledge.close()
+        self.chats.close()
+        self.storage.close()
 
     async def post_init(self, application: Application, recent=True) -> None:
         """Callback called when the bot starts.
 
-        When the bot starts, send a broadcast message to notify users that the bot is online again.
+        When the bot starts, load the models in the background (see load_models) and send a broadcast message to notify users that the bot is online again.
         The notification can be sent to the users that interacts with the bot recently (default) or to all the users in memory
+        The broadcast is rate-limited and runs in the background while the bot serves updates.
 
         Parameters
         ----------
@@ -275,24 +656,27 @@ class TelegramBot:
         answer: str
             The answer generated with LLM
         """
+        self.outbox.start(application.bot)
+        self.model_loading = asyncio.create_task(self.load_models(application))
         logging.info(f"broadcasting message...")
-        chat_ids = get_all_chat_ids(recent=recent)
-        if len(chat_ids) > 0:
-            for chat_id in chat_ids:
-                await application.bot.send_message(chat_id=chat_id, text=self.ONSTART_MSG)
-                logging.info(f"broadcast message sent")
-        else:
-            logging.info(f"no chats found")
+        # The broadcast shares the global rate limit of the outbox, so that replies and broadcast together stay within it
+        broadcaster = Broadcaster(application.bot, rate=self.BROADCAST_RATE, max_concurrency=self.BROADCAST_CONCURRENCY, bucket=self.outbox.bucket)
+        # The broadcast runs in the background: polling starts right away instead of waiting for every chat to be notified
+        self.startup_broadcast = asyncio.create_task(broadcaster.broadcast(self.chats.aiter_chat_ids(recent=recent), self.ONSTART_MSG))
 
     async def reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Callback called when there is a new incoming message.
 
         When a new message is received, the bot:
-        1) Updates session info
-        2) Sets its status to 'typing...' (only lasts for 5 seconds and there's no way to modify it)
-        3) Semantic search to get the most plausible action from the vector db
-        4A) If semantic search finds an action that is plausible enough, the correspondent routine starts
-        4B) If semantic search does not return anything, the user message is passed to the LLM and the generated answer is sent back
+        1) Updates session info (and answers it is warming up if the models are still loading after a restart)
+        2) Sets its status to 'typing...' and refreshes it until the answer is ready (it only lasts for 5 seconds)
+        3) Queues the message behind the previous messages of the same chat (or answers it is busy if the queue is full)
+        4) Keyword search for short messages naming an action, then hybrid search to get the most plausible action from the vector db
+        5A) If the search finds an action that is plausible enough, the correspondent routine starts
+        5B) If the conversation is fresh and a similar question was answered before, the cached answer is sent back
+        5C) Otherwise, the user message is passed to the LLM and the generated answer is sent back
+        Semantic search and generation run on the inference executor, so the event loop keeps serving other updates meanwhile.
+        Replies are enqueued in the outbox, which sends them in order and within Telegram's rate limits.
 
         Parameters
         ----------
@@ -308,26 +692,48 @@ class TelegramBot:
         """
         chat_id = update.effective_chat.id
         logging.info(f"incoming message from {chat_id}")
-        update_session(str(chat_id), "TEST001")
-        await context.bot.send_chat_action(chat_id=chat_id, action='typing')
-        # Check in the vector db if the message is semantically similar to one of the scripted actions
-        action = self.vector_db_search(update.message.text)
-        # If so, trigger action and don't update chat history
-        if action is not None:
-            await update.message.reply_text(f"{action['name']}", reply_markup=self.increase_decrease_menu(action_id=str(action['id'])))
-        # Otherwise, use LLM to generate answer and update chat history
-        else:
-            answer = self.update_and_generate(chat_id, update.message.text)
-            await context.bot.send_message(chat_id=chat_id, text=answer)
+        await self.chats.aupdate_session(str(chat_id), "TEST001")
+        if not self.models_ready:
+            self.outbox.send(chat_id, self.WARMUP_MSG)
+            return
+        try:
+            # Typing starts before waiting for the slot: a message queued behind another one of the same chat shows it too
+            async with keep_typing(self.outbox, chat_id), self.workers.slot(chat_id):
+                # Messages naming an action trigger it right away, without running the embedder
+                embedding = None
+                action = self.keyword_search(update.message.text)
+                # Otherwise, check in the vector db if the message is similar to one of the scripted actions
+                if action is None:
+                    embedding = await self.workers.run(self.embedder.encode, update.message.text)
+                    action = self.vector_db_search(update.message.text, embedding=embedding)
+                # If so, trigger action and don't update chat history
+                if action is not None:
+                    self.outbox.send(chat_id, f"{action['name']}", reply_markup=self.increase_decrease_menu(action_id=str(action['id'])))
+                # If the same question was already answered at the start of another conversation, reuse that answer
+                elif (answer := await self.cached_answer(chat_id, update.message.text, embedding)) is not None:
+                    self.outbox.send(chat_id, answer)
+                # Otherwise, use LLM to generate answer and update chat history
+                elif self.STREAM_REPLIES:
+                    await self.update_and_stream(chat_id, update.message.text, embedding=embedding)
+                else:
+                    answer = await self.workers.run(self.update_and_generate, chat_id, update.message.text, embedding)
+                    self.outbox.send(chat_id, answer)
+            if self.first_reply_at is None:
+                self.first_reply_at = time.monotonic()
+                logging.info(f"time to first reply after restart: {self.first_reply_at - self.started_at:.1f}s")
+        except asyncio.QueueFull as e:
+            logging.warning(f"message from {chat_id} rejected: {e}")
+            self.outbox.send(chat_id, self.BUSY_MSG)
 
     def run(self):
         """Run the telegram bot.
 
         Application built through ApplicationBuilder passing the API token and the init and stop callbacks.
+        Updates are processed concurrently: ordering within a chat is enforced by the inference executor.
         Then, handlers managing various types of user-bot interaction are added to the application.
         Finally, the app starts through the convenience method 'run_polling' which initialize, update and gracefully stop the bot.
         """
-        application = ApplicationBuilder().token(self.API_TOKEN).post_init(self.post_init).post_stop(self.post_stop).build()
+        application = ApplicationBuilder().token(self.API_TOKEN).concurrent_updates(True).post_init(self.post_init).post_stop(self.post_stop).build()
         handlers = [CommandHandler("start", self.start),
                     CommandHandler('restart', self.restart),
                     CommandHandler('config', self.config),
@@ -0,0 +1,88 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+
+class InferenceExecutor:
+    """
+    Runs the CPU/GPU-bound stages of a reply (embedding, generation) off the event loop.
+
+    Jobs are executed by a dedicated thread pool with bounded concurrency. Incoming messages are admitted through a bounded
+    request queue: when too many messages are pending, new ones are rejected instead of piling up (backpressure).
+    Messages of the same chat are processed one at a time and in arrival order, so two messages from the same chat are
+    always answered in order, while different chats proceed concurrently.
+
+    Attributes
+    ----------
+    max_workers : int
+        number of threads running CPU/GPU-bound jobs
+    max_pending : int
+        maximum number of messages admitted (running or waiting) at the same time
+    pending : int
+        number of messages currently admitted
+    """
+    def __init__(self, max_workers: int = 1, max_pending: int = 64):
+        """
+        Parameters
+        ----------
+        max_workers : int
+            number of threads running CPU/GPU-bound jobs
+        max_pending : int
+            maximum number of messages admitted (running or waiting) at the same time
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self._chat_locks: dict[int, list] = {}  # chat_id -> [lock, number of messages holding or waiting for it]
+
+    @asynccontextmanager
+    async def slot(self, chat_id: int):
+        """Admit a message of 'chat_id' and wait for the previous messages of the same chat to be processed.
+
+        Raises asyncio.QueueFull if 'max_pending' messages are already admitted.
+        """
+        if self.pending >= self.max_pending:
+            raise asyncio.QueueFull(f"{self.pending} messages pending")
+        self.pending += 1
+        entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes up its waiters in FIFO order, preserving the arrival order of the messages
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_id]
+            self.pending -= 1
+
+    async def run(self, function, *args):
+        """Run 'function(*args)' on the inference thread pool and await its result."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        return self._executor
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+@asynccontextmanager
+async def keep_typing(outbox, chat_id: int, interval: float = 4.5):
+    """Keep the 'typing...' chat action visible while the body of the context manager runs.
+
+    Telegram clears a chat action after 5 seconds, so it is re-sent every 'interval' seconds until the work is done.
+    The actions go through the OutboundDispatcher 'outbox', which drops them while one is still shown.
+    """
+    async def refresh():
+        while True:
+            outbox.typing(chat_id)
+            await asyncio.sleep(interval)
+
+    task = asyncio.create_task(refresh())
+    try:
+        yield
+    finally:
+        task.cancel()
@@ -1,14 +1,20 @@
 import os
+import logging
 
+from bot.sqlutils import retrieve_action_descriptions, put_action_embeddings
 from scripts.embedder.embeddings import SentenceEmbedder
 
 os.chdir("/home/tommaso/Repositories/teleRAG/")
 
 def main():
-    sentences = ["This action sets the maximum length of the answers generated by the model. Specifying a max length helps you prevent long or irrelevant responses and control costs and time."]
+    actions = retrieve_action_descriptions()
+    if actions is None:
+        logging.warning("No actions found.")
+        return
     embedder = SentenceEmbedder('paraphrase-MiniLM-L6-v2')
-    embeddings = embedder.encode(sentences)
-    print("["+",".join([str(e) for e in embeddings[0]])+"]")
+    embeddings = embedder.encode(list(actions["description"]))
+    put_action_embeddings(list(actions["id"]), embeddings)
+    print(f"{len(embeddings)} action embeddings written to data/actions.db")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,259 @@
+import time
+import asyncio
+import logging
+import sqlite3
+from contextlib import asynccontextmanager
+from itertools import zip_longest
+from urllib.parse import urlsplit
+
+import aiohttp
+
+
+class HostLimiter:
+    """
+    Politeness limits of a single host: at most 'max_concurrency' requests in flight, and request starts spaced by at
+    least 1 / 'rate' seconds.
+    The semaphore is created on first use, in the event loop running the crawl: asyncio primitives are bound to a loop.
+    """
+    def __init__(self, max_concurrency: int = 2, rate: float = 2.0):
+        self.max_concurrency = max_concurrency
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._semaphore = None
+        self._next_start = 0.0
+
+    def delay(self, seconds: float):
+        """Push back the next request start, e.g. when the host answers 429 with a Retry-After header."""
+        self._next_start = max(self._next_start, asyncio.get_running_loop().time() + seconds)
+
+    @asynccontextmanager
+    async def slot(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            now = asyncio.get_running_loop().time()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+            if start > now:
+                await asyncio.sleep(start - now)
+            yield
+
+
+class Checkpoint:
+    """
+    Persistent record of the crawl, so that a crawl interrupted at any point resumes where it stopped.
+
+    The 'pages' table holds every URL fetched for good (status, ETag, Last-Modified, time); the 'fingerprints' table holds
+    the content hash and SimHash of every article written, for deduplication across runs, and the part file holding its
+    latest version. URLs that failed (network errors, 5xx) are not recorded and are retried by the next run.
+    Changes are only visible to this connection until 'commit', so that pages are committed together with the output
+    they produced: a crash rolls back both.
+    """
+    def __init__(self, db_path: str = 'data/ws_checkpoint.db'):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS pages
+                              (
+                                  url           TEXT
+                                      constraint pages_pk
+                                          primary key,
+                                  status        INTEGER,
+                                  etag          TEXT,
+                                  last_modified TEXT,
+                                  fetched_at    REAL
+                              );""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS fingerprints
+                              (
+                                  url          TEXT
+                                      constraint fingerprints_pk
+                                          primary key,
+                                  content_hash TEXT,
+                                  simhash      INTEGER,
+                                  band0        INTEGER,
+                                  band1        INTEGER,
+                                  band2        INTEGER,
+                                  band3        INTEGER,
+                                  part         TEXT
+                              );""")
+        if "part" not in [column for _, column, *_ in self._conn.execute("PRAGMA table_info(fingerprints);")]:
+            # Checkpoints written before the part files were recorded
+            self._conn.execute("ALTER TABLE fingerprints ADD COLUMN part TEXT;")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS fingerprints_hash ON fingerprints (content_hash);")
+        for band in range(4):
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS fingerprints_band{band} ON fingerprints (band{band});")
+        self._conn.commit()
+
+    def pending(self, urls: list[str], refresh: bool = False) -> list[tuple[str, str | None, str | None]]:
+        """Return the URLs to fetch as (url, etag, last_modified).
+
+        Without 'refresh', the URLs already fetched are skipped. With 'refresh', they are fetched again, conditionally on
+        their validators, so that unchanged pages cost a 304 and no extraction.
+        """
+        known = {url: (etag, last_modified) for url, etag, last_modified in self._conn.execute("SELECT url, etag, last_modified FROM pages;")}
+        if refresh:
+            return [(url, *known.get(url, (None, None))) for url in urls]
+        return [(url, None, None) for url in urls if url not in known]
+
+    def done(self, url: str, status: int, etag: str | None = None, last_modified: str | None = None):
+        """Record a fetched page (committed at the next 'commit')."""
+        self._conn.execute("INSERT OR REPLACE INTO pages (url, status, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?, ?);",
+                           (url, status, etag, last_modified, time.time()))
+
+    def is_duplicate(self, url: str, content_hash: str, simhash: int, max_distance: int = 3) -> bool:
+        """Whether another URL already has the same content, or a near-duplicate one (SimHash within 'max_distance' bits).
+
+        The 64-bit SimHash is split in 4 bands of 16 bits: two fingerprints within 3 bits share at least one band, so only
+        the fingerprints sharing a band are compared.
+        """
+        if self._conn.execute("SELECT 1 FROM fingerprints WHERE content_hash = ? AND url != ? LIMIT 1;", (content_hash, url)).fetchone():
+            return True
+        bands = _bands_(simhash)
+        candidates = self._conn.execute("SELECT simhash FROM fingerprints WHERE (band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?) AND url != ?;",
+                                        (*bands, url))
+        return any(bin((simhash ^ candidate) & 0xFFFFFFFFFFFFFFFF).count("1") <= max_distance for candidate, in candidates)
+
+    def add_fingerprint(self, url: str, content_hash: str, simhash: int, part: str | None = None):
+        """Record the fingerprints of an article and the part file it is written to (committed at the next 'commit')."""
+        self._conn.execute("INSERT OR REPLACE INTO fingerprints (url, content_hash, simhash, band0, band1, band2, band3, part) VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+                           (url, content_hash, simhash, *_bands_(simhash), part))
+
+    def parts(self, urls: list[str], chunk_size: int = 500) -> dict:
+        """Return the part file holding the latest version of each URL, for the URLs with a recorded part."""
+        parts = {}
+        for start in range(0, len(urls), chunk_size):
+            chunk = urls[start:start + chunk_size]
+            parts.update(self._conn.execute(f"SELECT url, part FROM fingerprints WHERE part IS NOT NULL AND url IN ({', '.join('?' * len(chunk))});", chunk))
+        return parts
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def _bands_(simhash: int) -> list[int]:
+    return [(simhash >> (16 * band)) & 0xFFFF for band in range(4)]
+
+
+def interleave(url_lists: list[list[str]]) -> list[str]:
+    """Merge the URL lists of several websites round-robin, so that the workers are spread over the hosts."""
+    return [url for urls in zip_longest(*url_lists) for url in urls if url is not None]
+
+
+class Fetcher:
+    """
+    Asynchronous HTTP fetch engine shared by all the crawled websites.
+
+    A global pool of 'max_workers' tasks consumes a single queue of URLs. Each host gets its own HostLimiter
+    ('per_host' requests in flight, 'rate_per_host' requests per second), so that the crawl is polite to every host
+    while the workers keep busy on the others. Network errors, 429 and 5xx answers are retried with exponential backoff
+    (429 honors Retry-After). Conditional requests send If-None-Match / If-Modified-Since when validators are known.
+
+    Attributes
+    ----------
+    max_workers : int
+        number of concurrent fetch tasks across all hosts
+    per_host : int
+        maximum number of requests in flight per host
+    rate_per_host : float
+        maximum number of requests per second per host
+    timeout : float
+        total timeout of a request, in seconds
+    retries : int
+        number of retries of a failed request
+    """
+    def __init__(self, max_workers: int = 32, per_host: int = 2, rate_per_host: float = 2.0, timeout: float = 30.0, retries: int = 2,
+                 user_agent: str = "teleRAG-crawler"):
+        """
+        Parameters
+        ----------
+        max_workers : int
+            number of concurrent fetch tasks across all hosts
+        per_host : int
+            maximum number of requests in flight per host
+        rate_per_host : float
+            maximum number of requests per second per host
+        timeout : float
+            total timeout of a request, in seconds
+        retries : int
+            number of retries of a failed request
+        user_agent : str
+            the User-Agent header of the requests
+        """
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.rate_per_host = rate_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.user_agent = user_agent
+        self._hosts = {}  # host -> HostLimiter, for the event loop in '_loop'
+        self._loop = None
+
+    def _limiter_(self, url: str) -> HostLimiter:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # The limiters of a previous run (e.g. another asyncio.run) are bound to its loop: start with new ones
+            self._loop, self._hosts = loop, {}
+        host = urlsplit(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = HostLimiter(self.per_host, self.rate_per_host)
+        return self._hosts[host]
+
+    async def fetch(self, session: aiohttp.ClientSession, url: str, etag: str | None = None, last_modified: str | None = None) -> dict:
+        """Fetch a URL, return a dict with url, status, html (None unless 200), etag and last_modified.
+
+        Raises the last error if the request still fails after 'retries' retries.
+        """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        limiter = self._limiter_(url)
+        for attempt in range(self.retries + 1):
+            try:
+                async with limiter.slot():
+                    async with session.get(url, headers=headers) as response:
+                        if response.status == 429 or response.status >= 500:
+                            retry_after = response.headers.get("Retry-After", "")
+                            limiter.delay(float(retry_after) if retry_after.isdigit() else 2 ** attempt)
+                            raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+                        html = await response.text(errors="replace") if response.status == 200 else None
+                        return {"url": url,
+                                "status": response.status,
+                                "html": html,
+                                "etag": response.headers.get("ETag", etag),
+                                "last_modified": response.headers.get("Last-Modified", last_modified)}
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                logging.debug(f"retrying {url} after error: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+    async def crawl(self, requests: list[tuple[str, str | None, str | None]], on_page):
+        """Fetch every (url, etag, last_modified) request with the worker pool, awaiting 'on_page(page)' for each fetched page.
+
+        Failed URLs are logged and skipped.
+        """
+        queue = asyncio.Queue()
+        for request in requests:
+            queue.put_nowait(request)
+
+        async def worker(session):
+            while True:
+                try:
+                    url, etag, last_modified = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    page = await self.fetch(session, url, etag, last_modified)
+                    await on_page(page)
+                except Exception as e:
+                    logging.warning(f"failed to fetch {url}: {e}")
+
+        connector = aiohttp.TCPConnector(limit=self.max_workers, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers={"User-Agent": self.user_agent}) as session:
+            await asyncio.gather(*(worker(session) for _ in range(self.max_workers)))
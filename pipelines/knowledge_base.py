@@ -0,0 +1,126 @@
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+from tqdm import tqdm
+
+from scripts.embedder.embeddings import SentenceEmbedder
+from scripts.embedder.index import IVFIndex, QuantizedIndex, l2_normalize
+from scripts.embedder.knowledge import chunk_text
+from scripts.embedder.lexical import BM25Index
+from pipelines.web_scraped_dataset import read_dataset
+
+os.chdir("/home/tommaso/Repositories/teleRAG/")
+
+
+def write_chunks(articles, db_path: str, chunk_words: int = 100, overlap: int = 20) -> tuple[int, int]:
+    """
+    Chunk the body of every article (dicts with url, body, title) and write the chunks to the 'chunks' table, return
+    the number of articles and of chunks. The articles are streamed, e.g. from read_dataset, and never held in memory.
+    Chunks are kept around 100 words, since the embedder truncates its inputs at 128 tokens.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("DROP TABLE IF EXISTS chunks;")
+    conn.execute("""CREATE TABLE chunks
+                    (
+                        id    INTEGER
+                            constraint chunks_pk
+                                primary key,
+                        url   TEXT,
+                        title TEXT,
+                        text  TEXT
+                    );""")
+    n_articles, n_chunks = 0, 0
+    for article in tqdm(articles, desc="Chunking"):
+        chunks = chunk_text(str(article["body"]), chunk_words=chunk_words, overlap=overlap)
+        conn.executemany("INSERT INTO chunks (id, url, title, text) VALUES (?, ?, ?, ?);",
+                         [(n_chunks + i, article["url"], article["title"], chunk) for i, chunk in enumerate(chunks)])
+        n_articles += 1
+        n_chunks += len(chunks)
+    conn.commit()
+    conn.close()
+    return n_articles, n_chunks
+
+
+def write_embeddings(db_path: str, npy_path: str, n_chunks: int, embedder: SentenceEmbedder, batch_size: int = 256):
+    """
+    Embed the chunks in batches and write them, L2-normalized, to a float32 .npy file that can be memory-mapped.
+
+    The chunks are streamed from the database and the matrix is written through a memory map, so memory usage does not
+    grow with the size of the knowledge base.
+    """
+    dim = embedder.model.get_sentence_embedding_dimension()
+    embeddings = np.lib.format.open_memmap(npy_path, mode="w+", dtype=np.float32, shape=(n_chunks, dim))
+    conn = sqlite3.connect(db_path)
+    cursor = conn.execute("SELECT id, text FROM chunks ORDER BY id;")
+    with tqdm(total=n_chunks, desc="Embedding") as progress:
+        while batch := cursor.fetchmany(batch_size):
+            ids, texts = zip(*batch)
+            # Chunks are mostly unique: bypass the embedder cache, which would only evict the hot query embeddings
+            embeddings[ids[0]:ids[-1] + 1] = l2_normalize(embedder.model.encode(list(texts), batch_size=batch_size))
+            progress.update(len(batch))
+    conn.close()
+    embeddings.flush()
+    del embeddings
+
+
+def write_bm25_index(db_path: str, bm25_path: str, batch_size: int = 10000):
+    """
+    Build the BM25 inverted index of the chunks, streamed from the database in batches, and save it.
+    """
+    index = BM25Index()
+    conn = sqlite3.connect(db_path)
+    cursor = conn.execute("SELECT id, text FROM chunks ORDER BY id;")
+    while batch := cursor.fetchmany(batch_size):
+        ids, texts = zip(*batch)
+        index.add(ids, texts)
+    conn.close()
+    index.save(bm25_path)
+    print(f"BM25 index of {len(index)} chunks written to {bm25_path}")
+
+
+def write_ivf_index(npy_path: str, index_path: str, nprobe: int = 16):
+    """
+    Train an IVF index on the chunk embeddings and save it, so that the bot searches it instead of scanning every chunk.
+    """
+    embeddings = np.load(npy_path, mmap_mode="r")
+    index = IVFIndex.build(embeddings, nprobe=nprobe)
+    index.save(index_path)
+    print(f"IVF index with {index.n_lists} lists (nprobe={nprobe}) written to {index_path}")
+
+
+def write_quantized_index(npy_path: str, index_path: str, precision: str):
+    """
+    Quantize the chunk embeddings (int8 or binary) and save the index, so that the bot only keeps the codes in memory.
+    """
+    embeddings = np.load(npy_path, mmap_mode="r")
+    index = QuantizedIndex(embeddings, precision=precision, normalized=True)
+    index.save(index_path)
+    print(f"{precision} index of {len(index)} chunks ({index.codes.nbytes / 1024 ** 2:.1f} MB of codes) written to {index_path}")
+
+
+def build_knowledge_base(articles, path: str = "data/kb", embedder: SentenceEmbedder | None = None, min_ivf_chunks: int = 50000,
+                         precision: str = "float32"):
+    """
+    Build the knowledge base read by KnowledgeBase from an iterable of articles (dicts with url, body, title).
+    With precision 'int8' or 'binary', the bot searches a quantized index (with float rescoring). Otherwise, an
+    approximate index is only built for at least 'min_ivf_chunks' chunks: below that, the exact scan is fast enough.
+    """
+    os.makedirs(path, exist_ok=True)
+    embedder = SentenceEmbedder() if embedder is None else embedder
+    db_path, npy_path = os.path.join(path, "chunks.db"), os.path.join(path, "embeddings.npy")
+    n_articles, n_chunks = write_chunks(articles, db_path)
+    write_embeddings(db_path, npy_path, n_chunks, embedder)
+    write_bm25_index(db_path, os.path.join(path, "bm25.npz"))
+    if os.path.exists(os.path.join(path, "index")):
+        shutil.rmtree(os.path.join(path, "index"))
+    if precision != "float32":
+        write_quantized_index(npy_path, os.path.join(path, "index"), precision)
+    elif n_chunks >= min_ivf_chunks:
+        write_ivf_index(npy_path, os.path.join(path, "index"))
+    print(f"{n_chunks} chunks from {n_articles} articles written to {path}")
+
+
+if __name__ == "__main__":
+    build_knowledge_base(read_dataset("data/ws_dataset"))
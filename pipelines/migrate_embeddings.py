@@ -0,0 +1,53 @@
+import os
+import sys
+import sqlite3
+import logging
+
+sys.path.append("/home/tommaso/Repositories/teleRAG/")
+
+from bot.sqlutils import blob_to_embedding, embedding_to_blob
+
+os.chdir("/home/tommaso/Repositories/teleRAG/")
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+
+def migrate_embeddings(db_path: str = 'data/actions.db') -> int:
+    """
+    One-shot migration of the 'embeddings' table from stringified Python lists (TEXT) to float32 BLOBs.
+    The table is rebuilt with a BLOB column in a single transaction. Returns the number of converted rows.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("SELECT id, embedding FROM embeddings;").fetchall()
+        dims = set()
+        converted = []
+        for row_id, embedding in rows:
+            vector = blob_to_embedding(embedding)
+            dims.add(len(vector))
+            converted.append((row_id, embedding_to_blob(vector)))
+        if len(dims) > 1:
+            raise ValueError(f"Embeddings with different dimensions found: {sorted(dims)}")
+        with conn:
+            conn.execute("""CREATE TABLE embeddings_blob
+                            (
+                                id        integer
+                                    constraint embeddings_pk
+                                        primary key,
+                                embedding BLOB
+                            );""")
+            conn.executemany("INSERT INTO embeddings_blob (id, embedding) VALUES (?, ?);", converted)
+            conn.execute("DROP TABLE embeddings;")
+            conn.execute("ALTER TABLE embeddings_blob RENAME TO embeddings;")
+        conn.execute("VACUUM;")
+        logging.info(f"{len(converted)} embeddings converted to float32 BLOBs (dim={dims.pop() if dims else None})")
+        return len(converted)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    migrate_embeddings(sys.argv[1] if len(sys.argv) > 1 else 'data/actions.db')
@@ -1,12 +1,25 @@
-import time
 import os
+import time
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 from trafilatura.sitemaps import sitemap_search
-from trafilatura import fetch_url, extract, extract_metadata
+from trafilatura import extract, extract_metadata
+
+from pipelines.fetcher import Checkpoint, Fetcher, interleave
 
 os.chdir("/home/tommaso/Repositories/teleRAG/")
 
+SCHEMA = pa.schema([("url", pa.string()), ("body", pa.string()), ("title", pa.string()), ("description", pa.string())])
+
+
 def get_urls_from_sitemap(resource_url: str) -> list:
     """
     Funzione che recupera la sitemap attraverso Trafilatura
@@ -15,36 +28,173 @@ def get_urls_from_sitemap(resource_url: str) -> list:
     return urls
 
 
-def create_dataset(list_of_websites: list) -> pd.DataFrame:
-    """
-    Funzione che crea un DataFrame Pandas di URL e articoli.
-    """
-    data = []
-    for website in tqdm(list_of_websites, desc="Websites"):
-        urls = get_urls_from_sitemap(website)
-        for url in tqdm(urls, desc="URLs"):
-            html = fetch_url(url)
-            body = extract(html)
-            try:
-                metadata = extract_metadata(html)
-                title = metadata.title
-                description = metadata.description
-            except:
-                title = ""
-                description = ""
-            d = {
-                'url': url,
-                "body": body,
-                "title": title,
-                "description": description
-            }
-            data.append(d)
-            time.sleep(0.5)
-    df = pd.DataFrame(data)
-    df = df.drop_duplicates()
-    df = df.dropna()
-
-    return df
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """
+    SimHash a 64 bit (intero con segno, come in SQLite) degli shingle di parole del testo: testi quasi uguali hanno
+    fingerprint che differiscono in pochi bit.
+    """
+    words = text.lower().split()
+    shingles = [" ".join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))]
+    hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "little") for shingle in shingles], dtype=np.uint64)
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - len(hashes)
+    fingerprint = int(np.packbits(votes > 0, bitorder="little").view("<u8")[0])
+    return fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+
+
+def parse_article(url: str, html: str) -> dict | None:
+    """
+    Funzione che estrae corpo, titolo e descrizione di un articolo, con le fingerprint del corpo (None se la pagina non
+    ha un corpo). Eseguita in un processo separato: il parsing è CPU-bound.
+    """
+    body = extract(html)
+    if body is None:
+        return None
+    try:
+        metadata = extract_metadata(html)
+        title = metadata.title
+        description = metadata.description
+    except:
+        title = ""
+        description = ""
+    return {
+        'url': url,
+        "body": body,
+        "title": title,
+        "description": description,
+        "content_hash": hashlib.sha1(" ".join(body.split()).encode()).hexdigest(),
+        "simhash": simhash(body)
+    }
+
+
+class ArticleWriter:
+    """
+    Ultimo stadio della pipeline: scarta i duplicati e scrive gli articoli in Parquet, a blocchi di 'chunk_size' righe.
+
+    Ogni blocco è un file Parquet completo 'part-<timestamp>-<blocco>.parquet' nella cartella 'path', scritto in un file
+    temporaneo e rinominato quando è chiuso. Le pagine e le fingerprint (con il file che contiene l'articolo) sono
+    registrate nel checkpoint solo dopo: un crash, anche un kill -9, perde solo il blocco non ancora scritto, le cui
+    pagine saranno scaricate di nuovo. Gli articoli senza titolo o descrizione sono scartati e contati in 'incomplete'.
+    """
+    def __init__(self, path: str, checkpoint: Checkpoint, chunk_size: int = 500):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size
+        self.written = 0
+        self.duplicates = 0
+        self.incomplete = 0
+        self._rows = []
+        self._run = time.time_ns()
+        self._chunks = 0
+
+    @property
+    def part(self) -> str:
+        """Il file del blocco in memoria."""
+        return f"part-{self._run}-{self._chunks:06d}.parquet"
+
+    def add(self, page: dict, article: dict | None):
+        if article is not None and (article["title"] is None or article["description"] is None):
+            logging.debug(f"{article['url']} skipped: no {'title' if article['title'] is None else 'description'}")
+            self.incomplete += 1
+        elif article is not None:
+            if self.checkpoint.is_duplicate(article["url"], article["content_hash"], article["simhash"]):
+                self.duplicates += 1
+            else:
+                self.checkpoint.add_fingerprint(article["url"], article["content_hash"], article["simhash"], self.part)
+                self._rows.append({column: article[column] for column in SCHEMA.names})
+        self.checkpoint.done(page["url"], page["status"], page["etag"], page["last_modified"])
+        if len(self._rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            # Il file ha il suo footer prima che il checkpoint registri le pagine: i .tmp di un crash non sono letti
+            path = os.path.join(self.path, self.part)
+            pq.write_table(pa.Table.from_pylist(self._rows, schema=SCHEMA), path + ".tmp")
+            os.replace(path + ".tmp", path)
+            self.written += len(self._rows)
+            self._rows = []
+            self._chunks += 1
+        self.checkpoint.commit()
+
+    def close(self):
+        self.flush()
+
+
+async def crawl_websites(list_of_websites: list, checkpoint: Checkpoint, fetcher: Fetcher, writer: ArticleWriter, refresh: bool = False, processes: int | None = None):
+    """
+    Funzione che scarica gli articoli di tutti i siti in streaming: fetch -> estrazione (pool di processi) -> dedupe -> scrittura.
+
+    Ogni worker del fetcher attende l'estrazione della sua pagina prima di prenderne un'altra, quindi in memoria ci sono
+    al più 'fetcher.max_workers' pagine, più il blocco in scrittura.
+    """
+    sitemaps = await asyncio.gather(*(asyncio.to_thread(get_urls_from_sitemap, website) for website in list_of_websites))
+    requests = checkpoint.pending(interleave([list(urls) for urls in sitemaps]), refresh=refresh)
+    logging.info(f"{len(requests)} URLs to fetch")
+    progress = tqdm(total=len(requests), desc="URLs")
+    loop = asyncio.get_running_loop()
+
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+        async def on_page(page: dict):
+            article = None
+            if page["html"] is not None:
+                article = await loop.run_in_executor(pool, parse_article, page["url"], page["html"])
+            writer.add(page, article)
+            progress.update(1)
+
+        await fetcher.crawl(requests, on_page)
+    progress.close()
+
+
+def create_dataset(list_of_websites: list, path: str = "data/ws_dataset", checkpoint_path: str = "data/ws_checkpoint.db", refresh: bool = False,
+                   fetcher: Fetcher | None = None) -> int:
+    """
+    Funzione che scarica gli articoli dei siti nel dataset Parquet 'path', restituendo il numero di articoli scritti.
+
+    Le pagine già scaricate sono registrate nel checkpoint: una nuova esecuzione riprende da dove si era fermata.
+    Con 'refresh', le pagine già scaricate sono richieste di nuovo in modo condizionale (ETag/Last-Modified).
+    """
+    checkpoint = Checkpoint(checkpoint_path)
+    writer = ArticleWriter(path, checkpoint)
+    try:
+        asyncio.run(crawl_websites(list_of_websites, checkpoint, fetcher if fetcher is not None else Fetcher(), writer, refresh=refresh))
+    finally:
+        writer.close()
+        checkpoint.close()
+    logging.info(f"{writer.written} articles written to {writer.path}, {writer.duplicates} duplicates and {writer.incomplete} articles without title or description skipped")
+    return writer.written
+
+
+def read_dataset(path: str = "data/ws_dataset", batch_size: int = 1000, checkpoint_path: str = "data/ws_checkpoint.db"):
+    """
+    Funzione che legge gli articoli del dataset Parquet a blocchi, come dizionari (url, body, title, description).
+
+    Di un articolo aggiornato da un refresh si legge solo l'ultima versione: il checkpoint registra il file che la
+    contiene, e viene interrogato per ogni blocco, quindi la memoria non cresce con il corpus. Senza checkpoint (o per
+    gli articoli scritti prima che il file fosse registrato) si leggono tutte le versioni.
+    """
+    files = sorted((os.path.join(path, file) for file in os.listdir(path) if file.endswith(".parquet")), reverse=True)
+    checkpoint = Checkpoint(checkpoint_path) if os.path.exists(checkpoint_path) else None
+    try:
+        for file in files:
+            part = os.path.basename(file)
+            for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size):
+                articles = batch.to_pylist()
+                latest = checkpoint.parts([article["url"] for article in articles]) if checkpoint is not None else {}
+                for article in articles:
+                    if latest.get(article["url"], part) == part:
+                        yield article
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+def load_dataset(path: str = "data/ws_dataset", checkpoint_path: str = "data/ws_checkpoint.db") -> pd.DataFrame:
+    """
+    Funzione che carica l'intero dataset Parquet in un DataFrame Pandas.
+    """
+    return pd.DataFrame(list(read_dataset(path, checkpoint_path=checkpoint_path)), columns=SCHEMA.names)
 
 
 if __name__ == "__main__":
@@ -52,5 +202,4 @@ if __name__ == "__main__":
         "https://cats.com/",
         "https://en.wikipedia.org/wiki/Cat"
     ]
-    df = create_dataset(list_of_websites)
-    df.to_csv("./data/ws_dataset.csv", index=False)
+    create_dataset(list_of_websites)
@@ -0,0 +1,129 @@
+import time
+import queue
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import Future
+
+
+class BatchStats:
+    """Batch-size statistics of a MicroBatcher."""
+    def __init__(self):
+        self.batches = 0
+        self.items = 0
+        self.sizes = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, size: int):
+        with self._lock:
+            self.batches += 1
+            self.items += size
+            self.sizes[size] += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {"batches": self.batches,
+                    "items": self.items,
+                    "mean_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+                    "max_batch_size": max(self.sizes) if self.sizes else 0,
+                    "histogram": dict(sorted(self.sizes.items()))}
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into batches processed by a single call.
+
+    Requests are submitted from any thread and queued. A worker thread collects them until either 'max_batch_size'
+    requests are pending or 'max_wait_ms' milliseconds have passed since the first one arrived, then runs
+    'batch_function' once on the whole batch and hands each result back to its caller through a Future.
+
+    Attributes
+    ----------
+    batch_function : callable
+        function mapping a list of requests to the list of their results (same order)
+    max_batch_size : int
+        maximum number of requests processed together
+    max_wait_ms : float
+        maximum time a request waits for other requests to join its batch
+    stats : BatchStats
+        batch-size statistics
+    """
+    def __init__(self, batch_function, max_batch_size: int = 8, max_wait_ms: float = 10.0, name: str = "MicroBatcher", log_every: int = 100):
+        """
+        Parameters
+        ----------
+        batch_function : callable
+            function mapping a list of requests to the list of their results (same order)
+        max_batch_size : int
+            maximum number of requests processed together
+        max_wait_ms : float
+            maximum time a request waits for other requests to join its batch
+        name : str
+            name of the worker thread, used in logs
+        log_every : int
+            log the batch-size statistics every 'log_every' batches (0 to disable)
+        """
+        self.batch_function = batch_function
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.name = name
+        self.log_every = log_every
+        self.stats = BatchStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run_, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, request) -> Future:
+        """Queue a request, return the Future of its result."""
+        future = Future()
+        self._queue.put((request, future))
+        return future
+
+    def __call__(self, request):
+        """Submit a request and wait for its result."""
+        return self.submit(request).result()
+
+    def close(self):
+        """Process the pending requests, then stop the worker thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _collect_(self, first) -> tuple[list, bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                job = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                return batch, True
+            batch.append(job)
+        return batch, False
+
+    def _run_(self):
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stop = self._collect_(first)
+            batch = [(request, future) for request, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = list(self.batch_function([request for request, _ in batch]))
+                if len(results) != len(batch):
+                    raise ValueError(f"{len(results)} results returned for {len(batch)} requests")
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                logging.error(f"{self.name}: batch of {len(batch)} failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.stats.record(len(batch))
+            if self.log_every and self.stats.batches % self.log_every == 0:
+                logging.info(f"{self.name} batch statistics: {self.stats.summary()}")
@@ -0,0 +1,60 @@
+import argparse
+import time
+
+import torch
+
+from scripts.llm.scoring import confidence_stats
+
+
+def loop_confidence(scores, ids, row=0) -> torch.Tensor:
+    """The former LLM.__get_confidence__: one exp over the vocabulary and one sum per generated step, in Python."""
+    normalized_logits_per_step = [torch.exp(scores[i][row][index]) / torch.sum(torch.exp(scores[i][row])) for i, index in enumerate(ids[row])]
+    return torch.Tensor(normalized_logits_per_step).mean()
+
+
+def synchronize(device: str):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def timed(function, device: str, repeats: int) -> float:
+    """Median milliseconds of 'function()'."""
+    function()  # warmup
+    times = []
+    for _ in range(repeats):
+        synchronize(device)
+        start = time.perf_counter()
+        function()
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+def main(batch_size: int, steps: int, vocabulary: int, device: str, repeats: int, scale: float):
+    generator = torch.Generator().manual_seed(0)
+    logits = torch.randn(batch_size, steps, vocabulary, generator=generator) * scale
+    ids = logits.argmax(dim=-1).to(device)
+    scores = tuple(logits[:, step].to(device) for step in range(steps))
+    loop = timed(lambda: [loop_confidence(scores, ids, row).item() for row in range(batch_size)], device, repeats)
+    vectorized = timed(lambda: confidence_stats(scores, ids), device, repeats)
+    expected = torch.tensor([loop_confidence(scores, ids, row).item() for row in range(batch_size)])
+    actual = torch.tensor([row["mean"] for row in confidence_stats(scores, ids)])
+    print(f"batch {batch_size}, {steps} steps, vocabulary {vocabulary}, logit scale {scale}, {device}")
+    print(f"{'loop':<12}{loop:>10.2f} ms")
+    print(f"{'vectorized':<12}{vectorized:>10.2f} ms  ({loop / vectorized:.1f}x)")
+    if torch.isfinite(expected).all():
+        print(f"max difference of the mean probability: {(expected - actual).abs().max().item():.2e}")
+    else:
+        print(f"loop: {int((~torch.isfinite(expected)).sum())}/{batch_size} rows overflow to nan/inf, vectorized: all finite = {bool(torch.isfinite(actual).all())}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vectorized log-softmax confidence scoring against the former per-step loop")
+    parser.add_argument("--batch", type=int, default=8, help="number of generated sequences")
+    parser.add_argument("--steps", type=int, default=100, help="generated tokens per sequence (LLM max_new_tokens)")
+    parser.add_argument("--vocabulary", type=int, default=32000, help="vocabulary size (Mistral: 32000)")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeats", type=int, default=5, help="number of timed runs")
+    parser.add_argument("--scale", type=float, default=5.0, help="standard deviation of the logits (about 25 or more makes exp overflow in float32)")
+    args = parser.parse_args()
+    main(args.batch, args.steps, args.vocabulary, args.device, args.repeats, args.scale)
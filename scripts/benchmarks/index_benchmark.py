@@ -0,0 +1,55 @@
+import argparse
+import time
+
+import numpy as np
+
+from scripts.embedder.index import EmbeddingIndex, IVFIndex
+
+
+def synthetic_embeddings(n: int, dim: int = 384, n_topics: int = 1000, spread: float = 1.5, seed: int = 0) -> np.ndarray:
+    """Clustered random vectors (a mixture of 'n_topics' Gaussians), closer to sentence embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((n_topics, dim)).astype(np.float32)
+    vectors = topics[rng.integers(n_topics, size=n)]
+    return vectors + spread * rng.standard_normal((n, dim)).astype(np.float32)
+
+
+def measure(index, queries: np.ndarray, top_k: int, **kwargs) -> tuple[list[list], float]:
+    """Return the ids retrieved for each query and the queries per second."""
+    start = time.perf_counter()
+    results = [[entry_id for entry_id, _ in index.search(query, top_k=top_k, **kwargs)] for query in queries]
+    return results, len(queries) / (time.perf_counter() - start)
+
+
+def recall(results: list[list], truth: list[list]) -> float:
+    return float(np.mean([len(set(result) & set(expected)) / len(expected) for result, expected in zip(results, truth)]))
+
+
+def main(n: int, dim: int, n_queries: int, top_k: int, n_lists: int | None, spread: float):
+    vectors = synthetic_embeddings(n + n_queries, dim=dim, spread=spread)
+    vectors, queries = vectors[:n], vectors[n:]
+    exact = EmbeddingIndex(vectors)
+    truth, exact_qps = measure(exact, queries, top_k)
+    print(f"{n} vectors, dim {dim}, {n_queries} queries, recall@{top_k}")
+    print(f"{'backend':<10}{'nprobe':>8}{'recall':>10}{'QPS':>12}{'ms/query':>10}")
+    print(f"{'exact':<10}{'-':>8}{1.0:>10.3f}{exact_qps:>12.1f}{1000 / exact_qps:>10.2f}")
+    start = time.perf_counter()
+    ivf = IVFIndex.build(vectors, n_lists=n_lists)
+    print(f"(IVF index with {ivf.n_lists} lists built in {time.perf_counter() - start:.1f}s)")
+    nprobe = 1
+    while nprobe <= ivf.n_lists:
+        results, qps = measure(ivf, queries, top_k, nprobe=nprobe)
+        print(f"{'ivf':<10}{nprobe:>8}{recall(results, truth):>10.3f}{qps:>12.1f}{1000 / qps:>10.2f}")
+        nprobe *= 2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall@k and QPS of the approximate vector index against the exact baseline")
+    parser.add_argument("-n", type=int, default=100000, help="number of indexed vectors")
+    parser.add_argument("--dim", type=int, default=384, help="vector dimension (384 for MiniLM)")
+    parser.add_argument("--queries", type=int, default=500, help="number of queries")
+    parser.add_argument("-k", type=int, default=10, help="k of recall@k")
+    parser.add_argument("--lists", type=int, default=None, help="number of IVF lists (default: 2 * sqrt(n))")
+    parser.add_argument("--spread", type=float, default=1.5, help="noise around the topic centers (higher is harder)")
+    args = parser.parse_args()
+    main(args.n, args.dim, args.queries, args.k, args.lists, args.spread)
@@ -0,0 +1,56 @@
+import argparse
+import time
+
+import torch
+from transformers import AutoTokenizer, GenerationConfig
+
+from scripts.llm.backends import CPUBackend
+
+PROMPT = "The cat is a small domesticated carnivorous mammal. Write a short paragraph about the history of cats living with humans."
+
+
+def measure(model, tokenizer, backend: CPUBackend, new_tokens: int, repeats: int) -> dict:
+    """Median prefill time (first token) and decode throughput of greedy generation of exactly 'new_tokens' tokens."""
+    inputs = tokenizer(PROMPT, return_tensors="pt").to(model.device)
+    first_token = GenerationConfig(do_sample=False, max_new_tokens=1, min_new_tokens=1, pad_token_id=tokenizer.eos_token_id)
+    full = GenerationConfig(do_sample=False, max_new_tokens=new_tokens, min_new_tokens=new_tokens, pad_token_id=tokenizer.eos_token_id)
+    prefill, total = [], []
+    with torch.no_grad(), backend.attention():
+        model.generate(**inputs, generation_config=first_token)  # warmup
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model.generate(**inputs, generation_config=first_token)
+            prefill.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            model.generate(**inputs, generation_config=full)
+            total.append(time.perf_counter() - start)
+    prefill, total = sorted(prefill)[len(prefill) // 2], sorted(total)[len(total) // 2]
+    return {"prompt_tokens": inputs["input_ids"].shape[1],
+            "prefill_ms": prefill * 1000,
+            "tokens_per_second": (new_tokens - 1) / max(total - prefill, 1e-9)}
+
+
+def main(checkpoint: str, precisions: list[str], threads: list[int], new_tokens: int, repeats: int):
+    tokenizer = AutoTokenizer.from_pretrained(checkpoint, cache_dir="./models/cache")
+    print(f"{checkpoint}, greedy generation of {new_tokens} tokens, median of {repeats} runs")
+    print(f"{'precision':<10}{'threads':>8}{'MB':>10}{'prefill ms':>12}{'tokens/s':>10}")
+    for precision in precisions:
+        for n_threads in threads:
+            backend = CPUBackend(precision=precision, threads=n_threads)
+            model = backend.load(checkpoint, cache_dir="./models/cache")
+            megabytes = sum(tensor.nelement() * tensor.element_size() for tensor in model.state_dict().values()
+                            if isinstance(tensor, torch.Tensor)) / 1024 ** 2
+            result = measure(model, tokenizer, backend, new_tokens, repeats)
+            print(f"{precision:<10}{n_threads:>8}{megabytes:>10.0f}{result['prefill_ms']:>12.1f}{result['tokens_per_second']:>10.1f}")
+            del model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokens/sec of the CPU generation backend, per precision and number of threads")
+    parser.add_argument("--model", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0", help="small causal LM (local path or hub id)")
+    parser.add_argument("--precisions", nargs="+", default=["float32", "int8"], choices=CPUBackend.PRECISIONS, help="CPU precisions to compare")
+    parser.add_argument("--threads", type=int, nargs="+", default=[torch.get_num_threads()], help="numbers of matmul threads to compare")
+    parser.add_argument("--tokens", type=int, default=64, help="number of generated tokens")
+    parser.add_argument("--repeats", type=int, default=3, help="number of timed runs")
+    args = parser.parse_args()
+    main(args.model, args.precisions, args.threads, args.tokens, args.repeats)
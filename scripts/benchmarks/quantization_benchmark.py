@@ -0,0 +1,50 @@
+import argparse
+import os
+
+import numpy as np
+
+from scripts.benchmarks.index_benchmark import synthetic_embeddings, recall
+from scripts.embedder.index import EmbeddingIndex, QuantizedIndex, l2_normalize
+
+
+def load_embeddings(path: str, n: int) -> tuple[np.ndarray, str]:
+    """Our chunk embeddings (data/kb/embeddings.npy) if the knowledge base was built, synthetic MiniLM-sized ones otherwise."""
+    if os.path.exists(path):
+        return np.asarray(np.load(path, mmap_mode="r")[:n]), path
+    return l2_normalize(synthetic_embeddings(n)), "synthetic"
+
+
+def main(path: str, n: int, n_queries: int, top_k: int, thresholds: list[float]):
+    embeddings, source = load_embeddings(path, n + n_queries)
+    # Held-out embeddings are used as queries, so that they are not trivially found in the index
+    rows = np.random.default_rng(0).permutation(len(embeddings))
+    vectors, queries = embeddings[np.sort(rows[n_queries:])], embeddings[rows[:n_queries]]
+    exact = EmbeddingIndex(vectors)
+    truth = [exact.search(query, top_k=top_k) for query in queries]
+    print(f"{len(vectors)} vectors ({source}), dim {vectors.shape[1]}, {len(queries)} queries, recall@{top_k}")
+    print(f"{'precision':<10}{'rescore':>8}{'MB':>10}{'reduction':>11}{'recall':>9}{'top-1 error':>13}" + "".join(f"{'agree@' + str(t):>12}" for t in thresholds))
+    print(f"{'float32':<10}{'-':>8}{exact.matrix.nbytes / 1024 ** 2:>10.1f}{1:>10.0f}x{1.0:>9.3f}{0.0:>13.4f}" + "".join(f"{1.0:>12.3f}" for _ in thresholds))
+    for precision in ("int8", "binary"):
+        for rescore in (True, False):
+            index = QuantizedIndex(vectors, precision=precision, keep_vectors=rescore, normalized=True)
+            results = [index.search(query, top_k=top_k) for query in queries]
+            # Resident memory: with rescoring, the float vectors are memory-mapped in production, so only the codes count
+            megabytes = (index.codes.nbytes + index.ids.nbytes) / 1024 ** 2
+            error = np.mean([abs(result[0][1] - expected[0][1]) for result, expected in zip(results, truth)])
+            # Agreement of the threshold decision on the best result with the one on exact similarities
+            agreements = [np.mean([(result[0][1] >= threshold) == (expected[0][1] >= threshold) for result, expected in zip(results, truth)])
+                          for threshold in thresholds]
+            print(f"{precision:<10}{str(rescore):>8}{megabytes:>10.1f}{exact.matrix.nbytes / 1024 ** 2 / megabytes:>10.1f}x"
+                  f"{recall([[i for i, _ in r] for r in results], [[i for i, _ in e] for e in truth]):>9.3f}{error:>13.4f}"
+                  + "".join(f"{agreement:>12.3f}" for agreement in agreements))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory reduction and recall loss of int8/binary quantization against float32")
+    parser.add_argument("--embeddings", default="data/kb/embeddings.npy", help="embeddings to quantize (synthetic if missing)")
+    parser.add_argument("-n", type=int, default=100000, help="maximum number of indexed vectors")
+    parser.add_argument("--queries", type=int, default=500, help="number of held-out queries")
+    parser.add_argument("-k", type=int, default=10, help="k of recall@k")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.45, 0.6], help="similarity thresholds to check (KB_THRESHOLD, ACTIONS_THRESHOLD)")
+    args = parser.parse_args()
+    main(args.embeddings, args.n, args.queries, args.k, args.thresholds)
@@ -1,23 +1,84 @@
+import numpy as np
 from torch import Tensor
 from transformers import AutoTokenizer, AutoModel
 import torch
 import os
 from sentence_transformers import SentenceTransformer
 
+from scripts.batching import MicroBatcher
+from scripts.embedder.cache import EmbeddingCache
+from scripts.embedder.index import EmbeddingIndex, VectorIndex
+
 os.chdir("//")
 
 
 class SentenceEmbedder:
-    def __init__(self, model_path='paraphrase-MiniLM-L6-v2', semantic_threshold=0.5):
+    def __init__(self, model_path='paraphrase-MiniLM-L6-v2', semantic_threshold=0.5, cache_size=10000, cache_bytes=64 * 1024 ** 2, lowercase=False):
+        self.model_path = model_path
         self.model = SentenceTransformer(model_path, cache_folder="./models/cache")
+        # Memoize the embeddings of repeated texts ("hi", "thanks", "ok", ...). Set cache_size=0 to disable
+        self.cache = EmbeddingCache(max_entries=cache_size, max_bytes=cache_bytes) if cache_size > 0 else None
+        # Only enable with uncased models, where lowercasing the text doesn't change its embedding
+        self.lowercase = lowercase
+        self.batcher = None
+
+    def __normalize__(self, sentence: str) -> str:
+        sentence = " ".join(sentence.split())
+        return sentence.lower() if self.lowercase else sentence
+
+    def enable_batching(self, max_batch_size=32, max_wait_ms=5.0):
+        """Coalesce concurrent single-sentence encode calls (e.g., from different chats) into batched forward passes."""
+        if self.batcher is not None:
+            self.batcher.close()
+        self.batcher = MicroBatcher(self.__encode_batch__, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, name="EmbedderBatcher")
+
+    def warmup(self):
+        """Embed a few sentences, bypassing the cache, so that the first user messages don't pay for the first forward passes."""
+        self.model.encode(["Hi!", "What can you do for me?"])
 
     def encode(self, sentences):
-        return self.model.encode(sentences)
+        """Embed a sentence (1D array) or a list of sentences (2D array), only running the model on the sentences not cached yet.
+
+        When batching is enabled, the model call for a single sentence is shared with the concurrent calls of other threads.
+        """
+        single = isinstance(sentences, str)
+        sentences = [self.__normalize__(sentence) for sentence in ([sentences] if single else sentences)]
+        if not sentences:
+            return self.model.encode(sentences)
+        if self.cache is not None:
+            embeddings = [self.cache.get((self.model_path, sentence)) for sentence in sentences]
+        else:
+            embeddings = [None] * len(sentences)
+        # Run the model once per distinct missing sentence, then merge the results back in order
+        missing = list(dict.fromkeys(sentence for sentence, embedding in zip(sentences, embeddings) if embedding is None))
+        if missing:
+            if single and self.batcher is not None:
+                computed = {missing[0]: self.batcher(missing[0])}
+            else:
+                computed = self.__compute__(missing)
+            embeddings = [computed[sentence] if embedding is None else embedding for sentence, embedding in zip(sentences, embeddings)]
+        return embeddings[0] if single else np.stack(embeddings)
+
+    def __compute__(self, sentences: list[str]) -> dict:
+        computed = dict(zip(sentences, self.model.encode(sentences)))
+        if self.cache is not None:
+            for sentence, embedding in computed.items():
+                self.cache.put((self.model_path, sentence), embedding)
+        return computed
+
+    def __encode_batch__(self, sentences: list[str]) -> list:
+        computed = self.__compute__(list(dict.fromkeys(sentences)))
+        return [computed[sentence] for sentence in sentences]
+
+    def semantic_search(self, target, references, top_k=1) -> list[tuple]:
+        """Return the 'top_k' references most similar to the target as (id, similarity) pairs.
 
-    def semantic_search(self, target, references):
-        similarities = self.__cosine_similarity__(torch.tensor(target), torch.tensor(references))
-        val, ind = torch.max(similarities, dim=-1)
-        return float(val), int(ind)
+        References should be a prebuilt VectorIndex (exact or approximate): building one on the fly normalizes every
+        reference at each call. Raw embeddings are indexed exactly, their ids being their row numbers.
+        """
+        if not isinstance(references, VectorIndex):
+            references = EmbeddingIndex(references)
+        return references.search(target, top_k=top_k)
 
     def __cosine_similarity__(self, x1: torch.Tensor, x2: torch.Tensor) -> Tensor:
         return torch.nn.functional.cosine_similarity(x1, x2, dim=-1)
@@ -0,0 +1,487 @@
+import os
+import json
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from scripts.embedder.quantization import QUANTIZERS
+
+
+def l2_normalize(vectors: np.ndarray) -> np.ndarray:
+    """Return a float32 copy of 'vectors' scaled to unit L2 norm along the last axis (zero vectors are left as they are)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _top_k_(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Positions of the 'top_k' highest scores, sorted by decreasing score."""
+    top_k = min(top_k, len(scores))
+    if top_k < len(scores):
+        positions = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        positions = np.arange(len(scores))
+    return positions[np.argsort(-scores[positions], kind="stable")]
+
+
+class VectorIndex(ABC):
+    """
+    Interface of the cosine similarity indexes behind SentenceEmbedder.semantic_search.
+
+    Entries are identified by an id (int or str) and optionally carry a name. Backends store L2-normalized float32
+    vectors, support incremental add/remove, and are saved to (and loaded from) a directory holding a 'meta.json' file
+    plus the .npy arrays of the backend. Arrays are loaded memory-mapped on request.
+    Backends must implement every abstract method, otherwise they can't be instantiated.
+
+    Attributes
+    ----------
+    dim : int
+        the dimension of the indexed embeddings
+    """
+    backend = None
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._names = {}  # id -> name, only for the entries added with a name
+
+    @abstractmethod
+    def __len__(self):
+        """Number of indexed entries."""
+
+    @abstractmethod
+    def add(self, embeddings, ids, names=None):
+        """Add the (n, dim) embeddings with their ids (and names), replacing the entries with the same ids."""
+
+    @abstractmethod
+    def remove(self, ids):
+        """Remove the entries with the given ids (unknown ids are ignored)."""
+
+    @abstractmethod
+    def search(self, query, top_k: int = 1) -> list[tuple]:
+        """Return the 'top_k' most similar entries as (id, similarity) pairs, sorted by decreasing similarity."""
+
+    @abstractmethod
+    def similarities(self, query, ids) -> dict:
+        """Return the similarity of the query with each of the given entries, by id (unknown ids are left out)."""
+
+    def name(self, entry_id):
+        """Return the name of an entry (its id if it has no name)."""
+        return self._names.get(entry_id, entry_id)
+
+    def _add_names_(self, ids, names):
+        if names is not None:
+            self._names.update(zip(np.asarray(ids).tolist(), names))
+
+    def _remove_names_(self, ids):
+        for entry_id in np.asarray(ids).tolist():
+            self._names.pop(entry_id, None)
+
+    def _params_(self) -> dict:
+        return {}
+
+    @abstractmethod
+    def _arrays_(self) -> dict:
+        """Arrays saved as '<name>.npy' files, by name."""
+
+    def save(self, path: str):
+        """Save the index to the directory 'path'."""
+        os.makedirs(path, exist_ok=True)
+        for name, array in self._arrays_().items():
+            np.save(os.path.join(path, f"{name}.npy"), array, allow_pickle=False)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"backend": self.backend, "dim": self.dim, "params": self._params_(),
+                       "names": [[entry_id, name] for entry_id, name in self._names.items()]}, f)
+
+    @classmethod
+    @abstractmethod
+    def _from_arrays_(cls, dim: int, arrays: dict, params: dict):
+        """Rebuild the index from the arrays returned by '_arrays_' and the parameters returned by '_params_'."""
+
+
+def load_index(path: str, mmap: bool = False) -> VectorIndex:
+    """Load an index saved with VectorIndex.save, memory-mapping its arrays if 'mmap'."""
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    cls = BACKENDS[meta["backend"]]
+    arrays = {file[:-len(".npy")]: np.load(os.path.join(path, file), mmap_mode="r" if mmap else None)
+              for file in os.listdir(path) if file.endswith(".npy")}
+    index = cls._from_arrays_(meta["dim"], arrays, meta["params"])
+    index._names = {entry_id: name for entry_id, name in meta["names"]}
+    return index
+
+
+class EmbeddingIndex(VectorIndex):
+    """
+    In-memory index of embeddings used for exact cosine similarity search.
+
+    Embeddings are stored once as a contiguous, pre-L2-normalized float32 matrix, so that scoring a query against
+    the whole index reduces to a single matrix-vector dot product. An id side array maps rows back to entries.
+
+    Attributes
+    ----------
+    matrix : np.ndarray
+        the (n, dim) float32 matrix of normalized embeddings
+    ids : np.ndarray
+        the id of the entry stored at each row
+    """
+    backend = "exact"
+
+    def __init__(self, embeddings, ids=None, names=None, normalized=False):
+        """
+        Parameters
+        ----------
+        embeddings : array-like
+            the (n, dim) embeddings to index
+        ids : array-like, optional
+            the id of each embedding (defaults to the row number)
+        names : array-like, optional
+            the name of each embedding (defaults to the id)
+        normalized : bool
+            whether the embeddings are already a normalized float32 matrix, used as is without copying it (e.g., a
+            memory-mapped .npy file)
+        """
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2:
+            raise ValueError(f"Expected a 2D matrix of embeddings, got shape {matrix.shape}")
+        super().__init__(matrix.shape[1])
+        self.matrix = matrix if normalized else np.ascontiguousarray(l2_normalize(matrix))
+        self.ids = np.arange(len(matrix)) if ids is None else np.asarray(ids)
+        if len(self.ids) != len(self.matrix) or (names is not None and len(names) != len(self.matrix)):
+            raise ValueError("Embeddings, ids and names must have the same length")
+        self._add_names_(self.ids, names)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def scores(self, query) -> np.ndarray:
+        """Cosine similarity between the query and every row of the index."""
+        return self.matrix @ l2_normalize(np.ravel(query))
+
+    def search(self, query, top_k: int = 1) -> list[tuple]:
+        if len(self) == 0 or top_k <= 0:
+            return []
+        scores = self.scores(query)
+        rows = _top_k_(scores, top_k)
+        return list(zip(self.ids[rows].tolist(), scores[rows].tolist()))
+
+    def similarities(self, query, ids) -> dict:
+        rows = np.flatnonzero(np.isin(self.ids, np.asarray(ids)))
+        return dict(zip(self.ids[rows].tolist(), (self.matrix[rows] @ l2_normalize(np.ravel(query))).tolist()))
+
+    def add(self, embeddings, ids, names=None):
+        embeddings = l2_normalize(np.atleast_2d(embeddings))
+        ids = np.asarray(ids)
+        self.remove(ids)
+        self.matrix = np.concatenate([self.matrix, embeddings])
+        self.ids = np.concatenate([self.ids, ids])
+        self._add_names_(ids, names)
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, np.asarray(ids))
+        if not keep.all():
+            self.matrix, self.ids = self.matrix[keep], self.ids[keep]
+        self._remove_names_(ids)
+
+    def _arrays_(self) -> dict:
+        return {"matrix": self.matrix, "ids": self.ids}
+
+    @classmethod
+    def _from_arrays_(cls, dim: int, arrays: dict, params: dict):
+        return cls(arrays["matrix"], ids=arrays["ids"], normalized=True)
+
+
+class IVFIndex(VectorIndex):
+    """
+    Inverted file index for approximate cosine similarity search.
+
+    The embedding space is partitioned into 'n_lists' cells by spherical k-means. Each embedding is stored in the list of
+    its nearest centroid, and a query only scores the embeddings of the 'nprobe' lists whose centroids are the most
+    similar to it. 'nprobe' is the recall-vs-latency knob: nprobe=n_lists is an exact (but slower) search.
+    The index must be trained (see 'build' and 'train') before embeddings are added; added embeddings are assigned to the
+    existing centroids, so retrain when the distribution of the data changes a lot.
+
+    Attributes
+    ----------
+    n_lists : int
+        number of cells (inverted lists)
+    nprobe : int
+        number of lists scanned by each query
+    centroids : np.ndarray | None
+        the (n_lists, dim) normalized centroids (None until trained)
+    """
+    backend = "ivf"
+
+    def __init__(self, dim: int, n_lists: int = 256, nprobe: int = 8):
+        """
+        Parameters
+        ----------
+        dim : int
+            the dimension of the indexed embeddings
+        n_lists : int
+            number of cells (inverted lists), sqrt(n) to 4 * sqrt(n) for n embeddings is a sensible choice
+        nprobe : int
+            number of lists scanned by each query
+        """
+        super().__init__(dim)
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.centroids = None
+        self._vectors = []  # list -> (size, dim) normalized embeddings
+        self._ids = []  # list -> (size,) ids
+
+    @classmethod
+    def build(cls, embeddings, ids=None, names=None, n_lists: int | None = None, nprobe: int = 8, sample_size: int = 65536, batch_size: int = 65536):
+        """Train an index on a sample of the embeddings and add all of them (in batches, 'embeddings' can be memory-mapped)."""
+        n = len(embeddings)
+        n_lists = n_lists if n_lists is not None else max(1, min(int(2 * np.sqrt(n)), 4096, n))
+        index = cls(np.shape(embeddings)[1], n_lists=n_lists, nprobe=nprobe)
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(n, size=min(n, max(sample_size, n_lists)), replace=False))
+        index.train(np.asarray(embeddings[sample]))
+        ids = np.arange(n) if ids is None else np.asarray(ids)
+        for start in range(0, n, batch_size):
+            index.add(embeddings[start:start + batch_size], ids[start:start + batch_size],
+                      None if names is None else names[start:start + batch_size])
+        return index
+
+    def train(self, embeddings, iterations: int = 10):
+        """Learn the centroids with spherical k-means on 'embeddings' (at least 'n_lists' of them). Drops the indexed entries."""
+        embeddings = l2_normalize(embeddings)
+        if len(embeddings) < self.n_lists:
+            raise ValueError(f"At least {self.n_lists} embeddings are needed to train {self.n_lists} lists, got {len(embeddings)}")
+        rng = np.random.default_rng(0)
+        centroids = embeddings[rng.choice(len(embeddings), size=self.n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = self._assign_(embeddings, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, embeddings)
+            empty = np.bincount(assignment, minlength=self.n_lists) == 0
+            # Reseed empty cells with random embeddings, so that no list stays unused
+            sums[empty] = embeddings[rng.choice(len(embeddings), size=int(empty.sum()), replace=False)]
+            centroids = l2_normalize(sums)
+        self.centroids = centroids
+        self._vectors = [np.zeros((0, self.dim), dtype=np.float32) for _ in range(self.n_lists)]
+        self._ids = [np.zeros(0, dtype=np.int64) for _ in range(self.n_lists)]
+        self._names = {}
+
+    def _assign_(self, embeddings: np.ndarray, centroids: np.ndarray, batch_size: int = 16384) -> np.ndarray:
+        return np.concatenate([np.argmax(embeddings[start:start + batch_size] @ centroids.T, axis=1)
+                               for start in range(0, len(embeddings), batch_size)])
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._ids)
+
+    def add(self, embeddings, ids, names=None):
+        if self.centroids is None:
+            raise RuntimeError("IVFIndex must be trained before adding embeddings")
+        embeddings = l2_normalize(np.atleast_2d(embeddings))
+        ids = np.asarray(ids)
+        self.remove(ids)
+        assignment = self._assign_(embeddings, self.centroids)
+        for cell in np.unique(assignment):
+            rows = assignment == cell
+            if len(self._ids[cell]) == 0:
+                self._ids[cell] = self._ids[cell].astype(ids.dtype)
+            self._vectors[cell] = np.concatenate([self._vectors[cell], embeddings[rows]])
+            self._ids[cell] = np.concatenate([self._ids[cell], ids[rows]])
+        self._add_names_(ids, names)
+
+    def remove(self, ids):
+        ids = np.asarray(ids)
+        for cell in range(len(self._ids)):
+            keep = ~np.isin(self._ids[cell], ids)
+            if not keep.all():
+                self._vectors[cell], self._ids[cell] = self._vectors[cell][keep], self._ids[cell][keep]
+        self._remove_names_(ids)
+
+    def search(self, query, top_k: int = 1, nprobe: int | None = None) -> list[tuple]:
+        if self.centroids is None or top_k <= 0:
+            return []
+        query = l2_normalize(np.ravel(query))
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        cells = _top_k_(self.centroids @ query, nprobe)
+        cells = [cell for cell in cells if len(self._ids[cell]) > 0]
+        if not cells:
+            return []
+        scores = np.concatenate([self._vectors[cell] @ query for cell in cells])
+        positions = _top_k_(scores, top_k)
+        ids = np.concatenate([self._ids[cell] for cell in cells])
+        return list(zip(ids[positions].tolist(), scores[positions].tolist()))
+
+    def similarities(self, query, ids) -> dict:
+        # Every list is looked up, not only the 'nprobe' closest ones: the entries may be anywhere
+        query = l2_normalize(np.ravel(query))
+        ids = np.asarray(ids)
+        similarities = {}
+        for cell in range(len(self._ids)):
+            rows = np.flatnonzero(np.isin(self._ids[cell], ids))
+            if len(rows):
+                similarities.update(zip(self._ids[cell][rows].tolist(), (self._vectors[cell][rows] @ query).tolist()))
+        return similarities
+
+    def _params_(self) -> dict:
+        return {"n_lists": self.n_lists, "nprobe": self.nprobe}
+
+    def _arrays_(self) -> dict:
+        # The lists are stored back to back, so that they can be memory-mapped as views of a single matrix
+        return {"centroids": self.centroids,
+                "vectors": np.concatenate(self._vectors),
+                "ids": np.concatenate(self._ids),
+                "offsets": np.cumsum([0] + [len(ids) for ids in self._ids])}
+
+    @classmethod
+    def _from_arrays_(cls, dim: int, arrays: dict, params: dict):
+        index = cls(dim, **params)
+        index.centroids = np.asarray(arrays["centroids"])
+        offsets = arrays["offsets"]
+        index._vectors = [arrays["vectors"][start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        index._ids = [arrays["ids"][start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return index
+
+
+class QuantizedIndex(VectorIndex):
+    """
+    Index of quantized (int8 or 1-bit binary) embeddings, searched in two passes.
+
+    The first pass scores the compact codes of all the entries (int8 dot products or Hamming distances, see
+    quantization.py) and keeps the 'top_k * oversample' best candidates. The second pass rescores the candidates with
+    their float32 embeddings, so the returned similarities are exact cosine similarities and thresholds keep their meaning.
+    Only the codes need to be resident: loaded with mmap=True, the float embeddings stay on disk and only the pages of
+    the candidates are read. Without float embeddings (keep_vectors=False), the approximate first pass scores are returned.
+
+    Attributes
+    ----------
+    precision : str
+        'int8' or 'binary'
+    oversample : int
+        number of candidates rescored per requested result
+    quantizer : ScalarQuantizer | BinaryQuantizer
+        the quantizer, calibrated on the embeddings the index is built with
+    codes : np.ndarray
+        the codes of the entries, one row per entry
+    vectors : np.ndarray | None
+        the normalized float32 embeddings of the entries, used for rescoring
+    ids : np.ndarray
+        the id of the entry stored at each row
+    """
+    backend = "quantized"
+
+    def __init__(self, embeddings, ids=None, names=None, precision: str = "int8", oversample: int = 4, keep_vectors: bool = True,
+                 normalized: bool = False, sample_size: int = 65536, batch_size: int = 65536):
+        """
+        Parameters
+        ----------
+        embeddings : array-like
+            the (n, dim) embeddings to index (can be memory-mapped, they are encoded in batches)
+        ids : array-like, optional
+            the id of each embedding (defaults to the row number)
+        names : array-like, optional
+            the name of each embedding (defaults to the id)
+        precision : str
+            'int8' (4x smaller than float32) or 'binary' (32x smaller)
+        oversample : int
+            number of candidates rescored per requested result
+        keep_vectors : bool
+            whether to keep the float embeddings for rescoring
+        normalized : bool
+            whether the embeddings are already a normalized float32 matrix, kept as is without copying it
+        sample_size : int
+            number of embeddings the quantizer is calibrated on
+        batch_size : int
+            number of embeddings encoded at once
+        """
+        if precision not in QUANTIZERS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {list(QUANTIZERS)}")
+        matrix = embeddings if normalized else l2_normalize(embeddings)
+        if np.ndim(matrix) != 2:
+            raise ValueError(f"Expected a 2D matrix of embeddings, got shape {np.shape(matrix)}")
+        super().__init__(matrix.shape[1])
+        self.precision = precision
+        self.oversample = oversample
+        sample = np.random.default_rng(0).choice(len(matrix), size=min(len(matrix), sample_size), replace=False)
+        self.quantizer = QUANTIZERS[precision]().fit(np.asarray(matrix[np.sort(sample)]))
+        self.codes = np.concatenate([self.quantizer.encode(matrix[start:start + batch_size]) for start in range(0, len(matrix), batch_size)])
+        self.vectors = matrix if keep_vectors else None
+        self.ids = np.arange(len(matrix)) if ids is None else np.asarray(ids)
+        if len(self.ids) != len(self.codes) or (names is not None and len(names) != len(self.codes)):
+            raise ValueError("Embeddings, ids and names must have the same length")
+        self._add_names_(self.ids, names)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def nbytes(self) -> int:
+        """Bytes of the index held in memory (memory-mapped embeddings excluded)."""
+        in_memory = self.vectors is not None and not isinstance(self.vectors, np.memmap)
+        return self.codes.nbytes + self.ids.nbytes + (self.vectors.nbytes if in_memory else 0)
+
+    def search(self, query, top_k: int = 1) -> list[tuple]:
+        if len(self) == 0 or top_k <= 0:
+            return []
+        query = l2_normalize(np.ravel(query))
+        scores = self.quantizer.scores(self.codes, query)
+        if self.vectors is None:
+            rows = _top_k_(scores, top_k)
+            return list(zip(self.ids[rows].tolist(), scores[rows].tolist()))
+        # Rescore the candidates with their float embeddings (in row order, for sequential reads of memory-mapped ones)
+        candidates = np.sort(_top_k_(scores, top_k * self.oversample))
+        scores = np.asarray(self.vectors[candidates]) @ query
+        best = _top_k_(scores, top_k)
+        return list(zip(self.ids[candidates[best]].tolist(), scores[best].tolist()))
+
+    def similarities(self, query, ids) -> dict:
+        query = l2_normalize(np.ravel(query))
+        rows = np.flatnonzero(np.isin(self.ids, np.asarray(ids)))
+        if len(rows) == 0:
+            return {}
+        if self.vectors is None:
+            scores = self.quantizer.scores(self.codes[rows], query)
+        else:
+            scores = np.asarray(self.vectors[rows]) @ query
+        return dict(zip(self.ids[rows].tolist(), np.asarray(scores).tolist()))
+
+    def add(self, embeddings, ids, names=None):
+        embeddings = l2_normalize(np.atleast_2d(embeddings))
+        ids = np.asarray(ids)
+        self.remove(ids)
+        self.codes = np.concatenate([self.codes, self.quantizer.encode(embeddings)])
+        if self.vectors is not None:
+            self.vectors = np.concatenate([self.vectors, embeddings])
+        self.ids = np.concatenate([self.ids, ids])
+        self._add_names_(ids, names)
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, np.asarray(ids))
+        if not keep.all():
+            self.codes, self.ids = self.codes[keep], self.ids[keep]
+            if self.vectors is not None:
+                self.vectors = self.vectors[keep]
+        self._remove_names_(ids)
+
+    def _params_(self) -> dict:
+        return {"precision": self.precision, "oversample": self.oversample}
+
+    def _arrays_(self) -> dict:
+        # The quantization parameters are saved with the codes, so that new embeddings are encoded consistently
+        arrays = {"codes": self.codes, "ids": self.ids, **{f"quantizer_{name}": value for name, value in self.quantizer.params().items()}}
+        if self.vectors is not None:
+            arrays["vectors"] = self.vectors
+        return arrays
+
+    @classmethod
+    def _from_arrays_(cls, dim: int, arrays: dict, params: dict):
+        index = cls.__new__(cls)
+        VectorIndex.__init__(index, dim)
+        index.precision = params["precision"]
+        index.oversample = params["oversample"]
+        index.quantizer = QUANTIZERS[index.precision](**{name[len("quantizer_"):]: np.asarray(value) for name, value in arrays.items()
+                                                        if name.startswith("quantizer_")})
+        # Codes are small and scanned at every query: keep them in memory, while the float embeddings can stay memory-mapped
+        index.codes = np.asarray(arrays["codes"]).copy() if isinstance(arrays["codes"], np.memmap) else arrays["codes"]
+        index.ids = arrays["ids"]
+        index.vectors = arrays.get("vectors")
+        return index
+
+
+BACKENDS = {EmbeddingIndex.backend: EmbeddingIndex, IVFIndex.backend: IVFIndex, QuantizedIndex.backend: QuantizedIndex}
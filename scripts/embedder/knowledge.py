@@ -0,0 +1,86 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from scripts.embedder.index import EmbeddingIndex, VectorIndex, load_index
+from scripts.embedder.lexical import BM25Index, fuse
+
+
+def chunk_text(text: str, chunk_words: int = 100, overlap: int = 20) -> list[str]:
+    """Split a text into chunks of 'chunk_words' words, consecutive chunks sharing 'overlap' words."""
+    words = text.split()
+    if not words:
+        return []
+    step = max(chunk_words - overlap, 1)
+    return [" ".join(words[start:start + chunk_words]) for start in range(0, max(len(words) - overlap, 1), step)]
+
+
+class KnowledgeBase:
+    """
+    Chunks of the scraped articles, retrieved by cosine similarity with the question.
+
+    The knowledge base is a directory holding two files, written by pipelines/knowledge_base.py:
+    - embeddings.npy: the (n, dim) L2-normalized float32 matrix of the chunk embeddings, row i being the chunk with id i.
+      It is memory-mapped, so it is not loaded in memory at startup and its pages are shared with the OS page cache.
+    - chunks.db: SQLite table 'chunks' (id, url, title, text), only queried for the top-k chunks of each search.
+    If the pipeline also saved an approximate (IVF) or quantized index in the 'index' subdirectory, that index is searched
+    instead of scanning all the embeddings. If it saved a BM25 index of the chunks (bm25.npz), searches given the query text fuse
+    dense and lexical results, so that chunks containing the exact keywords of the question are boosted.
+
+    Attributes
+    ----------
+    path : str
+        the directory of the knowledge base
+    index : VectorIndex
+        the index over the memory-mapped chunk embeddings
+    lexical : BM25Index | None
+        the inverted index over the chunk texts (None if not built)
+    """
+    def __init__(self, path: str = 'data/kb', nprobe: int | None = None):
+        """
+        Parameters
+        ----------
+        path : str
+            the directory of the knowledge base
+        nprobe : int, optional
+            number of lists scanned by each query of the approximate index (defaults to the one it was saved with)
+        """
+        self.path = path
+        if os.path.exists(os.path.join(path, "index", "meta.json")):
+            self.index: VectorIndex = load_index(os.path.join(path, "index"), mmap=True)
+            if nprobe is not None:
+                self.index.nprobe = nprobe
+        else:
+            self.index = EmbeddingIndex(np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r"), normalized=True)
+        self.lexical = BM25Index.load(os.path.join(path, "bm25.npz")) if os.path.exists(os.path.join(path, "bm25.npz")) else None
+        self._conn = sqlite3.connect(f"file:{os.path.join(path, 'chunks.db')}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def search(self, query, top_k: int = 3, threshold: float = 0.0, text: str | None = None, lexical_weight: float = 0.1) -> list[dict]:
+        """Return the 'top_k' chunks most similar to the query embedding (only those with similarity above 'threshold').
+
+        If the query 'text' is given and the BM25 index is available, the similarity is fused with the lexical score
+        (see lexical.fuse) before ranking and thresholding.
+        Each chunk is a dict with its id, url, title, text and similarity, sorted by decreasing similarity.
+        """
+        hits = self.index.search(query, top_k=top_k)
+        if text is not None and self.lexical is not None:
+            hits = fuse(hits, self.lexical.search(text, top_k=top_k), weight=lexical_weight,
+                        similarities=lambda ids: self.index.similarities(query, ids))[:top_k]
+        hits = [(chunk_id, similarity) for chunk_id, similarity in hits if similarity >= threshold]
+        if not hits:
+            return []
+        with self._lock:
+            rows = self._conn.execute(f"SELECT id, url, title, text FROM chunks WHERE id IN ({', '.join('?' * len(hits))});",
+                                      [chunk_id for chunk_id, _ in hits]).fetchall()
+        chunks = {row[0]: row for row in rows}
+        return [{"id": chunk_id, "url": chunks[chunk_id][1], "title": chunks[chunk_id][2], "text": chunks[chunk_id][3], "similarity": similarity}
+                for chunk_id, similarity in hits if chunk_id in chunks]
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,196 @@
+import re
+from collections import Counter
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+MAX_FREQUENCY = np.iinfo(np.uint16).max
+STOPWORDS = frozenset("a an and are as at be by can do for from how i in is it me my of on or set the this to what with you your".split())
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase word tokens of 'text', without stopwords.
+
+    Identifiers such as 'max_new_tokens' are kept whole and also split in their parts, so that they match both when
+    written verbatim and when spelled out ('max new tokens').
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        parts = [part for part in token.split("_") if part]
+        if len(parts) > 1:
+            tokens.append(token)
+        tokens.extend(part for part in parts if part not in STOPWORDS)
+    return tokens
+
+
+class BM25Index:
+    """
+    Inverted index ranking documents by Okapi BM25.
+
+    Each term maps to its posting list: the positions of the documents containing it (int32) and the term frequencies
+    (uint16). Documents are added incrementally: new postings are appended to the lists of their terms. Removed documents
+    are only marked as deleted and skipped at query time, until 'compact' drops them. The index is saved to a compressed
+    .npz file holding the posting lists back to back and loaded as views of those arrays.
+
+    Attributes
+    ----------
+    k1 : float
+        term frequency saturation
+    b : float
+        document length normalization
+    ids : np.ndarray
+        the id of the document stored at each position
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        """
+        Parameters
+        ----------
+        k1 : float
+            term frequency saturation
+        b : float
+            document length normalization
+        """
+        self.k1 = k1
+        self.b = b
+        self.ids = np.zeros(0, dtype=np.int64)
+        self._lengths = np.zeros(0, dtype=np.int32)
+        self._deleted = np.zeros(0, dtype=bool)
+        self._positions = {}  # id -> position of its live document
+        self._postings = {}  # term -> (positions, frequencies)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def add(self, ids, texts):
+        """Index the texts under their ids, replacing the documents with the same ids."""
+        ids = np.asarray(ids)
+        self.remove(ids)
+        start = len(self.ids)
+        terms, positions, frequencies, lengths = [], [], [], []
+        for offset, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            terms.extend(counts)
+            positions.extend([start + offset] * len(counts))
+            frequencies.extend(counts.values())
+        if terms:
+            # Group the new postings by term, then append them to the posting list of each term at once
+            vocabulary, term_ids = np.unique(np.array(terms), return_inverse=True)
+            order = np.argsort(term_ids, kind="stable")
+            positions = np.asarray(positions, dtype=np.int32)[order]
+            frequencies = np.minimum(frequencies, MAX_FREQUENCY).astype(np.uint16)[order]
+            bounds = np.searchsorted(term_ids[order], np.arange(len(vocabulary) + 1))
+            for term, low, high in zip(vocabulary.tolist(), bounds[:-1], bounds[1:]):
+                if term in self._postings:
+                    old_positions, old_frequencies = self._postings[term]
+                    self._postings[term] = (np.concatenate([old_positions, positions[low:high]]), np.concatenate([old_frequencies, frequencies[low:high]]))
+                else:
+                    self._postings[term] = (positions[low:high], frequencies[low:high])
+        self.ids = np.concatenate([self.ids, ids]) if len(self.ids) else ids.copy()
+        self._lengths = np.concatenate([self._lengths, np.asarray(lengths, dtype=np.int32)])
+        self._deleted = np.concatenate([self._deleted, np.zeros(len(ids), dtype=bool)])
+        self._positions.update(zip(ids.tolist(), range(start, start + len(ids))))
+
+    def remove(self, ids):
+        """Mark the documents with the given ids as deleted (unknown ids are ignored)."""
+        for entry_id in np.asarray(ids).tolist():
+            position = self._positions.pop(entry_id, None)
+            if position is not None:
+                self._deleted[position] = True
+
+    def matching(self, terms) -> list:
+        """Return the ids of the documents containing at least one of the (tokenized) 'terms', from their posting lists."""
+        postings = [self._postings[term][0] for term in set(terms) if term in self._postings]
+        if not postings:
+            return []
+        positions = np.unique(np.concatenate(postings))
+        return self.ids[positions[~self._deleted[positions]]].tolist()
+
+    def compact(self):
+        """Drop the deleted documents from the posting lists."""
+        if not self._deleted.any():
+            return
+        alive = ~self._deleted
+        new_positions = np.cumsum(alive, dtype=np.int32) - 1
+        for term, (positions, frequencies) in list(self._postings.items()):
+            keep = alive[positions]
+            if keep.any():
+                self._postings[term] = (new_positions[positions[keep]], frequencies[keep])
+            else:
+                del self._postings[term]
+        self.ids, self._lengths = self.ids[alive], self._lengths[alive]
+        self._deleted = np.zeros(len(self.ids), dtype=bool)
+        self._positions = dict(zip(self.ids.tolist(), range(len(self.ids))))
+
+    def search(self, query: str, top_k: int = 10) -> list[tuple]:
+        """Return the 'top_k' documents with the highest BM25 score as (id, score) pairs, sorted by decreasing score."""
+        terms = [term for term in dict.fromkeys(tokenize(query)) if term in self._postings]
+        if not terms or top_k <= 0 or len(self) == 0:
+            return []
+        n_docs = len(self)
+        average_length = self._lengths[~self._deleted].mean() or 1.0
+        all_positions, all_scores = [], []
+        for term in terms:
+            positions, frequencies = self._postings[term]
+            frequencies = frequencies.astype(np.float32)
+            # Document frequencies include the deleted documents not compacted yet: a slight underestimate of the idf
+            idf = np.log(1 + (n_docs - len(positions) + 0.5) / (len(positions) + 0.5))
+            norms = self.k1 * (1 - self.b + self.b * self._lengths[positions] / average_length)
+            all_positions.append(positions)
+            all_scores.append(idf * frequencies * (self.k1 + 1) / (frequencies + norms))
+        # Accumulate the scores in a dense array over all the documents: linear, but cheaper than sorting the postings
+        scores = np.bincount(np.concatenate(all_positions), weights=np.concatenate(all_scores), minlength=len(self.ids))
+        scores[self._deleted] = 0
+        positions = np.flatnonzero(scores)
+        scores = scores[positions]
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k] if top_k < len(scores) else np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return list(zip(self.ids[positions[best]].tolist(), scores[best].tolist()))
+
+    def save(self, path: str):
+        """Save the (compacted) index to the .npz file 'path'."""
+        self.compact()
+        terms = list(self._postings)
+        np.savez_compressed(path,
+                            params=np.array([self.k1, self.b]),
+                            terms=np.frombuffer("\n".join(terms).encode(), dtype=np.uint8),
+                            offsets=np.cumsum([0] + [len(self._postings[term][0]) for term in terms]),
+                            positions=np.concatenate([self._postings[term][0] for term in terms]) if terms else np.zeros(0, dtype=np.int32),
+                            frequencies=np.concatenate([self._postings[term][1] for term in terms]) if terms else np.zeros(0, dtype=np.uint16),
+                            ids=self.ids,
+                            lengths=self._lengths)
+
+    @classmethod
+    def load(cls, path: str):
+        """Load an index saved with 'save'."""
+        with np.load(path) as data:
+            k1, b = data["params"].tolist()
+            index = cls(k1=k1, b=b)
+            terms = data["terms"].tobytes().decode().split("\n") if len(data["terms"]) else []
+            offsets, positions, frequencies = data["offsets"], data["positions"], data["frequencies"]
+            index._postings = {term: (positions[start:end], frequencies[start:end]) for term, start, end in zip(terms, offsets[:-1], offsets[1:])}
+            index.ids, index._lengths = data["ids"], data["lengths"]
+        index._deleted = np.zeros(len(index.ids), dtype=bool)
+        index._positions = dict(zip(index.ids.tolist(), range(len(index.ids))))
+        return index
+
+
+def fuse(dense: list[tuple], lexical: list[tuple], weight: float, similarities) -> list[tuple]:
+    """Fuse dense and lexical results into (id, score) pairs, sorted by decreasing score.
+
+    The score is the dense similarity plus 'weight' times the lexical score normalized by the best lexical score, so
+    without lexical matches it is the dense similarity and the similarity thresholds keep their meaning.
+    The dense similarity of the entries only retrieved by the lexical search is computed by 'similarities', a function
+    of their ids returning their similarity by id (e.g. VectorIndex.similarities for the query); entries it leaves out
+    are dropped.
+    """
+    scores = dict(dense)
+    missing = [entry_id for entry_id, _ in lexical if entry_id not in scores]
+    if missing:
+        scores.update(similarities(missing))
+    best = lexical[0][1] if lexical else 0.0
+    for entry_id, score in lexical:
+        if entry_id in scores:
+            scores[entry_id] += weight * score / best
+    return sorted(scores.items(), key=lambda item: -item[1])
@@ -0,0 +1,86 @@
+import numpy as np
+
+# Number of set bits of every byte, for Hamming distances between packed binary codes
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+class ScalarQuantizer:
+    """
+    int8 scalar quantization: each dimension is mapped linearly from its [minimum, maximum] range, calibrated on the
+    embeddings, to [-128, 127] (values out of range are clipped). Codes take 1 byte per dimension instead of 4.
+
+    Attributes
+    ----------
+    minimums : np.ndarray
+        the lower bound of each dimension
+    scales : np.ndarray
+        the width of a quantization step of each dimension
+    """
+    precision = "int8"
+
+    def __init__(self, minimums: np.ndarray | None = None, scales: np.ndarray | None = None):
+        self.minimums = minimums
+        self.scales = scales
+
+    def fit(self, embeddings: np.ndarray):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.minimums = embeddings.min(axis=0)
+        self.scales = np.maximum(embeddings.max(axis=0) - self.minimums, 1e-12) / 255
+        return self
+
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        codes = np.rint((np.asarray(embeddings, dtype=np.float32) - self.minimums) / self.scales) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+        """Approximate dot products between the query and the embeddings encoded in 'codes'.
+
+        Embedding ~ minimums + scales * (code + 128), so the dot product is a constant plus the product of the codes with
+        the query rescaled by 'scales'. Codes are converted to float in batches, to bound the temporary memory.
+        """
+        weights = (self.scales * query).astype(np.float32)
+        offset = float(query @ self.minimums + 128 * weights.sum())
+        return np.concatenate([codes[start:start + batch_size].astype(np.float32) @ weights
+                               for start in range(0, len(codes), batch_size)] or [np.zeros(0, dtype=np.float32)]) + offset
+
+    def params(self) -> dict:
+        return {"minimums": self.minimums, "scales": self.scales}
+
+
+class BinaryQuantizer:
+    """
+    1-bit binary quantization: each dimension is encoded by its sign after subtracting the mean embedding, calibrated on
+    the embeddings, and the bits are packed 8 per byte (32 times smaller than float32). Similarity is estimated from the
+    Hamming distance between codes: for two unit vectors, the angle between them is about pi * hamming / dim.
+
+    Attributes
+    ----------
+    means : np.ndarray
+        the mean of each dimension
+    """
+    precision = "binary"
+
+    def __init__(self, means: np.ndarray | None = None):
+        self.means = means
+
+    def fit(self, embeddings: np.ndarray):
+        self.means = np.asarray(embeddings, dtype=np.float32).mean(axis=0)
+        return self
+
+    def encode(self, embeddings: np.ndarray) -> np.ndarray:
+        return np.packbits(np.asarray(embeddings, dtype=np.float32) > self.means, axis=-1)
+
+    def hamming(self, codes: np.ndarray, query: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+        query_code = self.encode(query)
+        return np.concatenate([POPCOUNT[np.bitwise_xor(codes[start:start + batch_size], query_code)].sum(axis=1, dtype=np.int32)
+                               for start in range(0, len(codes), batch_size)] or [np.zeros(0, dtype=np.int32)])
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Estimated cosine similarities between the query and the embeddings encoded in 'codes'."""
+        return np.cos(np.pi * self.hamming(codes, query) / len(self.means)).astype(np.float32)
+
+    def params(self) -> dict:
+        return {"means": self.means}
+
+
+QUANTIZERS = {ScalarQuantizer.precision: ScalarQuantizer, BinaryQuantizer.precision: BinaryQuantizer}
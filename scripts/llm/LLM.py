@@ -1,20 +1,28 @@
 import os
+import copy
+import asyncio
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+from transformers import AutoTokenizer, GenerationConfig
 import numpy as np
 
+from scripts.batching import MicroBatcher
+from scripts.llm.backends import GenerationBackend, select_backend
+from scripts.llm.prefix_cache import PrefixCache
+from scripts.llm.scoring import confidence_stats
+from scripts.llm.streaming import CallbackStreamer
+
 os.chdir("/home/tommaso/Repositories/teleRAG")
 
 class LLM:
-    def __init__(self, pt_checkpoint ="mistralai/Mistral-7B-Instruct-v0.2", device="cuda:0"):
-        # Pointless to run on CPU, check if GPU is available otherwise refuse
-        if not torch.cuda.is_available():
-            raise Exception("No GPU detected. Please make sure your hardware matches LLM requirements before running this script.")
+    def __init__(self, pt_checkpoint ="mistralai/Mistral-7B-Instruct-v0.2", device="auto", backend: GenerationBackend | None = None):
+        # GPU if available (8-bit weights, flash attention), otherwise CPU (int8 dynamic quantization). See scripts/llm/backends.py
+        self.backend = select_backend(device) if backend is None else backend
         self.tokenizer = AutoTokenizer.from_pretrained(pt_checkpoint, cache_dir="./models/cache")
-        self.model = AutoModelForCausalLM.from_pretrained(pt_checkpoint,
-                                                          load_in_8bit=True,
-                                                          device_map=device,
-                                                          cache_dir="./models/cache")
+        # Batched generation needs left padding, so that every prompt ends where generation starts
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = self.backend.load(pt_checkpoint, cache_dir="./models/cache")
         self.gen_config = GenerationConfig(
             do_sample=True,
             temperature=0.2,
@@ -35,44 +43,128 @@ class LLM:
              "content": "Your name is RagBot. You are a friendly chatbot that answers questions. Keep the answer short and concise. Don't be verbose."},
             {"role": "assistant", "content": "Got it! How can I assist you today?"}
         ]
+        self.scheduler = None
+        self.prefix_cache = None
+
+    def enable_batching(self, max_batch_size=8, max_wait_ms=20.0):
+        """Route generation through a MicroBatcher that generates concurrent replies in a single batched forward pass."""
+        if self.scheduler is not None:
+            self.scheduler.close()
+        self.scheduler = MicroBatcher(self._generate_batch_, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, name="LLMBatcher")
+
+    def enable_prefix_cache(self, max_entries=64, max_bytes=2 * 1024 ** 3):
+        """Keep the past_key_values of each chat across turns, so that only the new part of the prompt is prefilled."""
+        self.prefix_cache = PrefixCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    def warmup(self, max_new_tokens=4):
+        """Run a short generation, single and batched, before serving traffic.
 
-    def reply(self, user_message: str, chat_template = [], min_confidence=0):
+        The first calls pay for CUDA context setup, kernel selection and the allocation of the caching allocator blocks
+        (on CPU, for the allocation of the thread pool and of the activation buffers): this moves that cost out of the
+        first user replies.
+        """
+        gen_config = copy.deepcopy(self.gen_config)
+        gen_config.max_new_tokens = max_new_tokens
+        prompts = [self.chat_template + [{"role": "user", "content": "Hi!"}],
+                   self.chat_template + [{"role": "user", "content": "What can you do for me?"}]]
+        with torch.no_grad(), self.backend.attention():
+            for batch in (prompts[:1], prompts):
+                templates = [self.tokenizer.apply_chat_template(prompt, tokenize=False, add_generation_prompt=True) for prompt in batch]
+                inputs = self.tokenizer(templates, return_tensors="pt", padding=True).to(self.model.device)
+                self.model.generate(**inputs, generation_config=gen_config)
+
+    def reply(self, user_message: str, chat_template = [], min_confidence=0, cache_key=None, context=None):
         chat_template.append({"role": "user", "content": user_message})
+        prompt = self.__with_context__(chat_template, context)
         if min_confidence > 0:
-            answer = self._generate_(chat_template=chat_template, confidence=True)
+            answer = self._dispatch_(chat_template=prompt, confidence=True, cache_key=cache_key)
             if answer["confidence"] < min_confidence:
                 answer["text"] = "Purry, I don't understand."
         else:
-            answer = self._generate_(chat_template=chat_template, confidence=False)
+            answer = self._dispatch_(chat_template=prompt, confidence=False, cache_key=cache_key)
         chat_template.append({"role": "assistant", "content": answer["text"]})
-        return {"text": "\n".join([answer["text"], str(np.random.choice(["Meow!", "Purr!", "Mew!", "Chirrup!", "Chirp!"], size=1)[0])]),
+        return {"text": "\n".join([answer["text"], self.__meow__()]),
                 "chat_template": chat_template}
 
-    def __get_confidence__(self, scores, ids):
-        # OPTION 1: calculate softmax, then access element [index]
-        # normalized_logits_per_step = [torch.nn.functional.softmax(scores[i], dim=1)[0][index] for i, index in enumerate(ids[0])]
-        # OPTION 2: directly calculate exp of element [index] and divide by sum of exps --> 1 division instead of 30K
-        normalized_logits_per_step = [torch.exp(scores[i][0][index]) / torch.sum(torch.exp(scores[i][0])) for i, index in enumerate(ids[0])]
-        return torch.Tensor(normalized_logits_per_step).mean()
+    async def astream_reply(self, user_message: str, chat_template = [], cache_key=None, executor=None, context=None):
+        """Same as 'reply', but asynchronously yields the text of the answer while it is generated.
+
+        Generation runs on 'executor' (default: the event loop default executor). The answer is appended to 'chat_template'
+        once generation is over.
+        """
+        chat_template.append({"role": "user", "content": user_message})
+        prompt = self.__with_context__(chat_template, context)
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+
+        def on_text(text):
+            loop.call_soon_threadsafe(chunks.put_nowait, text)
 
-    def _generate_(self, chat_template, confidence):
-        with torch.no_grad(), torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=False, enable_mem_efficient=False):
+        generation = loop.run_in_executor(executor, self._dispatch_, prompt, False, cache_key, on_text)
+        # Unblock the consumer if generation fails before the streamer is closed
+        generation.add_done_callback(lambda _: chunks.put_nowait(None))
+        while (chunk := await chunks.get()) is not None:
+            yield chunk
+        answer = await generation
+        chat_template.append({"role": "assistant", "content": answer["text"]})
+        yield "\n" + self.__meow__()
+
+    def __with_context__(self, chat_template, context=None):
+        """Return the prompt for 'chat_template', with the retrieved passages in 'context' prepended to the last user message.
+
+        'chat_template' itself is left untouched, so that the history keeps the message as the user wrote it.
+        """
+        if not context:
+            return chat_template
+        passages = "\n\n".join(context)
+        message = chat_template[-1]["content"]
+        return chat_template[:-1] + [{"role": "user",
+                                      "content": f"Use the following information to answer, if relevant.\n\n{passages}\n\nQuestion: {message}"}]
+
+    def __meow__(self):
+        return str(np.random.choice(["Meow!", "Purr!", "Mew!", "Chirrup!", "Chirp!"], size=1)[0])
+
+    def _dispatch_(self, chat_template, confidence, cache_key=None, on_text=None):
+        if self.scheduler is not None:
+            return self.scheduler({"chat_template": chat_template, "confidence": confidence, "cache_key": cache_key, "on_text": on_text})
+        return self._generate_(chat_template=chat_template, confidence=confidence, cache_key=cache_key, on_text=on_text)
+
+    def _generate_(self, chat_template, confidence, cache_key=None, on_text=None):
+        with torch.no_grad(), self.backend.attention():
             template = self.tokenizer.apply_chat_template(chat_template, tokenize=False, add_generation_prompt=True)
-            inputs = self.tokenizer(template, return_tensors="pt").to("cuda")
-            config = self.gen_config
-            if confidence:
-                config.output_scores = True,
-                config.return_dict_in_generate = True
-                output = self.model.generate(**inputs, generation_config=config)
-                confidence_score = self.__get_confidence__(scores=output["scores"],
-                                                           ids=output["sequences"][:, inputs["input_ids"].shape[1]:])
-                return {"text": self.tokenizer.batch_decode(output["sequences"][:, inputs["input_ids"].shape[1]:],
-                                                            skip_special_tokens=True)[0],
-                        "confidence": confidence_score.item()
-                        }
-            else:
-                output = self.model.generate(**inputs, generation_config=config)
-                return {"text": self.tokenizer.batch_decode(output[:, inputs["input_ids"].shape[1]:],
-                                                            skip_special_tokens=True)[0],
-                        "confidence": None
-                        }
+            inputs = self.tokenizer(template, return_tensors="pt").to(self.model.device)
+            # Reuse the keys/values of the prefix already processed in the previous turns of this chat, if any
+            past_key_values = None
+            if cache_key is not None and self.prefix_cache is not None:
+                past_key_values = self.prefix_cache.lookup(cache_key, inputs["input_ids"][0])
+            streamer = CallbackStreamer(self.tokenizer, [on_text]) if on_text is not None else None
+            output = self.model.generate(**inputs, generation_config=self.gen_config, past_key_values=past_key_values, streamer=streamer,
+                                         output_scores=confidence, return_dict_in_generate=True)
+            if cache_key is not None and self.prefix_cache is not None:
+                self.prefix_cache.store(cache_key, output["sequences"][0], output["past_key_values"])
+            generated = output["sequences"][:, inputs["input_ids"].shape[1]:]
+            return {"text": self.tokenizer.batch_decode(generated, skip_special_tokens=True)[0],
+                    "confidence": confidence_stats(output["scores"], generated, self.gen_config.eos_token_id)[0]["mean"] if confidence else None
+                    }
+
+    def _generate_batch_(self, requests):
+        """Generate the replies of several requests (chat_template, confidence, cache_key, on_text) with a single left-padded batched generate.
+
+        The prefix cache only applies to unpadded sequences: it is used when the batch holds a single request (i.e., under low load).
+        """
+        if len(requests) == 1:
+            return [self._generate_(**requests[0])]
+        confidence = any(request["confidence"] for request in requests)
+        with torch.no_grad(), self.backend.attention():
+            templates = [self.tokenizer.apply_chat_template(request["chat_template"], tokenize=False, add_generation_prompt=True) for request in requests]
+            inputs = self.tokenizer(templates, return_tensors="pt", padding=True).to(self.model.device)
+            callbacks = [request["on_text"] for request in requests]
+            streamer = CallbackStreamer(self.tokenizer, callbacks) if any(callbacks) else None
+            output = self.model.generate(**inputs, generation_config=self.gen_config, streamer=streamer,
+                                         output_scores=confidence, return_dict_in_generate=True)
+            generated = output["sequences"][:, inputs["input_ids"].shape[1]:]
+            texts = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+            # Rows that finished early are padded: only the tokens generated up to (and including) EOS are scored
+            stats = confidence_stats(output["scores"], generated, self.gen_config.eos_token_id) if confidence else None
+            return [{"text": texts[row], "confidence": stats[row]["mean"] if request["confidence"] else None}
+                    for row, request in enumerate(requests)]
@@ -0,0 +1,108 @@
+import contextlib
+from abc import ABC, abstractmethod
+
+import torch
+from transformers import AutoModelForCausalLM
+
+
+class GenerationBackend(ABC):
+    """
+    Where and how a causal LM runs: how its weights are loaded and which attention kernels generation uses.
+    Backends must implement 'load', otherwise they can't be instantiated.
+
+    Attributes
+    ----------
+    device : str
+        the torch device the model runs on
+    """
+    name = None
+
+    def __init__(self, device: str):
+        self.device = device
+
+    @abstractmethod
+    def load(self, checkpoint: str, cache_dir: str = "./models/cache"):
+        """Load the model of 'checkpoint', ready for generation on this backend."""
+
+    def attention(self):
+        """Context manager wrapping generation, selecting the attention kernels of this backend."""
+        return contextlib.nullcontext()
+
+
+class CUDABackend(GenerationBackend):
+    """
+    GPU backend: 8-bit weights (bitsandbytes) and flash attention.
+    """
+    name = "cuda"
+
+    def __init__(self, device: str = "cuda:0"):
+        if not torch.cuda.is_available():
+            raise Exception("No GPU detected. Please make sure your hardware matches LLM requirements, or run the LLM on CPU.")
+        super().__init__(device)
+
+    def load(self, checkpoint: str, cache_dir: str = "./models/cache"):
+        return AutoModelForCausalLM.from_pretrained(checkpoint,
+                                                    load_in_8bit=True,
+                                                    device_map=self.device,
+                                                    cache_dir=cache_dir)
+
+    def attention(self):
+        return torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=False, enable_mem_efficient=False)
+
+
+class CPUBackend(GenerationBackend):
+    """
+    CPU backend, for nodes without a GPU (staging, failover).
+
+    With precision 'int8', the weights of the linear layers are quantized to int8 (PyTorch dynamic quantization: weights
+    are stored in int8, activations are quantized on the fly), so that they take a quarter of the memory of float32 and
+    matmuls run on the int8 kernels (fbgemm/onednn). 'bfloat16' halves the memory and is fast on CPUs with AVX512-BF16/AMX;
+    'float32' is the reference. Matmuls use 'threads' threads (PyTorch's default, one per physical core, if None); the KV
+    cache is kept by generate.
+    N.b., the model is loaded in float32 before quantization: loading a 7B model needs about 28 GB of RAM.
+    N.b., the number of threads is a process-wide PyTorch setting: 'load' applies it (torch.set_num_threads), so it also
+    holds for any other model of the process, e.g. the sentence embedder.
+
+    Attributes
+    ----------
+    precision : str
+        'int8', 'bfloat16' or 'float32'
+    threads : int | None
+        number of threads of the matmuls, applied by 'load' (None keeps PyTorch's default)
+    """
+    name = "cpu"
+    PRECISIONS = ("int8", "bfloat16", "float32")
+
+    def __init__(self, precision: str = "int8", threads: int | None = None):
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"unknown CPU precision '{precision}', expected one of {self.PRECISIONS}")
+        super().__init__("cpu")
+        self.precision = precision
+        self.threads = threads
+
+    def load(self, checkpoint: str, cache_dir: str = "./models/cache"):
+        """Load the model of 'checkpoint' in the backend precision, setting the process-wide number of torch threads to 'threads'."""
+        if self.threads is not None:
+            torch.set_num_threads(self.threads)
+        model = AutoModelForCausalLM.from_pretrained(checkpoint,
+                                                     torch_dtype=torch.bfloat16 if self.precision == "bfloat16" else torch.float32,
+                                                     low_cpu_mem_usage=True,
+                                                     cache_dir=cache_dir)
+        model.eval()
+        if self.precision == "int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+
+BACKENDS = {CUDABackend.name: CUDABackend, CPUBackend.name: CPUBackend}
+
+
+def select_backend(device: str = "auto", cpu_precision: str = "int8", cpu_threads: int | None = None) -> GenerationBackend:
+    """Return the backend of 'device' ('cuda', 'cuda:<n>' or 'cpu'). With 'auto', the GPU is used if available, the CPU otherwise."""
+    if device == "auto":
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    if device.startswith("cuda"):
+        return CUDABackend("cuda:0" if device == "cuda" else device)
+    if device == "cpu":
+        return CPUBackend(precision=cpu_precision, threads=cpu_threads)
+    raise ValueError(f"unknown device '{device}', expected 'auto', 'cuda[:n]' or 'cpu'")
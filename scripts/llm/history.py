@@ -0,0 +1,71 @@
+import logging
+import threading
+from collections import OrderedDict
+
+
+class HistoryWindow:
+    """
+    Sliding window that fits a chat template into a token budget before it is passed to the LLM.
+
+    The first 'system_turns' messages (the persona from the DEFAULT template) are always kept. When the conversation
+    exceeds the budget, the oldest user/assistant turns are dropped until it fits in 'target_ratio' of the budget:
+    truncating below the limit means the window slides only every few turns, so in between the prompt prefix stays stable
+    and the per-chat prefix cache can keep reusing it.
+    Token counts are cached per message, so each check only tokenizes the messages that were never seen before.
+
+    Attributes
+    ----------
+    max_tokens : int
+        token budget of the prompt, including the new user message and the tokens reserved for the answer
+    system_turns : int
+        number of leading messages that are never dropped
+    reserved_tokens : int
+        tokens reserved for the generated answer
+    target_ratio : float
+        fraction of the budget the history is cut down to when it overflows
+    """
+    MESSAGE_OVERHEAD = 4  # tokens added by the chat template around each message (e.g. [INST], [/INST], </s>)
+
+    def __init__(self, tokenizer, max_tokens: int = 3072, system_turns: int = 2, reserved_tokens: int = 100, target_ratio: float = 0.75, cache_size: int = 50000):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.system_turns = system_turns
+        self.reserved_tokens = reserved_tokens
+        self.target_ratio = target_ratio
+        self.cache_size = cache_size
+        self._counts = OrderedDict()  # (role, content) -> number of tokens
+        self._lock = threading.Lock()
+
+    def count(self, message: dict) -> int:
+        """Number of tokens taken by a message in the prompt (cached)."""
+        key = (message["role"], message["content"])
+        with self._lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                return self._counts[key]
+        tokens = len(self.tokenizer.encode(message["content"], add_special_tokens=False)) + self.MESSAGE_OVERHEAD
+        with self._lock:
+            self._counts[key] = tokens
+            if len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def fit(self, chat_template: list[dict], new_message: str = "", chat_id=None) -> list[dict]:
+        """Return a copy of 'chat_template' that, together with 'new_message' and the answer, fits in the token budget."""
+        system, turns = chat_template[:self.system_turns], chat_template[self.system_turns:]
+        counts = [self.count(message) for message in turns]
+        fixed = sum(self.count(message) for message in system) + self.count({"role": "user", "content": new_message}) + self.reserved_tokens
+        if fixed + sum(counts) <= self.max_tokens:
+            return list(chat_template)
+        budget = max(int(self.max_tokens * self.target_ratio) - fixed, 0)
+        start, total = len(turns), 0
+        while start > 0 and total + counts[start - 1] <= budget:
+            start -= 1
+            total += counts[start]
+        # The kept turns must start with a user message, to preserve the user/assistant alternation of the template
+        while start < len(turns) and turns[start]["role"] != "user":
+            total -= counts[start]
+            start += 1
+        logging.info(f"history of {chat_id} truncated: dropped {start} of {len(turns)} messages "
+                     f"({sum(counts[:start])} tokens), kept {total + fixed} of {self.max_tokens} tokens")
+        return list(system) + turns[start:]
@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def _legacy_(past_key_values):
+    """Return past_key_values in the legacy format: a tuple of (key, value) tensors of shape (batch, heads, seq, dim) per layer."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple(past_key_values)
+
+
+def _crop_(past_key_values, length: int):
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past_key_values)
+
+
+def _nbytes_(past_key_values) -> int:
+    return sum(key.nelement() * key.element_size() + value.nelement() * value.element_size() for key, value in past_key_values)
+
+
+class PrefixCache:
+    """
+    Per-chat cache of the attention keys/values (past_key_values) of the tokens already processed in previous turns.
+
+    Each turn, the prompt of a chat is the prompt of the previous turn plus the previous answer and the new user message.
+    The cache stores, per chat, the token ids processed last turn and their past_key_values: on the next turn only the
+    tokens after the longest common prefix need to be prefilled. Any mismatch (edited or truncated history, /restart)
+    just shortens the reused prefix, down to a clean miss.
+    Entries are evicted in LRU order when either 'max_entries' or 'max_bytes' is exceeded.
+
+    Attributes
+    ----------
+    max_entries : int
+        maximum number of chats with cached keys/values
+    max_bytes : int
+        memory budget for the cached keys/values
+    """
+    def __init__(self, max_entries: int = 64, max_bytes: int = 2 * 1024 ** 3):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.prefill_tokens = 0
+        self._entries = OrderedDict()  # key -> (token ids, past_key_values, nbytes)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key, input_ids: torch.Tensor):
+        """Return the past_key_values cached for 'key' that can be reused for the 1D tensor 'input_ids' (or None on a miss).
+
+        The entry is consumed: the caller is expected to store the updated keys/values once generation is over.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
+        reused = 0
+        if entry is not None:
+            cached_ids, past_key_values, _ = entry
+            length = min(len(cached_ids), len(input_ids) - 1)  # at least one token must be fed to the model
+            mismatch = (cached_ids[:length].to(input_ids.device) != input_ids[:length]).nonzero()
+            reused = int(mismatch[0]) if len(mismatch) > 0 else length
+        with self._lock:
+            self.prefill_tokens += len(input_ids) - reused
+            if reused > 0:
+                self.hits += 1
+                self.saved_tokens += reused
+            else:
+                self.misses += 1
+        return _crop_(past_key_values, reused) if reused > 0 else None
+
+    def store(self, key, token_ids: torch.Tensor, past_key_values):
+        """Cache the keys/values of the sequence 'token_ids' (1D tensor) for 'key', evicting the least recently used entries if needed."""
+        past_key_values = _legacy_(past_key_values)
+        length = past_key_values[0][0].shape[2]
+        past_key_values = _crop_(past_key_values, min(length, len(token_ids)))
+        nbytes = _nbytes_(past_key_values)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self._entries[key] = (token_ids[:length].detach(), past_key_values, nbytes)
+            self.nbytes += nbytes
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "megabytes": round(self.nbytes / 1024 ** 2, 1),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                    "saved_tokens": self.saved_tokens,
+                    "prefill_tokens": self.prefill_tokens}
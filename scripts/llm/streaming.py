@@ -0,0 +1,42 @@
+from transformers.generation.streamers import BaseStreamer
+
+
+class CallbackStreamer(BaseStreamer):
+    """
+    Streamer that decodes every row of a (possibly batched) generation incrementally and passes the new text of each
+    row to its own callback, as soon as the tokens are generated.
+
+    Unlike TextStreamer, it supports batches: rows without a callback are ignored. Callbacks run in the generation
+    thread and receive None once generation is over.
+    """
+    def __init__(self, tokenizer, callbacks: list, skip_prompt: bool = True):
+        self.tokenizer = tokenizer
+        self.callbacks = callbacks
+        self.skip_prompt = skip_prompt
+        self.next_tokens_are_prompt = True
+        self.tokens = [[] for _ in callbacks]
+        self.printed = [0 for _ in callbacks]
+
+    def _emit_(self, row: int, final: bool = False):
+        text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+        # An incomplete multi-byte character is decoded as U+FFFD: wait for the next token before emitting it
+        if len(text) > self.printed[row] and (final or not text.endswith("�")):
+            self.callbacks[row](text[self.printed[row]:])
+            self.printed[row] = len(text)
+
+    def put(self, value):
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        value = value.reshape(len(self.callbacks), -1).tolist()
+        for row, callback in enumerate(self.callbacks):
+            if callback is not None:
+                self.tokens[row].extend(value[row])
+                self._emit_(row)
+
+    def end(self):
+        for row, callback in enumerate(self.callbacks):
+            if callback is not None:
+                self._emit_(row, final=True)
+                callback(None)
+        self.next_tokens_are_prompt = True
@@ -1,19 +1,25 @@
+import os
+import json
+import time
 import argparse
 
 import torch
-from transformers import TextStreamer, AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+from transformers import TextStreamer, AutoTokenizer, GenerationConfig
+
+from scripts.llm.backends import GenerationBackend, select_backend
+from scripts.llm.scoring import confidence_stats
 
 
 class Maestrale:
-    def __init__(self, device="cuda:0"):
-        # Pointless to run on CPU, check if GPU is available otherwise refuse
-        if not torch.cuda.is_available():
-            raise Exception("No GPU detected. Please make sure your hardware matches LLM requirements before running this script.")
+    def __init__(self, device="auto", backend: GenerationBackend | None = None):
+        # GPU if available (8-bit weights, flash attention), otherwise CPU (int8 dynamic quantization). See scripts/llm/backends.py
+        self.backend = select_backend(device) if backend is None else backend
         self.tokenizer = AutoTokenizer.from_pretrained("mii-llm/maestrale-chat-v0.3-alpha")
-        self.model = AutoModelForCausalLM.from_pretrained("mii-llm/maestrale-chat-v0.3-alpha",
-                                                          load_in_8bit=True,
-                                                          device_map=device,
-                                                          cache_dir="./models/cache")
+        # Batched generation needs left padding, so that every prompt ends where generation starts
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = self.backend.load("mii-llm/maestrale-chat-v0.3-alpha", cache_dir="./models/cache")
         self.gen_config = GenerationConfig(
             do_sample=True,
             temperature=0.7,
@@ -35,22 +41,43 @@ class Maestrale:
             {"role": "user", "content": f""}
         ]
 
+    def __prompt__(self, question: str, context: str) -> list[dict]:
+        # A new template per call: the shared one is never modified, so concurrent calls don't overwrite each other's prompt
+        return [self.chat_template[0],
+                {"role": "user", "content": f"Data la seguente nota clinica: '{context}'\nRispondi alla seguente domanda: {question}."}]
+
     def generate_answer(self, question: str, context: str, stream=False, confidence=False):
-        template = self.chat_template
-        template[1]["content"] = f"Data la seguente nota clinica: '{context}'\nRispondi alla seguente domanda: {question}."
-        return self._generate_(chat_template=template, stream=stream, confidence=confidence)
+        return self._generate_(chat_template=self.__prompt__(question, context), stream=stream, confidence=confidence)
+
+    def prompt_lengths(self, records: list[tuple[str, str]]) -> list[int]:
+        """Number of prompt tokens of each (question, context) record."""
+        templates = [self.tokenizer.apply_chat_template(self.__prompt__(question, context), tokenize=False, add_generation_prompt=True)
+                     for question, context in records]
+        return [len(ids) for ids in self.tokenizer(templates)["input_ids"]]
 
-    def __get_confidence__(self, scores, ids):
-        # OPTION 1: calculate softmax, then access element [index]
-        # normalized_logits_per_step = [torch.nn.functional.softmax(scores[i], dim=1)[0][index] for i, index in enumerate(ids[0])]
-        # OPTION 2: directly calculate exp of element [index] and divide by sum of exps --> 1 division instead of 30K
-        normalized_logits_per_step = [torch.exp(scores[i][0][index]) / torch.sum(torch.exp(scores[i][0])) for i, index in enumerate(ids[0])]
-        return torch.Tensor(normalized_logits_per_step).mean()
+    def generate_batch(self, records: list[tuple[str, str]], confidence=False) -> list[dict]:
+        """Answer several (question, context) records with a single left-padded batched generate.
+
+        Returns a dict (text, confidence, confidence_stats) per record, in the same order; 'confidence_stats' holds the
+        mean/min token probability, mean log-probability and mean entropy of the answer (see scripts/llm/scoring.py). Records of similar length waste less compute on
+        padding: see 'evaluate', which buckets them by length.
+        """
+        templates = [self.tokenizer.apply_chat_template(self.__prompt__(question, context), tokenize=False, add_generation_prompt=True)
+                     for question, context in records]
+        with torch.no_grad(), self.backend.attention():
+            inputs = self.tokenizer(templates, return_tensors="pt", padding=True).to(self.model.device)
+            output = self.model.generate(**inputs, generation_config=self.gen_config, output_scores=confidence, return_dict_in_generate=True)
+            generated = output["sequences"][:, inputs["input_ids"].shape[1]:]
+            texts = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+            # Rows that finished early are padded: only the tokens generated up to (and including) EOS are scored
+            stats = confidence_stats(output["scores"], generated, self.gen_config.eos_token_id) if confidence else [None] * len(records)
+            return [{"text": text, "confidence": row["mean"] if row is not None else None, "confidence_stats": row}
+                    for text, row in zip(texts, stats)]
 
     def _generate_(self, chat_template, stream=False, confidence=False):
-        with torch.no_grad(), torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=False, enable_mem_efficient=False):
+        with torch.no_grad(), self.backend.attention():
             template = self.tokenizer.apply_chat_template(chat_template, tokenize=False, add_generation_prompt=True)
-            inputs = self.tokenizer(template, return_tensors="pt").to("cuda")
+            inputs = self.tokenizer(template, return_tensors="pt").to(self.model.device)
             config = self.gen_config
             if stream:
                 streamer = TextStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
@@ -62,14 +89,11 @@ class Maestrale:
                 return None
             else:
                 if confidence:
-                    config.output_scores = True,
-                    config.return_dict_in_generate = True
-                    output = self.model.generate(**inputs, generation_config=config)
-                    confidence_score = self.__get_confidence__(scores=output["scores"],
-                                                               ids=output["sequences"][:, inputs["input_ids"].shape[1]:])
-                    return {"text": self.tokenizer.batch_decode(output["sequences"][:, inputs["input_ids"].shape[1]:],
-                                                                skip_special_tokens=True)[0],
-                            "confidence": confidence_score.item()
+                    # Passed to generate instead of set on the shared config, which would turn scores on for every later call
+                    output = self.model.generate(**inputs, generation_config=config, output_scores=True, return_dict_in_generate=True)
+                    generated = output["sequences"][:, inputs["input_ids"].shape[1]:]
+                    return {"text": self.tokenizer.batch_decode(generated, skip_special_tokens=True)[0],
+                            "confidence": confidence_stats(output["scores"], generated, config.eos_token_id)[0]["mean"]
                             }
                 else:
                     output = self.model.generate(**inputs, generation_config=config)
@@ -77,3 +101,98 @@ class Maestrale:
                                                                 skip_special_tokens=True)[0],
                             "confidence": None
                             }
+
+
+def read_records(path: str):
+    """Yield the (id, question, context) records of a JSONL file, one JSON object per line with 'question' and 'context'
+    (and optionally 'id', the line number otherwise)."""
+    with open(path) as file:
+        for line_number, line in enumerate(file):
+            if line.strip():
+                record = json.loads(line)
+                yield record.get("id", line_number), record["question"], record["context"]
+
+
+def completed_ids(path: str) -> set:
+    """Ids of the records already answered in the results file 'path' (a truncated last line, left by a crash, is ignored)."""
+    done = set()
+    if os.path.exists(path):
+        with open(path) as file:
+            for line in file:
+                try:
+                    done.add(json.loads(line)["id"])
+                except (json.JSONDecodeError, KeyError):
+                    continue
+    return done
+
+
+def evaluate(maestrale: Maestrale, input_path: str, output_path: str, batch_size: int = 8, window: int = 512, confidence: bool = False) -> dict:
+    """Answer every record of the JSONL file 'input_path' with batched generation, appending the results to 'output_path'.
+
+    Records are streamed in windows of 'window' records; each window is sorted by prompt length and split into batches
+    of 'batch_size', so that the prompts of a batch have similar lengths and little compute goes to padding. Results are
+    written (and flushed) after each batch: an interrupted evaluation resumes from the records not in 'output_path' yet.
+    Return a dict with the number of records answered and skipped, the records/sec and the padding waste (fraction of
+    padding tokens in the batched prompts).
+    """
+    done = completed_ids(output_path)
+    stats = {"answered": 0, "skipped": 0, "records_per_second": 0.0, "padding_waste": 0.0}
+    prompt_tokens, padded_tokens = 0, 0
+    start = time.perf_counter()
+
+    def run(records, output):
+        nonlocal prompt_tokens, padded_tokens
+        lengths = maestrale.prompt_lengths([(question, context) for _, question, context in records])
+        # Longest first: a batch that does not fit in memory fails right away instead of at the end
+        order = sorted(range(len(records)), key=lambda i: lengths[i], reverse=True)
+        for offset in range(0, len(order), batch_size):
+            batch = [records[i] for i in order[offset:offset + batch_size]]
+            batch_lengths = [lengths[i] for i in order[offset:offset + batch_size]]
+            prompt_tokens += sum(batch_lengths)
+            padded_tokens += max(batch_lengths) * len(batch)
+            answers = maestrale.generate_batch([(question, context) for _, question, context in batch], confidence=confidence)
+            for (record_id, question, _), answer in zip(batch, answers):
+                output.write(json.dumps({"id": record_id, "question": question, "answer": answer["text"], "confidence": answer["confidence"],
+                                         "confidence_stats": answer["confidence_stats"]}, ensure_ascii=False) + "\n")
+            output.flush()
+            stats["answered"] += len(batch)
+            print(f"{stats['answered']} records answered, {stats['answered'] / (time.perf_counter() - start):.2f} records/s", end="\r")
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "a") as output:
+        if output.tell() > 0:
+            with open(output_path, "rb") as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    # Terminate the truncated line left by a crash, so that the next result starts on a line of its own
+                    output.write("\n")
+        records = []
+        for record in read_records(input_path):
+            if record[0] in done:
+                stats["skipped"] += 1
+                continue
+            records.append(record)
+            if len(records) == window:
+                run(records, output)
+                records = []
+        if records:
+            run(records, output)
+    elapsed = time.perf_counter() - start
+    stats["records_per_second"] = stats["answered"] / elapsed if elapsed > 0 else 0.0
+    stats["padding_waste"] = 1 - prompt_tokens / padded_tokens if padded_tokens > 0 else 0.0
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batched offline evaluation of Maestrale on (question, context) records")
+    parser.add_argument("input", help="JSONL file, one {'id', 'question', 'context'} object per line")
+    parser.add_argument("--output", help="JSONL results file (default: results/<input name>_maestrale.jsonl), resumed if it exists")
+    parser.add_argument("--batch-size", type=int, default=8, help="records per batched generate")
+    parser.add_argument("--window", type=int, default=512, help="records sorted by length together (larger: less padding)")
+    parser.add_argument("--confidence", action="store_true", help="also compute the confidence of each answer")
+    parser.add_argument("--device", default="auto", help="'auto', 'cuda[:n]' or 'cpu'")
+    args = parser.parse_args()
+    output_path = args.output or os.path.join("results", os.path.splitext(os.path.basename(args.input))[0] + "_maestrale.jsonl")
+    results = evaluate(Maestrale(device=args.device), args.input, output_path, batch_size=args.batch_size, window=args.window, confidence=args.confidence)
+    print(f"\n{results['answered']} records answered ({results['skipped']} already in {output_path}), "
+          f"{results['records_per_second']:.2f} records/s, padding waste {100 * results['padding_waste']:.1f}%")
@@ -0,0 +1,53 @@
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The bot modules chdir to the deployment directory when imported: import them once here, staying in the repository
+with mock.patch("os.chdir"):
+    import bot.botutils
+    import bot.sqlutils
+
+
+TINY_VOCABULARY = ["<unk>", "<|im_start|>", "<|im_end|>", "user", "assistant", "hi", "hello", "what", "can", "you", "do", "for", "me",
+                   "tell", "a", "long", "story", "about", "cats", "and", "dogs", "please", "the", "weather", "is", "nice", "today"]
+
+
+@pytest.fixture(scope="session")
+def tiny_checkpoint(tmp_path_factory) -> str:
+    """Directory of a randomly initialized 2-layer Llama with a word-level tokenizer and a ChatML template, to run LLM on CPU."""
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    tokenizers = pytest.importorskip("tokenizers")
+    path = str(tmp_path_factory.mktemp("tiny-llm"))
+    vocabulary = {word: i for i, word in enumerate(TINY_VOCABULARY)}
+    word_level = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocabulary, unk_token="<unk>"))
+    word_level.pre_tokenizer = tokenizers.pre_tokenizers.WhitespaceSplit()
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=word_level, unk_token="<unk>", eos_token="<|im_end|>",
+                                                     additional_special_tokens=["<|im_start|>"], model_input_names=["input_ids", "attention_mask"])
+    tokenizer.chat_template = ("{% for message in messages %}<|im_start|> {{ message['role'] }} {{ message['content'] }} <|im_end|> {% endfor %}"
+                               "{% if add_generation_prompt %}<|im_start|> assistant {% endif %}")
+    tokenizer.save_pretrained(path)
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(vocab_size=len(vocabulary), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                      num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256,
+                                      bos_token_id=vocabulary["<|im_start|>"], eos_token_id=vocabulary["<|im_end|>"], initializer_range=0.5)
+    transformers.LlamaForCausalLM(config).save_pretrained(path)
+    return path
+
+
+@pytest.fixture
+def tiny_llm(tiny_checkpoint):
+    """LLM on the tiny checkpoint, float32 on CPU, generating greedily."""
+    with mock.patch("os.chdir"):
+        from scripts.llm.LLM import LLM
+    from scripts.llm.backends import CPUBackend
+    llm = LLM(tiny_checkpoint, backend=CPUBackend(precision="float32"))
+    llm.gen_config.do_sample = False
+    llm.gen_config.repetition_penalty = 1.0
+    llm.gen_config.max_new_tokens = 12
+    return llm
@@ -0,0 +1,102 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from scripts.batching import MicroBatcher
+
+
+class GatedBatchFunction:
+    """Stub batch function doubling its requests, that blocks on its first batch until 'release' is called."""
+    def __init__(self, error: Exception | None = None):
+        self.batches = []
+        self.error = error
+        self.started = threading.Event()
+        self._gate = threading.Event()
+
+    def __call__(self, requests: list) -> list:
+        self.batches.append(list(requests))
+        if len(self.batches) == 1:
+            self.started.set()
+            self._gate.wait(timeout=5)
+        if self.error is not None:
+            raise self.error
+        return [request * 2 for request in requests]
+
+    def release(self):
+        self._gate.set()
+
+
+def test_batches_fill_up_to_max_batch_size():
+    function = GatedBatchFunction()
+    batcher = MicroBatcher(function, max_batch_size=3, max_wait_ms=50)
+    first = batcher.submit(0)
+    assert function.started.wait(timeout=5)
+    # Queued while the worker is busy with the first batch
+    futures = [batcher.submit(i) for i in range(1, 8)]
+    function.release()
+    assert [future.result(timeout=5) for future in [first, *futures]] == [2 * i for i in range(8)]
+    batcher.close()
+    assert [len(batch) for batch in function.batches] == [1, 3, 3, 1]
+    assert batcher.stats.summary()["max_batch_size"] == 3
+    assert batcher.stats.items == 8
+
+
+def test_partial_batch_is_flushed_after_max_wait():
+    function = GatedBatchFunction()
+    function.release()
+    batcher = MicroBatcher(function, max_batch_size=8, max_wait_ms=100)
+    start = time.monotonic()
+    assert batcher(21) == 42
+    elapsed = time.monotonic() - start
+    batcher.close()
+    assert function.batches == [[21]]
+    assert 0.09 <= elapsed < 2
+
+
+def test_results_match_their_requests():
+    function = GatedBatchFunction()
+    function.release()
+    batcher = MicroBatcher(function, max_batch_size=4, max_wait_ms=5)
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(batcher, range(100)))
+    batcher.close()
+    assert results == [2 * i for i in range(100)]
+    assert sorted(request for batch in function.batches for request in batch) == list(range(100))
+    assert all(len(batch) <= 4 for batch in function.batches)
+
+
+def test_exception_reaches_every_future_of_the_batch():
+    function = GatedBatchFunction(error=ValueError("out of memory"))
+    batcher = MicroBatcher(function, max_batch_size=4, max_wait_ms=50)
+    first = batcher.submit(0)
+    assert function.started.wait(timeout=5)
+    futures = [batcher.submit(i) for i in range(1, 5)]
+    function.release()
+    for future in [first, *futures]:
+        with pytest.raises(ValueError, match="out of memory"):
+            future.result(timeout=5)
+    batcher.close()
+    assert [len(batch) for batch in function.batches] == [1, 4]
+
+
+def test_wrong_number_of_results_fails_the_batch():
+    batcher = MicroBatcher(lambda requests: requests[:-1], max_batch_size=2, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(2)]
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+    batcher.close()
+
+
+def test_close_processes_pending_requests():
+    function = GatedBatchFunction()
+    batcher = MicroBatcher(function, max_batch_size=2, max_wait_ms=1000)
+    first = batcher.submit(1)
+    assert function.started.wait(timeout=5)
+    pending = batcher.submit(2)
+    function.release()
+    batcher.close()
+    assert first.result(timeout=0) == 2
+    assert pending.result(timeout=0) == 4
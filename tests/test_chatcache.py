@@ -0,0 +1,80 @@
+import time
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from bot.chatcache import ChatCache
+from bot.sqlutils import ChatStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = ChatStorage(str(tmp_path / "chats.db"))
+    yield storage
+    storage.close()
+
+
+def last_access(storage: ChatStorage, chat_id: str) -> float | None:
+    row = storage.submit(lambda conn: conn.execute("SELECT last_access FROM session WHERE id = ?;", (chat_id,)).fetchone()).result()
+    return None if row is None else datetime.fromisoformat(row[0]).timestamp()
+
+
+def test_close_writes_the_access_held_back_by_the_debounce(storage):
+    cache = ChatCache(storage, flush_interval=60, session_debounce=60)
+    cache.update_session("1", "config")
+    cache.flush()
+    first = last_access(storage, "1")
+    time.sleep(0.01)
+    cache.update_session("1", "config")
+    cache.flush()
+    assert last_access(storage, "1") == pytest.approx(first)
+    cache.close()
+    assert last_access(storage, "1") > first
+
+
+def test_held_back_access_is_written_once_the_debounce_expires(storage):
+    cache = ChatCache(storage, flush_interval=60, session_debounce=0.05)
+    cache.update_session("1", "config")
+    cache.flush()
+    first = last_access(storage, "1")
+    time.sleep(0.01)
+    cache.update_session("1", "config")
+    time.sleep(0.05)
+    cache.flush()
+    assert last_access(storage, "1") > first
+    cache.close()
+
+
+def test_written_sessions_of_uncached_chats_are_evicted(storage):
+    cache = ChatCache(storage, max_chats=2, flush_interval=60, session_debounce=60)
+    cache.append_chat("1", [{"role": "user", "content": "hi"}])
+    for chat_id in ["1", "2", "3", "4"]:
+        cache.update_session(chat_id, "config")
+    cache.flush()
+    assert set(cache._sessions) == {"1"}
+    assert all(last_access(storage, chat_id) is not None for chat_id in ["1", "2", "3", "4"])
+    cache.close()
+
+
+def test_failed_flush_is_retried_without_duplicates(storage, monkeypatch):
+    cache = ChatCache(storage, flush_interval=60, session_debounce=60)
+    cache.append_chat("1", [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}])
+    cache.update_session("1", "config")
+    write_batch = storage._write_batch_
+    calls = []
+
+    def fail_after_writing(conn, *args):
+        # The messages are inserted, then the job fails: none of them must be committed
+        calls.append(args)
+        write_batch(conn, *args)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("injected failure")
+
+    monkeypatch.setattr(storage, "_write_batch_", fail_after_writing)
+    cache.flush()
+    assert storage.get_chat("1") == []
+    cache.flush()
+    assert len(calls) == 2
+    assert storage.get_chat("1") == [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+    cache.close()
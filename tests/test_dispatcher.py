@@ -0,0 +1,109 @@
+import time
+import asyncio
+
+from telegram.error import RetryAfter
+
+from bot.dispatcher import OutboundDispatcher
+
+
+class StubMessage:
+    def __init__(self, bot, chat_id, message_id: int, text: str):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+
+    async def edit_text(self, text: str):
+        return await self.bot.call("edit", self.chat_id, text)
+
+
+class StubBot:
+    """Stub telegram.Bot recording the (monotonic time, kind, chat id, text) of every call.
+
+    The first 'throttled[chat_id]' calls to a chat raise RetryAfter('retry_after').
+    """
+    def __init__(self, throttled: dict | None = None, retry_after: int = 1):
+        self.calls = []
+        self.throttled = dict(throttled or {})
+        self.retry_after = retry_after
+        self._message_ids = 0
+
+    async def call(self, kind: str, chat_id, text: str | None = None):
+        if self.throttled.get(chat_id, 0) > 0:
+            self.throttled[chat_id] -= 1
+            raise RetryAfter(self.retry_after)
+        self.calls.append((time.monotonic(), kind, chat_id, text))
+        self._message_ids += 1
+        return StubMessage(self, chat_id, self._message_ids, text)
+
+    async def send_message(self, chat_id, text: str, **kwargs):
+        return await self.call("message", chat_id, text)
+
+    async def send_chat_action(self, chat_id, action: str):
+        return await self.call("typing", chat_id)
+
+    def times(self, chat_id) -> list:
+        return [at for at, _, chat, _ in self.calls if chat == chat_id]
+
+
+def test_per_chat_rate_holds_across_awaited_calls():
+    # Awaiting every call empties the chat queue each time: the chat bucket must survive it
+    async def run():
+        bot = StubBot()
+        dispatcher = OutboundDispatcher(bot, rate=1000.0, per_chat_rate=20.0, per_chat_burst=3.0)
+        message = await dispatcher.send(1, "0")
+        for i in range(1, 11):
+            await (dispatcher.edit(message, str(i)) if i % 2 else dispatcher.send(1, str(i)))
+        return bot
+    bot = asyncio.run(run())
+    times = bot.times(1)
+    assert len(times) == 11
+    # 3 calls in a burst, then one every 1/20 s
+    assert times[-1] - times[0] >= (11 - 3) / 20.0 * 0.9
+    assert [text for _, _, _, text in bot.calls] == [str(i) for i in range(11)]
+
+
+def test_retry_after_pauses_only_the_throttled_chat():
+    async def run():
+        bot = StubBot(throttled={1: 1}, retry_after=1)
+        dispatcher = OutboundDispatcher(bot, rate=1000.0, per_chat_rate=100.0, per_chat_burst=3.0)
+        start = time.monotonic()
+        throttled = dispatcher.send(1, "throttled")
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*(dispatcher.send(2, str(i)) for i in range(3)))
+        other = time.monotonic() - start
+        await throttled
+        return time.monotonic() - start, other, dispatcher
+    throttled, other, dispatcher = asyncio.run(run())
+    assert throttled >= 0.9
+    assert other < 0.5
+    assert dispatcher.retried == 1
+
+
+def test_retry_after_on_many_chats_pauses_every_chat():
+    async def run():
+        chats = OutboundDispatcher.GLOBAL_THROTTLE_CHATS
+        bot = StubBot(throttled={chat_id: 1 for chat_id in range(chats)}, retry_after=1)
+        dispatcher = OutboundDispatcher(bot, rate=1000.0, per_chat_rate=100.0, per_chat_burst=3.0)
+        throttled = [dispatcher.send(chat_id, "throttled") for chat_id in range(chats)]
+        await asyncio.sleep(0.05)
+        start = time.monotonic()
+        await dispatcher.send(chats, "other")
+        other = time.monotonic() - start
+        await asyncio.gather(*throttled)
+        return other
+    assert asyncio.run(run()) >= 0.8
+
+
+def test_idle_chat_buckets_are_dropped():
+    async def run():
+        bot = StubBot()
+        dispatcher = OutboundDispatcher(bot, rate=1000.0, per_chat_rate=100.0, per_chat_burst=1.0)
+        await asyncio.gather(*(dispatcher.send(chat_id, "hello") for chat_id in range(50)))
+        assert len(dispatcher._buckets) == 50
+        await asyncio.sleep(0.05)
+        await dispatcher.send(50, "hello")
+        return dispatcher
+    dispatcher = asyncio.run(run())
+    assert list(dispatcher._buckets) == [50]
+    assert not dispatcher._chats
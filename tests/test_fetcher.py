@@ -0,0 +1,126 @@
+import time
+import socket
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from pipelines.fetcher import Fetcher
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def serve(handler, port: int | None = None):
+    """Local HTTP server answering every GET with 'handler'."""
+    app = web.Application()
+    app.router.add_get("/{path:.*}", handler)
+    server = TestServer(app, host="127.0.0.1", port=port)
+    await server.start_server()
+    try:
+        yield server
+    finally:
+        await server.close()
+
+
+def fetch(fetcher: Fetcher, handler, path: str = "/page", **kwargs) -> tuple[dict, float]:
+    """Fetch 'path' from a server answering with 'handler', return the page and the elapsed seconds."""
+    async def main():
+        async with serve(handler) as server, aiohttp.ClientSession() as session:
+            start = time.monotonic()
+            page = await fetcher.fetch(session, str(server.make_url(path)), **kwargs)
+            return page, time.monotonic() - start
+    return asyncio.run(main())
+
+
+def failing(responses: list[web.Response], calls: list):
+    """Handler answering with 'responses' in order, then 200."""
+    async def handler(request):
+        calls.append(time.monotonic())
+        return responses[len(calls) - 1] if len(calls) <= len(responses) else web.Response(text="<html>ok</html>")
+    return handler
+
+
+def test_429_is_retried_after_retry_after():
+    calls = []
+    page, elapsed = fetch(Fetcher(retries=2, rate_per_host=0), failing([web.Response(status=429, headers={"Retry-After": "1"})], calls))
+    assert page["status"] == 200 and page["html"] == "<html>ok</html>"
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 1
+
+
+def test_5xx_is_retried_with_backoff():
+    calls = []
+    page, _ = fetch(Fetcher(retries=2, rate_per_host=0), failing([web.Response(status=503), web.Response(status=502)], calls))
+    assert page["status"] == 200
+    assert len(calls) == 3
+    # Exponential backoff: 1 then 2 seconds
+    assert calls[1] - calls[0] >= 1
+    assert calls[2] - calls[1] >= 2
+
+
+def test_5xx_fails_once_retries_are_exhausted():
+    calls = []
+    with pytest.raises(aiohttp.ClientResponseError):
+        fetch(Fetcher(retries=0, rate_per_host=0), failing([web.Response(status=500)], calls))
+    assert len(calls) == 1
+
+
+async def conditional(request):
+    if request.headers.get("If-None-Match") == '"v1"' or request.headers.get("If-Modified-Since") == "Mon, 01 Jan 2024 00:00:00 GMT":
+        return web.Response(status=304)
+    return web.Response(text="<html>v1</html>", headers={"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+
+
+def test_conditional_requests_get_304():
+    fetcher = Fetcher(rate_per_host=0)
+    page, _ = fetch(fetcher, conditional)
+    assert page["status"] == 200 and page["etag"] == '"v1"'
+    not_modified, _ = fetch(fetcher, conditional, etag=page["etag"])
+    assert not_modified["status"] == 304 and not_modified["html"] is None and not_modified["etag"] == '"v1"'
+    not_modified, _ = fetch(fetcher, conditional, last_modified=page["last_modified"])
+    assert not_modified["status"] == 304 and not_modified["last_modified"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+
+
+def crawl(fetcher: Fetcher, n_pages: int, port: int | None = None) -> tuple[int, int]:
+    """Crawl 'n_pages' pages of a slow server, return the number of pages fetched and the maximum number of requests in flight."""
+    in_flight, peak, pages = 0, 0, []
+
+    async def slow(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        return web.Response(text=request.path)
+
+    async def on_page(page):
+        pages.append(page)
+
+    async def main():
+        async with serve(slow, port) as server:
+            await fetcher.crawl([(str(server.make_url(f"/{i}")), None, None) for i in range(n_pages)], on_page)
+
+    asyncio.run(main())
+    return len(pages), peak
+
+
+def test_per_host_concurrency_limit():
+    fetched, peak = crawl(Fetcher(max_workers=8, per_host=2, rate_per_host=0), n_pages=12)
+    assert fetched == 12
+    assert peak == 2
+
+
+def test_fetcher_is_reusable_across_event_loops():
+    fetcher = Fetcher(max_workers=8, per_host=2, rate_per_host=0)
+    # Same host in both runs, so that the second run would reuse the limiter of the first one
+    port = free_port()
+    assert crawl(fetcher, n_pages=6, port=port) == (6, 2)
+    assert crawl(fetcher, n_pages=6, port=port) == (6, 2)
@@ -0,0 +1,73 @@
+from scripts.llm.history import HistoryWindow
+
+SYSTEM = [{"role": "user", "content": "you are a bot"}, {"role": "assistant", "content": "got it"}]
+
+
+class WordTokenizer:
+    """Stub tokenizer: one token per word, counting the encoded texts."""
+    def __init__(self):
+        self.encoded = 0
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> list[str]:
+        self.encoded += 1
+        return text.split()
+
+
+def conversation(turns: int, words: int = 10) -> list[dict]:
+    messages = list(SYSTEM)
+    for turn in range(turns):
+        messages.append({"role": "user", "content": " ".join([f"question{turn}"] * words)})
+        messages.append({"role": "assistant", "content": " ".join([f"answer{turn}"] * words)})
+    return messages
+
+
+def tokens(window: HistoryWindow, messages: list[dict], new_message: str) -> int:
+    return sum(window.count(message) for message in messages) + window.count({"role": "user", "content": new_message}) + window.reserved_tokens
+
+
+def test_short_history_is_kept_whole():
+    window = HistoryWindow(WordTokenizer(), max_tokens=200, reserved_tokens=20)
+    chat = conversation(3)
+    fitted = window.fit(chat, new_message="hello")
+    assert fitted == chat and fitted is not chat
+
+
+def test_long_history_keeps_the_system_turns_and_fits_the_target_ratio():
+    window = HistoryWindow(WordTokenizer(), max_tokens=200, reserved_tokens=20, target_ratio=0.75)
+    chat = conversation(20)
+    fitted = window.fit(chat, new_message="hello")
+    assert fitted[:2] == SYSTEM
+    assert fitted[2]["role"] == "user"
+    assert fitted[-2:] == chat[-2:]
+    assert tokens(window, fitted, "hello") <= 0.75 * 200
+    # The window is as large as the ratio allows: one more turn would not fit
+    kept = len(fitted) - len(SYSTEM)
+    assert tokens(window, SYSTEM + chat[-kept - 2:], "hello") > 0.75 * 200
+
+
+def test_kept_window_starts_with_a_user_message():
+    window = HistoryWindow(WordTokenizer(), max_tokens=200, reserved_tokens=20, target_ratio=0.75)
+    # Long questions and short answers: the budget boundary falls on an assistant message, which must be dropped too
+    chat = list(SYSTEM)
+    for turn in range(20):
+        chat += [{"role": "user", "content": " ".join([f"question{turn}"] * 30)}, {"role": "assistant", "content": f"answer{turn}"}]
+    fitted = window.fit(chat, new_message="hello")
+    assert fitted[:2] == SYSTEM
+    assert len(fitted) > 2 and fitted[2]["role"] == "user"
+    assert tokens(window, fitted, "hello") <= 0.75 * 200
+
+
+def test_system_turns_are_kept_when_nothing_else_fits():
+    window = HistoryWindow(WordTokenizer(), max_tokens=50, reserved_tokens=40)
+    fitted = window.fit(conversation(5), new_message="hello")
+    assert fitted == SYSTEM
+
+
+def test_token_counts_are_cached():
+    tokenizer = WordTokenizer()
+    window = HistoryWindow(tokenizer, max_tokens=200, reserved_tokens=20)
+    chat = conversation(20)
+    window.fit(chat, new_message="hello")
+    encoded = tokenizer.encoded
+    window.fit(chat + [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "hi there"}], new_message="bye")
+    assert tokenizer.encoded - encoded == 2
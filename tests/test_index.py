@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from scripts.embedder.index import EmbeddingIndex, IVFIndex, QuantizedIndex, load_index, l2_normalize
+
+
+def clustered(n: int, dim: int = 32, clusters: int = 16, seed: int = 0) -> np.ndarray:
+    """Embeddings around 'clusters' random directions, like sentence embeddings of a few topics."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    return (centers[rng.integers(clusters, size=n)] + 0.3 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def build(backend: str, embeddings: np.ndarray, ids=None, names=None):
+    if backend == "exact":
+        return EmbeddingIndex(embeddings, ids=ids, names=names)
+    if backend == "ivf":
+        return IVFIndex.build(embeddings, ids=ids, names=names, nprobe=4)
+    return QuantizedIndex(embeddings, ids=ids, names=names)
+
+
+def same_results(results: list[tuple], expected: list[tuple]) -> bool:
+    return [entry for entry, _ in results] == [entry for entry, _ in expected] and \
+        np.allclose([score for _, score in results], [score for _, score in expected], atol=1e-5)
+
+
+@pytest.mark.parametrize("n", [1, 2, 3])
+def test_ivf_builds_on_tiny_inputs(n):
+    embeddings = clustered(n)
+    index = IVFIndex.build(embeddings)
+    assert index.n_lists <= n
+    assert index.search(embeddings[0], top_k=1)[0][0] == 0
+
+
+@pytest.mark.parametrize("backend", ["exact", "ivf", "quantized"])
+def test_add_remove_save_and_load(tmp_path, backend):
+    embeddings = clustered(200)
+    index = build(backend, embeddings[:150], ids=np.arange(150), names=[f"entry {i}" for i in range(150)])
+    index.add(embeddings[150:], np.arange(150, 200), names=[f"entry {i}" for i in range(150, 200)])
+    index.remove([0, 1, 199])
+    # Re-adding an id replaces its entry
+    index.add(embeddings[5] * -1, [7])
+    assert len(index) == 197
+    assert index.search(embeddings[199], top_k=1)[0][0] != 199
+    assert index.search(-embeddings[5], top_k=1)[0][0] == 7
+    assert index.name(160) == "entry 160" and index.name(0) == 0
+
+    index.save(str(tmp_path / backend))
+    for mmap in (False, True):
+        loaded = load_index(str(tmp_path / backend), mmap=mmap)
+        assert type(loaded) is type(index) and len(loaded) == len(index)
+        assert loaded.name(160) == "entry 160"
+        for query in embeddings[[2, 50, 180]]:
+            assert same_results(loaded.search(query, top_k=5), index.search(query, top_k=5))
+
+
+def test_ivf_recall_against_exact_search():
+    data = clustered(5100, dim=64, clusters=50)
+    embeddings, queries = data[:5000], data[5000:]
+    exact = EmbeddingIndex(embeddings)
+    ivf = IVFIndex.build(embeddings, nprobe=8)
+    found = [len({entry for entry, _ in ivf.search(query, top_k=10)} & {entry for entry, _ in exact.search(query, top_k=10)}) for query in queries]
+    assert np.mean(found) / 10 >= 0.9
+    # nprobe = n_lists scans every list: the search is exact
+    for query in queries[:10]:
+        assert same_results(ivf.search(query, top_k=10, nprobe=ivf.n_lists), exact.search(query, top_k=10))
+    assert np.allclose(l2_normalize(embeddings) @ l2_normalize(queries[0]), exact.scores(queries[0]), atol=1e-5)
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from scripts.embedder.index import EmbeddingIndex, IVFIndex, QuantizedIndex
+from scripts.embedder.lexical import BM25Index, fuse, tokenize
+
+
+def test_matching_returns_the_live_documents_of_the_posting_lists():
+    index = BM25Index()
+    index.add([1, 2, 3], ["temperature of the sampling", "max_new_tokens: number of generated tokens", "top_p nucleus sampling"])
+    assert index.matching(tokenize("max new tokens")) == [2]
+    assert sorted(index.matching(tokenize("sampling"))) == [1, 3]
+    assert index.matching(tokenize("unknown words")) == []
+    index.remove([3])
+    assert index.matching(tokenize("sampling")) == [1]
+    index.compact()
+    assert index.matching(tokenize("nucleus sampling")) == [1]
+
+
+def test_lexical_only_hits_are_fused_on_their_actual_similarity():
+    vectors = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.1, 0.0, 1.0]])
+    query = np.array([1.0, 0.0, 0.0])
+    lexical = BM25Index()
+    lexical.add([0, 1, 2], ["weather forecast", "set the temperature", "reset the conversation"])
+    for index in [EmbeddingIndex(vectors), IVFIndex.build(vectors, n_lists=2), QuantizedIndex(vectors)]:
+        dense = index.search(query, top_k=1)
+        hits = dict(fuse(dense, lexical.search("temperature", top_k=1), weight=0.1, similarities=lambda ids: index.similarities(query, ids)))
+        # Entry 1 is orthogonal to the query: the keyword boost alone must not lift it to the similarity of entry 0
+        assert hits[0] == pytest.approx(1.0, abs=0.02)
+        assert hits[1] == pytest.approx(0.1, abs=0.02)
+        assert hits[1] < 0.5
@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+PROMPTS = [[{"role": "user", "content": "hi"}],
+           [{"role": "user", "content": "tell me a long story about cats and dogs please"}],
+           [{"role": "user", "content": "what can you do for me"}],
+           [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "the weather is nice today"}, {"role": "user", "content": "cats"}]]
+
+
+def request(prompt: list[dict], confidence: bool = True) -> dict:
+    return {"chat_template": prompt, "confidence": confidence, "cache_key": None, "on_text": None}
+
+
+def test_batched_generation_matches_single_prompts(tiny_llm):
+    # Prompts of different lengths: the shorter ones are left-padded in the batch
+    singles = [tiny_llm._generate_(**request(prompt)) for prompt in PROMPTS]
+    batched = tiny_llm._generate_batch_([request(prompt, confidence=row != 2) for row, prompt in enumerate(PROMPTS)])
+    assert [reply["text"] for reply in batched] == [reply["text"] for reply in singles]
+    assert batched[2]["confidence"] is None
+    for row in [0, 1, 3]:
+        assert batched[row]["confidence"] == pytest.approx(singles[row]["confidence"], rel=1e-4)
+
+
+def test_batcher_returns_each_reply_to_its_caller(tiny_llm):
+    singles = [tiny_llm._generate_(**request(prompt)) for prompt in PROMPTS]
+    tiny_llm.enable_batching(max_batch_size=len(PROMPTS), max_wait_ms=500)
+    try:
+        with ThreadPoolExecutor(len(PROMPTS)) as pool:
+            replies = list(pool.map(lambda prompt: tiny_llm._dispatch_(prompt, True), PROMPTS))
+        assert tiny_llm.scheduler.stats.items == len(PROMPTS)
+        assert tiny_llm.scheduler.stats.batches < len(PROMPTS)
+    finally:
+        tiny_llm.scheduler.close()
+    assert [reply["text"] for reply in replies] == [reply["text"] for reply in singles]
+    assert [reply["confidence"] for reply in replies] == pytest.approx([reply["confidence"] for reply in singles], rel=1e-4)
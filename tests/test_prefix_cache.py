@@ -0,0 +1,69 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from scripts.llm.prefix_cache import PrefixCache
+
+LAYERS, HEADS, DIM = 2, 2, 4
+
+
+def past(length: int) -> tuple:
+    """Legacy past_key_values of 'length' tokens, the values of position i being i."""
+    positions = torch.arange(length, dtype=torch.float32).view(1, 1, length, 1).expand(1, HEADS, length, DIM)
+    return tuple((positions.clone(), positions.clone()) for _ in range(LAYERS))
+
+
+def nbytes(length: int) -> int:
+    return 2 * LAYERS * HEADS * length * DIM * 4
+
+
+def test_longest_common_prefix_is_reused():
+    cache = PrefixCache()
+    cache.store("chat", torch.arange(10), past(10))
+    reused = cache.lookup("chat", torch.tensor([0, 1, 2, 3, 4, 5, 99, 99, 99, 99, 99, 99]))
+    assert all(key.shape[2] == 6 and value.shape[2] == 6 for key, value in reused)
+    assert torch.equal(reused[0][0][0, 0, :, 0], torch.arange(6, dtype=torch.float32))
+    assert (cache.hits, cache.misses, cache.saved_tokens, cache.prefill_tokens) == (1, 0, 6, 6)
+    # The entry is consumed by the lookup
+    assert len(cache) == 0 and cache.nbytes == 0
+    assert cache.lookup("chat", torch.arange(12)) is None
+
+
+def test_reuse_leaves_at_least_one_token_to_prefill():
+    cache = PrefixCache()
+    cache.store("chat", torch.arange(10), past(10))
+    reused = cache.lookup("chat", torch.arange(10))
+    assert reused[0][0].shape[2] == 9
+    cache.store("chat", torch.arange(10), past(10))
+    assert cache.lookup("chat", torch.tensor([7, 1, 2])) is None
+    assert cache.misses == 1
+
+
+def test_entries_are_evicted_by_bytes_in_lru_order():
+    cache = PrefixCache(max_entries=10, max_bytes=nbytes(10) + nbytes(10))
+    cache.store("a", torch.arange(10), past(10))
+    cache.store("b", torch.arange(10), past(10))
+    cache.store("c", torch.arange(5), past(5))
+    assert list(cache._entries) == ["b", "c"]
+    assert cache.nbytes == nbytes(10) + nbytes(5)
+    # Keys/values longer than the stored ids (the last generated token was not fed back) are cropped to them
+    cache.store("d", torch.arange(4), past(5))
+    assert list(cache._entries) == ["b", "c", "d"]
+    assert cache.nbytes == nbytes(10) + nbytes(5) + nbytes(4)
+    cache.store("huge", torch.arange(30), past(30))
+    assert "huge" not in cache._entries
+
+
+def test_reused_prefix_gives_the_same_reply_as_a_cold_generate(tiny_llm):
+    first = [{"role": "user", "content": "hi"}]
+    answer = tiny_llm._generate_(first, confidence=True)
+    second = first + [{"role": "assistant", "content": answer["text"]}, {"role": "user", "content": "tell me a story about cats"}]
+    cold = tiny_llm._generate_(second, confidence=True)
+
+    tiny_llm.enable_prefix_cache()
+    tiny_llm._generate_(first, confidence=True, cache_key="chat")
+    warm = tiny_llm._generate_(second, confidence=True, cache_key="chat")
+    assert tiny_llm.prefix_cache.hits == 1
+    assert tiny_llm.prefix_cache.saved_tokens > 0
+    assert warm["text"] == cold["text"]
+    assert warm["confidence"] == pytest.approx(cold["confidence"], rel=1e-4)
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from scripts.benchmarks.confidence_benchmark import loop_confidence
+from scripts.llm.scoring import confidence_stats, token_logprobs
+
+BATCH, STEPS, VOCABULARY = 3, 20, 50
+
+
+def generation(seed: int = 0, filtered: int = 0) -> tuple[tuple, torch.Tensor]:
+    """Random per-step scores and generated ids; the first 'filtered' tokens get -inf scores, as top-k/top-p leave them."""
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn(BATCH, STEPS, VOCABULARY, generator=generator) * 5
+    logits[:, :, :filtered] = float("-inf")
+    ids = torch.randint(filtered, VOCABULARY, (BATCH, STEPS), generator=generator)
+    return tuple(logits[:, step] for step in range(STEPS)), ids
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 16, 64])
+def test_mean_probability_matches_the_former_loop(chunk_size):
+    scores, ids = generation()
+    stats = confidence_stats(scores, ids, chunk_size=chunk_size)
+    expected = [loop_confidence(scores, ids, row).item() for row in range(BATCH)]
+    assert [row["mean"] for row in stats] == pytest.approx(expected, rel=1e-5)
+    assert all(row["tokens"] == STEPS for row in stats)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64])
+def test_logprobs_and_entropies_match_log_softmax(chunk_size):
+    scores, ids = generation(seed=1, filtered=10)
+    logprobs, entropies, mask = token_logprobs(scores, ids, chunk_size=chunk_size)
+    log_distributions = torch.log_softmax(torch.stack(scores, dim=1), dim=-1)
+    probabilities = log_distributions.exp()
+    assert torch.allclose(logprobs, log_distributions.gather(-1, ids.unsqueeze(-1)).squeeze(-1), atol=1e-5)
+    assert torch.allclose(entropies, torch.where(probabilities > 0, -probabilities * log_distributions, torch.zeros_like(probabilities)).sum(dim=-1), atol=1e-5)
+    assert torch.isfinite(entropies).all()
+    assert mask.all()
+
+
+def test_padding_after_eos_is_masked():
+    scores, ids = generation(seed=2)
+    eos = VOCABULARY - 1
+    ids[ids == eos] = 0
+    ids[0, 4] = eos
+    stats = confidence_stats(scores, ids, eos_token_id=eos, chunk_size=3)
+    assert [row["tokens"] for row in stats] == [5, STEPS, STEPS]
+    assert stats[0]["mean"] == pytest.approx(loop_confidence(scores[:5], ids[:, :5], 0).item(), rel=1e-5)
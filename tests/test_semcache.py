@@ -0,0 +1,54 @@
+import sqlite3
+
+import numpy as np
+
+from bot.semcache import SemanticAnswerCache
+
+
+def embedding(seed: int, dim: int = 16) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def test_answers_are_persisted_by_the_writer_thread(tmp_path):
+    db_path = str(tmp_path / "answer_cache.db")
+    cache = SemanticAnswerCache(threshold=0.99, max_entries=2, db_path=db_path)
+    for seed in range(3):
+        cache.store(embedding(seed), f"question {seed}", f"answer {seed}")
+    assert cache.lookup(embedding(2)) == "answer 2"
+    assert cache.lookup(embedding(0)) is None  # evicted
+    cache.close()
+    with sqlite3.connect(db_path) as conn:
+        assert sorted(question for question, in conn.execute("SELECT question FROM answer_cache;")) == ["question 1", "question 2"]
+
+    reloaded = SemanticAnswerCache(threshold=0.99, max_entries=2, db_path=db_path)
+    assert len(reloaded) == 2
+    assert reloaded.lookup(embedding(1)) == "answer 1"
+    assert reloaded.lookup(embedding(0)) is None
+    reloaded.close()
+
+
+def test_memory_only_cache():
+    cache = SemanticAnswerCache(threshold=0.99, max_entries=4)
+    cache.store(embedding(0), "question", "answer")
+    assert cache.lookup(embedding(0) * 3) == "answer"
+    assert cache.stats()["hits"] == 1
+    cache.close()
+
+
+def test_expired_best_match_falls_back_to_the_next_valid_one(monkeypatch):
+    cache = SemanticAnswerCache(threshold=0.9, max_entries=4, ttl=60)
+    question = embedding(0)
+    close = question + 0.05 * embedding(1)
+    now = 1000.0
+    monkeypatch.setattr("bot.semcache.time.time", lambda: now)
+    cache.store(question, "old question", "old answer")
+    now += 50
+    cache.store(close, "close question", "close answer")
+    now += 20
+    # The identical question has expired: the close one, still valid, is served and the expired one is evicted
+    assert cache.lookup(question) == "close answer"
+    assert len(cache) == 1
+    now += 50
+    assert cache.lookup(question) is None
+    assert len(cache) == 0
+    cache.close()
@@ -0,0 +1,51 @@
+import sqlite3
+
+from bot.sqlutils import ChatStorage
+
+DEFAULT = [{"role": "user", "content": "you are a bot"}, {"role": "assistant", "content": "got it"}]
+TURNS = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}, {"role": "user", "content": "bye"}]
+
+
+def legacy_database(path: str) -> str:
+    """A database with the legacy 'history' table: one stringified template per chat, the DEFAULT one included."""
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE history (id TEXT constraint history_pk primary key, template TEXT);")
+        conn.executemany("INSERT INTO history (id, template) VALUES (?, ?);",
+                         [("DEFAULT", str(DEFAULT)), ("1", str(DEFAULT + TURNS)), ("2", str(DEFAULT))])
+    conn.close()
+    return path
+
+
+def stored(storage: ChatStorage, chat_id: str) -> list[tuple]:
+    return storage.submit(lambda conn: conn.execute("SELECT seq, role, content FROM messages WHERE chat_id = ? ORDER BY seq;", (chat_id,)).fetchall()).result()
+
+
+def test_legacy_history_is_migrated_once(tmp_path):
+    path = legacy_database(str(tmp_path / "chats.db"))
+    storage = ChatStorage(path)
+    # The DEFAULT template is stored once, the chats only store the messages following it
+    assert [(role, content) for _, role, content in stored(storage, "DEFAULT")] == [(message["role"], message["content"]) for message in DEFAULT]
+    assert [seq for seq, _, _ in stored(storage, "1")] == [1, 2, 3]
+    assert stored(storage, "2") == []
+    assert storage.get_chat("1") == DEFAULT + TURNS
+    assert storage.get_chat("2") == DEFAULT
+    assert storage.get_chat("1", last_n=1) == DEFAULT + TURNS[-1:]
+    storage.append_chat("1", [{"role": "assistant", "content": "see you"}])
+    storage.close()
+
+    storage = ChatStorage(path)
+    assert [seq for seq, _, _ in stored(storage, "1")] == [1, 2, 3, 4]
+    assert storage.get_chat("1") == DEFAULT + TURNS + [{"role": "assistant", "content": "see you"}]
+    storage.close()
+
+
+def test_history_pages_start_from_the_latest_messages(tmp_path):
+    storage = ChatStorage(str(tmp_path / "chats.db"))
+    messages = [{"role": "user" if seq % 2 else "assistant", "content": str(seq)} for seq in range(1, 6)]
+    storage.append_chat("1", messages)
+    assert storage.get_chat_page("1", page=1, page_size=2) == (messages[3:], 3)
+    assert storage.get_chat_page("1", page=2, page_size=2) == (messages[1:3], 3)
+    assert storage.get_chat_page("1", page=3, page_size=2) == (messages[:1], 3)
+    assert storage.get_chat_page("1", page=4, page_size=2) == ([], 3)
+    assert storage.get_chat_page("unknown", page=1, page_size=2) == ([], 1)
+    storage.close()
@@ -0,0 +1,73 @@
+import os
+import sys
+import signal
+import hashlib
+import subprocess
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+pytest.importorskip("trafilatura")
+pytest.importorskip("tqdm")
+
+with mock.patch("os.chdir"):
+    from pipelines.web_scraped_dataset import ArticleWriter, read_dataset, simhash
+from pipelines.fetcher import Checkpoint
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Writes 'pages' articles in chunks of 4 and kills itself with SIGKILL: 'between' after 10 pages (2 chunks written, 2
+# articles in memory), 'commit' at the second chunk, after its file is closed but before the checkpoint commit
+CRASHING_WRITER = """
+import os, sys, signal
+from unittest import mock
+sys.path.insert(0, {root!r})
+with mock.patch("os.chdir"):
+    from pipelines.web_scraped_dataset import ArticleWriter
+from pipelines.fetcher import Checkpoint
+from tests.test_web_scraped_dataset import page, article
+
+path, checkpoint_path, pages, mode = sys.argv[1], sys.argv[2], int(sys.argv[3]), sys.argv[4]
+checkpoint = Checkpoint(checkpoint_path)
+writer = ArticleWriter(path, checkpoint, chunk_size=4)
+if mode == "commit":
+    commit = checkpoint.commit
+    checkpoint.commit = lambda: os.kill(os.getpid(), signal.SIGKILL) if writer.written >= 8 else commit()
+for i in range(pages):
+    writer.add(page(i), article(i))
+    if mode == "between" and i == 9:
+        os.kill(os.getpid(), signal.SIGKILL)
+"""
+
+
+def page(i: int) -> dict:
+    return {"url": f"https://example.org/{i}", "status": 200, "etag": None, "last_modified": None}
+
+
+def article(i: int) -> dict:
+    body = " ".join(f"word{i}x{j}" for j in range(20))
+    return {"url": f"https://example.org/{i}", "body": body, "title": f"title {i}", "description": f"description {i}",
+            "content_hash": hashlib.sha1(body.encode()).hexdigest(), "simhash": simhash(body)}
+
+
+@pytest.mark.parametrize("mode, pending", [("between", 4), ("commit", 8)])
+def test_resume_after_kill(tmp_path, mode, pending):
+    path, checkpoint_path, pages = str(tmp_path / "dataset"), str(tmp_path / "checkpoint.db"), 12
+    crash = subprocess.run([sys.executable, "-c", CRASHING_WRITER.format(root=ROOT), path, checkpoint_path, str(pages), mode])
+    assert crash.returncode == -signal.SIGKILL
+
+    checkpoint = Checkpoint(checkpoint_path)
+    urls = checkpoint.pending([page(i)["url"] for i in range(pages)])
+    # Only the pages of the chunks committed before the crash are skipped
+    assert [url for url, _, _ in urls] == [page(i)["url"] for i in range(pages - pending, pages)]
+    writer = ArticleWriter(path, checkpoint, chunk_size=4)
+    for i in range(pages - pending, pages):
+        writer.add(page(i), article(i))
+    writer.close()
+    checkpoint.close()
+
+    articles = list(read_dataset(path, checkpoint_path=checkpoint_path))
+    assert sorted(article["url"] for article in articles) == sorted(page(i)["url"] for i in range(pages))
+    assert not [file for file in os.listdir(path) if file.endswith(".tmp")]